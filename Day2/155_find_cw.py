@@ -0,0 +1,53 @@
+import  sys
+import  logging
+import  pyvisa
+import  pyvisa_py
+
+from python_rf_course.utils.SCPI_wrapper import SCPIWrapper
+from python_rf_course.utils.find_cw      import find_cw
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    # Connect to the instrument (the simulator: python -m python_rf_course.utils.scpi_simulator, ip 127.0.0.2)
+    try:
+        rm = pyvisa.ResourceManager('@py')
+        ip = '10.0.0.19' if len(sys.argv) < 2 else sys.argv[1]
+        sa = rm.open_resource(f'TCPIP0::{ip}::inst0::INSTR')
+        sa.timeout = 60000
+        # Query the signal generator name
+        # <company_name>, <model_number>, <serial_number>,<firmware_revision>
+        print(f'Connected to {','.join(sa.query("*IDN?").strip().split(',')[0:3])}')
+    except pyvisa.errors.VisaIOError:
+        print(f'Failed to connect to the instrument at {ip}')
+        sys.exit(1)
+
+    scpi = SCPIWrapper(instr=sa, log=logging.getLogger('sa_log'), name='SA', error_check='sync')
+
+    # Reset and clear all status (errors) of the spectrum analyzer
+    scpi.write("*RST")
+    scpi.write("*CLS")
+    # Start from the maximal span with the positive peak detector
+    scpi.write("sense:FREQuency:SPAN:FULL")
+    scpi.write(":TRACe1:TYPE WRITe")
+    scpi.write("sense:DETEctor POSitive")
+
+    # The zoom ladder is planned from the sweep time of the analyzer and the requested accuracy
+    # (instead of the fixed 100:10:1:0.1:0.01 MHz spans of 150-154)
+    for method in ('marker', 'trace'):
+        result = find_cw(scpi, accuracy=10.0, method=method)   # Hz
+        print(f"{method:6s}: {result['freq'] * 1e-6:.6f} MHz, {result['power']:.2f} dBm "
+              f"(+-{result['accuracy']:.1f} Hz)")
+        for step in result['steps']:
+            print(f"    Span {step['span'] * 1e-6:12.6f} MHz, RBW {step['rbw']:10.1f} Hz: "
+                  f"predicted {step['predicted']:.3f} s, measured {step['measured']:.3f} s")
+        timing = result['timing']
+        print(f"    Calibration {timing['calibration']:.3f} s, sweeps {timing['sweeps']:.3f} s, "
+              f"host {timing['host']:.3f} s, total {timing['total']:.3f} s")
+        # Start the next search from the full span
+        scpi.write("sense:FREQuency:SPAN:FULL")
+
+    scpi.check_errors()
+    # Close the connection
+    sa.close()
+    rm.close()
@@ -0,0 +1,47 @@
+import  sys
+import  logging
+import  pyvisa
+import  pyvisa_py
+
+from python_rf_course.utils.SCPI_wrapper import SCPIWrapper
+from python_rf_course.utils.find_cw      import find_carriers
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    # Connect to the instrument (the simulator: python -m python_rf_course.utils.scpi_simulator, ip 127.0.0.2)
+    try:
+        rm = pyvisa.ResourceManager('@py')
+        ip = '10.0.0.19' if len(sys.argv) < 2 else sys.argv[1]
+        sa = rm.open_resource(f'TCPIP0::{ip}::inst0::INSTR')
+        sa.timeout = 60000
+        # Query the signal generator name
+        # <company_name>, <model_number>, <serial_number>,<firmware_revision>
+        print(f'Connected to {','.join(sa.query("*IDN?").strip().split(',')[0:3])}')
+    except pyvisa.errors.VisaIOError:
+        print(f'Failed to connect to the instrument at {ip}')
+        sys.exit(1)
+
+    scpi = SCPIWrapper(instr=sa, log=logging.getLogger('sa_log'), name='SA', error_check='sync')
+
+    # Reset and clear all status (errors) of the spectrum analyzer
+    scpi.write("*RST")
+    scpi.write("*CLS")
+    # Start from the maximal span with the positive peak detector
+    scpi.write("sense:FREQuency:SPAN:FULL")
+    scpi.write(":TRACe1:TYPE WRITe")
+    scpi.write("sense:DETEctor POSitive")
+
+    # Every peak 6 dB above the noise floor (read_max_peak of 150-154 finds only the strongest one)
+    result = find_carriers(scpi, prominence=6.0, accuracy=100.0)  # Hz
+    print(f"{'Frequency [MHz]':>18s} {'Power [dBm]':>12s} {'Accuracy [Hz]':>14s}")
+    for carrier in result['carriers']:
+        print(f"{carrier['freq'] * 1e-6:18.6f} {carrier['power']:12.2f} {carrier['accuracy']:14.1f}")
+    timing = result['timing']
+    print(f"{len(result['sweeps'])} sweeps: calibration {timing['calibration']:.3f} s, "
+          f"sweeps {timing['sweeps']:.3f} s, host {timing['host']:.3f} s, total {timing['total']:.3f} s")
+
+    scpi.check_errors()
+    # Close the connection
+    sa.close()
+    rm.close()
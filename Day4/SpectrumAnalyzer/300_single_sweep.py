@@ -4,6 +4,8 @@ from datetime import datetime
 import matplotlib.pyplot as plt
 import numpy as np
 
+from python_rf_course.utils.trace_reader import TraceReader
+
 class SpectrumAnalyzer:
     def __init__(self, visa_address):
         """Initialize connection to spectrum analyzer."""
@@ -12,10 +14,13 @@ class SpectrumAnalyzer:
             self.sa = self.rm.open_resource(visa_address)
             # Set timeout to 20 seconds for long sweeps
             self.sa.timeout = 20000
+            # Binary trace reader (REAL,32 with ASCII fallback)
+            self.reader = TraceReader(self.sa)
             # Clear the instrument status
             self.sa.write("*CLS")
             # Reset to known state
             self.sa.write("*RST")
+            self.reader.invalidate()
             print(f"Connected to: {self.sa.query('*IDN?')}")
         except Exception as e:
             print(f"Error initializing instrument: {str(e)}")
@@ -87,8 +92,8 @@ class SpectrumAnalyzer:
     def get_trace_data(self):
         """Read trace data after sweep completion."""
         try:
-            # Query trace data PyVISA method for reading numerical data from instruments
-            p = self.sa.query_ascii_values(":TRACe:DATA? TRACE1", container=np.array)
+            # Read the trace as a binary block into a float32 buffer
+            p = self.reader.read(1)
             # Build the frequency list
             start_freq  = float(self.sa.query(":FREQuency:START?" ).strip())*1e-6
             stop_freq   = float(self.sa.query(":FREQuency:STOP?"  ).strip())*1e-6
@@ -7,7 +7,7 @@ import  pyvisa_py
 import  yaml
 from    PyQt6.QtWidgets    import QApplication, QMainWindow, QVBoxLayout, QTextBrowser
 from    PyQt6.uic          import loadUi
-from    PyQt6.QtCore       import QTimer
+from    PyQt6.QtCore       import QTimer, Qt
 
 from    time               import sleep
 
@@ -17,9 +17,17 @@ import logging # for pyinstaller
 from python_rf_course.utils.pyqt2python     import h_gui
 from python_rf_course.utils.plot_widget     import PlotWidget
 from python_rf_course.utils.logging_widget  import setup_logger
+from python_rf_course.utils.SCPI_wrapper    import SCPIWrapper
+from python_rf_course.utils.scpi_stats      import SCPIStats
+from python_rf_course.utils.stats_widget    import StatsDock
 
 from o310_long_process import LongProcess
 
+# Points of the Hi-Res curve while the scan runs (peak of each block of a segment)
+HIRES_PLOT_POINTS = 4096
+# Redraw period (ms) of the Hi-Res curve of a scan on disk (HiResStore)
+HIRES_PLOT_PERIOD = 250
+
 
 def is_valid_ip(ip:str) -> bool:
     # Regular expression pattern for matching IP address
@@ -70,6 +78,7 @@ class LabDemoVsaControl(QMainWindow):
         # Create a Resource Manager object
         self.rm         = pyvisa.ResourceManager('@py')
         self.vsa        = None
+        self.scpi       = None
 
         # Load the configuration/default values from the YAML file
         self.Params     = None
@@ -84,12 +93,23 @@ class LabDemoVsaControl(QMainWindow):
 
         self.h_gui['Save'].emit() #  self.cb_save
 
+        # SCPI round trip statistics (opt-in, Stats in the YAML file)
+        self.stats      = SCPIStats() if self.Params.get('Stats', False) else None
+        if self.stats is not None:
+            self.addDockWidget(Qt.DockWidgetArea.RightDockWidgetArea, StatsDock(self.stats, self))
+
         # Create a widget for the Spectrum Analyzer plot
         self.plot_sa        = PlotWidget()
         layout              = QVBoxLayout(self.widget)
         layout.addWidget(self.plot_sa)
         # Set the background color of the plot widget to white
         self.plot_sa.set_background_color('white')
+        # Hi-Res scan curve (extended segment by segment) and the last stitched spectrum
+        self.hires_curve    = None
+        self.hires_data     = None
+        # Live view of a scan on disk: decimated view of the store, redrawn at most every HIRES_PLOT_PERIOD
+        self.hires_timer    = QTimer()
+        self.hires_timer.timeout.connect(self.timer_hires_store)
 
         # Create a timer for the Spectrum Analyzer plot
         self.timer          = QTimer()
@@ -101,34 +121,25 @@ class LabDemoVsaControl(QMainWindow):
 
     def vsa_write(self, cmd:str):
         if self.vsa is not None:
-            # Add logging to the write command (Debug Level)
-            self.log.debug(f"VSA Write: {cmd}")
-            self.vsa.write(cmd)
-            # Check for errors
-            e = self.vsa.query('SYST:ERR?').strip().split(',')
-            if int(e[0]) != 0:
-                self.log.error(f"Error: {e[1]}")
+            # Logging and error checking are done by the SCPI wrapper
+            self.scpi.write(cmd)
 
     def vsa_query(self, cmd:str):
         if self.vsa is not None:
-            # Add logging to the query command (Debug Level)
-            self.log.debug(f"VSA Query: {cmd}")
-            return self.vsa.query(cmd).strip()
+            return self.scpi.query(cmd)
 
     def vsa_read_trace(self):
         if self.vsa is not None:
             # Query the instrument for the trace data
             trace_id = 1
-            # Query trace data PyVISA method for reading numerical data from instruments
-            p           = self.vsa.query_ascii_values(":TRACe:DATA? TRACE1", container=np.array)
-            # Build the frequency list
-
-            # Get the current frequency settings
-            start_freq  = float(self.vsa_query(":FREQuency:START?" ))*1e-6
-            stop_freq   = float(self.vsa_query(":FREQuency:STOP?"  ))*1e-6
-            num_points  =   int(self.vsa_query(":SENSe:SWEep:POIN?"))
-            # Calculate frequency points
-            f           = np.linspace(start_freq, stop_freq, num_points)
+            # Binary (REAL,32) trace read into a float32 buffer (ASCII fallback for older firmware)
+            p           = self.scpi.read_trace(trace_id)
+            # Frequency list (rebuilt only when the frequency settings change)
+            f           = self.scpi.freq_axis.get()
+            if len(f) != len(p):
+                # Changed on the instrument front panel
+                self.scpi.freq_axis.invalidate()
+                f       = self.scpi.freq_axis.get()
 
             return p, f
 
@@ -143,6 +154,10 @@ class LabDemoVsaControl(QMainWindow):
                 ip              = self.h_gui['IP'].get_val()
                 self.vsa        = self.rm.open_resource(f"TCPIP0::{ip}::inst0::INSTR")
                 self.vsa.timeout = 60000
+                # Shadow cache: unchanged settings (e.g. on Load) are not sent again
+                # Errors are read at the sync points (every trace refresh)
+                self.scpi       = SCPIWrapper(instr=self.vsa, log=self.log, name='VSA', error_check='sync', cache=True,
+                                              stats=self.stats)
                 self.log.info(f"Connected to {ip}")
                 # Read the signal generator status and update the GUI (RF On/Off, Modulation On/Off,Pout and Fc)
                 # Query the signal generator name
@@ -156,14 +171,15 @@ class LabDemoVsaControl(QMainWindow):
                 self.vsa_write("*RST")
                 self.vsa_write("*CLS")
                 sleep(.1)
-                # Aligned the spectrum analyzer to the GUI values
-                self.cb_fc()
-                self.cb_rbw()
-                self.cb_span()
-                self.cb_trace()
-                self.cb_detector()
-                # Sweep mode to continuous
-                self.vsa_write(":INITiate:CONTinuous ON")
+                # Aligned the spectrum analyzer to the GUI values (sent as a single message)
+                with self.scpi.transaction():
+                    self.cb_fc()
+                    self.cb_rbw()
+                    self.cb_span()
+                    self.cb_trace()
+                    self.cb_detector()
+                    # Sweep mode to continuous
+                    self.vsa_write(":INITiate:CONTinuous ON")
 
             except Exception:
                 self.log.error("Connection failed")
@@ -287,16 +303,26 @@ class LabDemoVsaControl(QMainWindow):
         if self.vsa is not None:
             if self.sender().isChecked():
                 self.log.info("HiResSnapshot button Checked")
-                self.thread = LongProcess(self.vsa)
+                # Pipelined scan (sweep the next segment while the last one is read), HiResPipeline in the YAML file
+                self.thread = LongProcess(self.scpi, pipelined=self.Params.get('HiResPipeline', False),
+                                          adaptive=self.Params.get('HiResAdaptive', False),
+                                          margin=self.Params.get('HiResMargin', 10.0),
+                                          coarse_rbw=self.Params.get('HiResCoarseRBW') or None,
+                                          store=self.Params.get('HiResStore') or None)
                 self.thread.progress.connect(self.cb_hires_scan)
+                self.thread.segment.connect(self.cb_hi_res_segment)
                 self.thread.data.connect(self.cb_hi_res_plot)
+                self.hires_curve = None
 
                 self.timer.stop()
                 self.thread.start() # Start the thread calling the run method
+                if self.thread.store_path is not None:
+                    self.hires_timer.start(HIRES_PLOT_PERIOD)
             else:
                 self.log.info("HiResSnapshot button Cleared")
                 self.thread.stop()
                 self.thread.wait()
+                self.hires_timer.stop()
                 self.h_gui['HiResProgress'].set_val(0)
                 self.timer.start()
 
@@ -309,7 +335,59 @@ class LabDemoVsaControl(QMainWindow):
                                xlabel='Frequency (MHz)', ylabel='Power dBm',
                                title='PSA', xlog=False, clf=True)
 
+    def timer_hires_store(self):
+        # Decimated view of the segments written so far, of the visible range once the user zooms in
+        view    = self.plot_sa.plot_widget.getViewBox()
+        if self.hires_curve is None or view.autoRangeEnabled()[0]:
+            f_min, f_max = None, None
+        else:
+            f_min, f_max = view.viewRange()[0]
+        with self.thread.store_lock:
+            if self.thread.store is None:
+                return
+            freq, power = self.thread.store.decimated(f_min=f_min, f_max=f_max)
+        if len(freq) == 0:
+            return
+        if self.hires_curve is None:
+            self.hires_curve = self.plot_sa.plot( freq , power ,
+                                                  line='b-' , line_width=4.0,
+                                                  xlabel='Frequency (MHz)', ylabel='Power dBm',
+                                                  title='Hi-Res PSA', xlog=False, clf=True)
+        else:
+            self.hires_curve.setData(freq, power)
+
+    def cb_hi_res_segment(self, offset, freq, power):
+        if self.thread.store_path is not None:
+            # Scan on disk: drawn from the store by timer_hires_store
+            return
+        # Only the segment delivered by the signal is read: its peak bins are copied to the plot buffers
+        n_points    = len(power)
+        i           = offset // n_points
+        if self.hires_curve is None:
+            # Plot buffers sized once for the scan (NaN: segment not swept yet, not drawn)
+            n_segments          = self.thread.power.size // n_points
+            n_bins              = min(n_points, max(1, HIRES_PLOT_POINTS // n_segments))
+            self.hires_edges    = np.linspace(0, n_points, n_bins + 1).astype(int)
+            self.hires_freq     = np.full(n_segments * n_bins, np.nan)
+            self.hires_power    = np.full(n_segments * n_bins, np.nan)
+        n_bins      = len(self.hires_edges) - 1
+        centre      = (self.hires_edges[:-1] + self.hires_edges[1:] - 1) // 2
+        self.hires_freq[i * n_bins:(i + 1) * n_bins]  = freq[centre]
+        self.hires_power[i * n_bins:(i + 1) * n_bins] = np.maximum.reduceat(power, self.hires_edges[:-1])
+        if self.hires_curve is None:
+            self.hires_curve = self.plot_sa.plot( self.hires_freq , self.hires_power ,
+                                                  line='b-' , line_width=4.0,
+                                                  xlabel='Frequency (MHz)', ylabel='Power dBm',
+                                                  title='Hi-Res PSA', xlog=False, clf=True)
+        self.hires_curve.setData(self.hires_freq, self.hires_power, connect='finite')
+
     def cb_hi_res_plot(self, freq, power):
+        # Complete (or partial when stopped) stitched spectrum
+        self.hires_timer.stop()
+        self.hires_data = (freq, power)
+        if self.hires_curve is not None:
+            self.hires_curve.setData(freq, power)
+        else:
             self.plot_sa.plot( freq , power ,
                                line='b-' , line_width=4.0,
                                xlabel='Frequency (MHz)', ylabel='Power dBm',
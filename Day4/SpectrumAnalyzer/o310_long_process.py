@@ -1,17 +1,52 @@
 from PyQt6.QtCore       import QThread, pyqtSignal
 
 import numpy as np
+import logging
+import queue
+import threading
+
+from python_rf_course.utils.SCPI_wrapper import SCPIWrapper
+from python_rf_course.utils.scan_store   import ScanStore
 
 
 class LongProcess(QThread):
     # Define signals as class attributes (for progressbar and returned data)
     progress    = pyqtSignal(int)
     data        = pyqtSignal(np.ndarray, np.ndarray)
+    # Each swept segment: offset in the scan buffers, read-only views of its frequency and power
+    segment     = pyqtSignal(int, np.ndarray, np.ndarray)
 
-    def __init__(self, vsa):
+    def __init__(self, vsa, stats = None, pipelined = False, adaptive = False, margin = 10.0,
+                 coarse_rbw = None, store = None):
         super().__init__()
+        # The SCPI wrapper owns the binary trace reader and the frequency axis of the session
+        if not isinstance(vsa, SCPIWrapper):
+            vsa = SCPIWrapper(instr=vsa, log=logging.getLogger('sa_log'), name='VSA', error_check='manual',
+                              stats=stats)
+        elif stats is not None:
+            # Round trip statistics (SCPIStats) of the scan
+            vsa.stats = stats
         self.vsa = vsa
         self.running = False
+        # Pipelined hi-res scan: the trace of a segment is read and stitched while the next segment sweeps
+        self.pipelined = pipelined
+        # Adaptive hi-res scan: only the segments where the wide sweep is above the noise floor + margin (dB)
+        # are swept at the hi-res RBW, the others are filled with the wide sweep data
+        self.adaptive = adaptive
+        self.margin = margin
+        # RBW (MHz) of a coarse pass for the classification (None - use the 8 MHz wide sweep,
+        # which spreads a strong signal over many segments)
+        self.coarse_rbw = coarse_rbw
+        # Scan buffers (preallocated by run, partial results are kept when the scan is stopped)
+        self.freq = None    # MHz
+        self.power = None   # dBm
+        self.coarse = None  # Per point flag: True - filled from the wide sweep
+        self.filled = 0     # Valid points at the start of the buffers
+        # Path of a scan store file (ScanStore): the power is written to the file (np.memmap) and the
+        # frequency axis is kept per segment, for scans that do not fit in RAM (None - RAM buffers)
+        self.store_path = store
+        self.store = None
+        self.store_lock = threading.Lock()  # Held by the readers of the store (GUI live view) and by close
 
     def run(self):
         # Save the instrument attributes for recall at the end of the scan
@@ -40,10 +75,20 @@ class LongProcess(QThread):
         self.vsa.query("*OPC?")
         # Read the trace data
         # Query the instrument for the trace data
-        trace_data  = self.vsa.query_ascii_values(':TRAC? TRACE1', container=np.array)
+        trace_data  = self.vsa.read_trace(1).copy()
+        wide_freq   = self.vsa.freq_axis.get()
         max_level   = np.ceil( np.max(trace_data)/5 + 1)*5
         # Set the reference level
         self.vsa.write(f"DISP:WIND:TRAC:Y:RLEV {max_level}")
+        wide_rbw    = 8.0
+        if self.adaptive and self.coarse_rbw is not None:
+            # Coarse pass over the same range for the classification
+            wide_rbw    = self.coarse_rbw
+            self.vsa.write(":TRACe1:TYPE WRITe"                         )
+            self.vsa.write(f"sense:BANDwidth:RESolution {wide_rbw} MHz" )
+            self.vsa.write("INITiate:IMMediate"                         )
+            self.vsa.query("*OPC?")
+            trace_data  = self.vsa.read_trace(1).copy()
 
         # Set the hi-res scan attributes
         self.vsa.write(f"sense:BANDwidth:RESolution {rbw} MHz"          )
@@ -53,10 +98,111 @@ class LongProcess(QThread):
         # Set single sweep mode
         self.vsa.write("INITiate:CONTinuous OFF"                        )
 
-        # Create a list to store the scan data
-        all_data = []
-        all_freq = []
-        for i, f in enumerate(Fscan):
+        # Preallocate the scan data (the number of points is known before the first sweep)
+        n_points        = int(float(self.vsa.query(':sens:SWEep:POINts?').strip()))
+        if self.store_path is not None:
+            self.store  = ScanStore.create(self.store_path, len(Fscan), n_points, start=Fscan[0] - span / 2,
+                                           step=span / (n_points - 1), rbw=rbw, span=span)
+            self.power  = self.store.power
+            self.freq   = None
+            self.coarse = None
+            self.vsa.log.info(f"Hi-Res scan: {len(Fscan)} segments x {n_points} points "
+                              f"({self.power.nbytes / 1e6:.1f} MB in {self.store_path})")
+        else:
+            self.power  = np.empty(len(Fscan) * n_points, dtype=np.float32)
+            self.freq   = np.empty(len(Fscan) * n_points, dtype=np.float64)
+            self.coarse = np.zeros(len(Fscan) * n_points, dtype=bool)
+            self.vsa.log.info(f"Hi-Res scan: {len(Fscan)} segments x {n_points} points "
+                              f"({(self.power.nbytes + self.freq.nbytes) / 1e6:.1f} MB)")
+        self.filled     = 0
+        if self.adaptive:
+            segments = self.classify(Fscan, span, wide_freq, trace_data)
+            # All the segments start with the wide sweep data, the noise level scaled to the hi-res RBW
+            # (an estimate), the occupied ones are then replaced by their hi-res sweeps
+            offsets = np.linspace(-span / 2, span / 2, n_points)
+            for i, fc_i in enumerate(Fscan):
+                self.set_axis(i, n_points, fc_i + offsets)
+                self.power[i * n_points:(i + 1) * n_points] = (np.interp(fc_i + offsets, wide_freq, trace_data)
+                                                               + 10 * np.log10(rbw / wide_rbw))
+                if self.store is not None:
+                    self.store.commit(i, coarse=True)
+            if self.coarse is not None:
+                self.coarse[:] = True
+            self.filled     = len(self.power)
+        else:
+            segments = range(len(Fscan))
+
+        if self.pipelined:
+            self.scan_pipelined(Fscan, segments, n_points)
+        else:
+            self.scan(Fscan, segments, n_points)
+
+        # Recall the instrument settings
+        self.vsa.write("*RCL 1")
+        # Set continuous sweep mode
+        self.vsa.write("INITiate:CONTinuous ON")
+        if not self.running:
+            self.vsa.log.info(f"Hi-Res scan stopped: {self.filled} points kept")
+        if self.store is not None:
+            if self.filled:
+                # The stitched spectrum stays in the file, the data signal has a decimated (peak) view (a copy)
+                self.data.emit(*self.store.decimated())
+            with self.store_lock:
+                self.store.close()
+                self.store = None
+        elif self.filled:
+            # Emit the data signal (read-only views of the buffers, no copy), a stopped scan emits the part it got
+            for a in (self.freq, self.power, self.coarse):
+                a.flags.writeable = False
+            self.data.emit(self.freq[:self.filled], self.power[:self.filled])
+
+    def classify(self, Fscan, span, wide_freq, wide_power) -> list:
+        """
+        Occupied segments: a point of the wide (max hold) sweep within the segment, or one wide bin around it,
+        is above the noise floor (median of the sweep) + margin.
+        :return: Indices of the occupied segments
+        """
+        level   = np.median(wide_power) + self.margin
+        step    = wide_freq[1] - wide_freq[0] if len(wide_freq) > 1 else 0.0
+        lo      = np.searchsorted(wide_freq, Fscan - span / 2 - step)
+        hi      = np.searchsorted(wide_freq, Fscan + span / 2 + step, side='right')
+        above   = np.concatenate(([0], np.cumsum(wide_power > level)))
+        segments = np.flatnonzero(above[hi] > above[lo]).tolist()
+        self.vsa.log.info(f"Adaptive Hi-Res scan: {len(segments)} of {len(Fscan)} segments above "
+                          f"{level:.1f} dBm")
+        return segments
+
+    def set_axis(self, i: int, n_points: int, freq):
+        # Frequency points of segment i
+        if self.store is not None:
+            self.store.set_axis(i, freq[0], (freq[-1] - freq[0]) / (n_points - 1))
+        else:
+            self.freq[i * n_points:(i + 1) * n_points] = freq
+
+    def segment_done(self, k: int, i: int, n_points: int, n_segments: int):
+        # Segment i (k-th of the scan) is in the buffers
+        start   = i * n_points
+        end     = start + n_points
+        if self.store is not None:
+            self.store.commit(i)
+            freq = self.store.segment_freq(i)
+        else:
+            self.coarse[start:end] = False
+            freq = self.freq[start:end]
+        self.filled = max(self.filled, end)
+        power   = self.power[start:end]
+        freq.flags.writeable    = False
+        power.flags.writeable   = False
+        self.segment.emit(start, freq, power)
+        # Update the progress bar
+        self.progress.emit(100 * (k + 1) // n_segments)
+
+    def scan(self, Fscan, segments, n_points) -> int:
+        # Sweep, wait and read each segment in turn
+        # :return: Number of segments swept
+        swept = 0
+        for k, i in enumerate(segments):
+            f = Fscan[i]
             # Set the center frequency
             self.vsa.write(f"sense:FREQuency:CENTer {f} MHz")
             # Initiate a single sweep
@@ -65,33 +211,73 @@ class LongProcess(QThread):
             # time_start = time.perf_counter()
             self.vsa.query("*OPC?")
             # print(f"Sweep {i+1} completed in {time.perf_counter() - time_start:.2f} seconds")
-            # Query the instrument for the trace data
-            trace_data = self.vsa.query_ascii_values(':TRAC? TRACE1', container=np.array)
-
-            # Get the current frequency settings
-            start_freq  = float(self.vsa.query(':SENS:FREQ:START?'))
-            stop_freq   = float(self.vsa.query(':SENS:FREQ:STOP?' ))
-            num_points  =   int(self.vsa.query(':SENS:SWE:POIN?'  ))
-
-            # Calculate frequency points
-            f           = np.linspace(start_freq*1e-6, stop_freq*1e-6, num_points)
-
-            # Append the data to the list (in a flattened format)
-            all_data = np.concatenate([all_data, trace_data  ])
-            all_freq = np.concatenate([all_freq, f           ])
-            # Update the progress bar
-            self.progress.emit(100 * (i + 1) // len(Fscan))
+            # Read the trace data directly into its segment of the buffer
+            start       = i * n_points
+            end         = start + n_points
+            self.vsa.read_trace(1, out=self.power[start:end])
+
+            # Frequency points (moved with the center frequency, no queries)
+            self.set_axis(i, n_points, self.vsa.freq_axis.get())
+
+            swept       = k + 1
+            self.segment_done(k, i, n_points, len(segments))
             if not self.running:
                 break
+        return swept
 
-        # Recall the instrument settings
-        self.vsa.write("*RCL 1")
-        # Set continuous sweep mode
-        self.vsa.write("INITiate:CONTinuous ON")
-        if self.running:
-            # Emit the data signal
-            self.data.emit(all_freq , all_data)
+    def scan_pipelined(self, Fscan, segments, n_points) -> int:
+        """
+        Overlapped scan: when a sweep completes its trace is copied to TRACE2, the next segment is tuned
+        and started in the same message, and TRACE2 is read while the analyzer sweeps.
+        Stitching and progress run on a worker thread. Two segment buffers are recycled between the threads.
+        :return: Number of segments swept
+        """
+        # Trace 2 holds the copy (not updated by the sweeps)
+        self.vsa.write(":TRACe2:TYPE VIEW")
+        # Span and points do not change during the scan: the axis is read once and moved by each new center
+        self.vsa.freq_axis.get()
+        free    = queue.Queue()
+        ready   = queue.Queue()
+        for _ in range(2):
+            free.put(np.empty(n_points, dtype=np.float32))
+        done    = [0]   # Segments stitched by the worker
+
+        def stitch():
+            while (item := ready.get()) is not None:
+                k, i, segment, freq = item
+                start   = i * n_points
+                self.power[start:start + n_points] = segment
+                self.set_axis(i, n_points, freq)
+                done[0] = k + 1
+                free.put(segment)
+                self.segment_done(k, i, n_points, len(segments))
 
+        worker = threading.Thread(target=stitch, name="Hi-Res stitch", daemon=True)
+        worker.start()
+        try:
+            if len(segments):
+                self.vsa.write(f"sense:FREQuency:CENTer {Fscan[segments[0]]} MHz")
+                self.vsa.write("INITiate:IMMediate")
+            for k, i in enumerate(segments):
+                # Wait for the sweep of segment i
+                self.vsa.query("*OPC?")
+                # Frequency points of segment i (before the next center frequency is sent, no query)
+                freq    = self.vsa.freq_axis.get()
+                with self.vsa.transaction():
+                    self.vsa.write(":TRACe:COPY TRACE1,TRACE2")
+                    if k + 1 < len(segments) and self.running:
+                        self.vsa.write(f"sense:FREQuency:CENTer {Fscan[segments[k + 1]]} MHz")
+                        self.vsa.write("INITiate:IMMediate")
+                # Read segment i while segment i+1 sweeps
+                segment = free.get()
+                self.vsa.read_trace(2, out=segment)
+                ready.put((k, i, segment, freq))
+                if not self.running:
+                    break
+        finally:
+            ready.put(None)
+            worker.join()
+        return done[0]
 
     def stop(self):
         self.running = False
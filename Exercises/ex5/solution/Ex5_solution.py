@@ -86,8 +86,8 @@ class LabNetworkControl(QMainWindow):
                 self.sg        = self.rm.open_resource(f"TCPIP0::{ip_sg}::inst0::INSTR")
                 self.sa.timeout = 5000
                 self.sg.timeout = 5000
-                self.scpi_sa    = SCPIWrapper(instr=self.sa, log= self.log, name='SA')
-                self.scpi_sg    = SCPIWrapper(instr=self.sg, log= self.log, name='SG')
+                self.scpi_sa    = SCPIWrapper(instr=self.sa, log= self.log, name='SA', error_check='sync', cache=True)
+                self.scpi_sg    = SCPIWrapper(instr=self.sg, log= self.log, name='SG', error_check='sync', cache=True)
 
                 self.log.info(f"Connected to {ip_sa=} and {ip_sg=}")
                 # Read the signal generator status and update the GUI (RF On/Off, Modulation On/Off,Pout and Fc)
@@ -102,6 +102,9 @@ class LabNetworkControl(QMainWindow):
                 self.scpi_sa.write("*CLS")
                 self.scpi_sg.write("*RST")
                 self.scpi_sg.write("*CLS")
+                # Drain the error queues of the setup sequence
+                self.scpi_sa.check_errors()
+                self.scpi_sg.check_errors()
             except Exception:
                 self.log.error("Connection failed")
                 if self.sa is not None:
@@ -154,7 +157,7 @@ class LabNetworkControl(QMainWindow):
     # thread callback functions
     def tcb_plot(self, freq, power):
         freq_v  = self.f_scan
-        power_v = np.concatenate((power, np.ones(len(freq_v)-len(power))*-100)) - self.Params['Pout']
+        power_v = np.concatenate((power, np.full(len(freq_v)-len(power), np.nan))) - self.Params['Pout']
         self.plot_sa.plot( freq_v , power_v,
                            line='b-' , line_width=1.5,
                            xlabel='Frequency (MHz)', ylabel='Power dBm',
@@ -173,7 +176,9 @@ class LabNetworkControl(QMainWindow):
             self.freq = np.array([])
             self.power = np.array([])
             # Create the thread object
-            self.thread = LongProcess(f_scan=self.f_scan, scpi_sa=self.scpi_sa,scpi_sg=self.scpi_sg) # Create the thread object
+            self.thread = LongProcess(f_scan=self.f_scan, scpi_sa=self.scpi_sa,scpi_sg=self.scpi_sg,
+                                      mode=self.Params.get('ScanMode', 'point'),
+                                      rbw=self.Params.get('ListRBW', 1.0)) # Create the thread object
             self.thread.progress.connect(self.tcb_progress)
             self.thread.data.connect(self.tcb_plot)
             self.thread.log.connect(        self.log.info      )
@@ -3,7 +3,7 @@ import re
 import  yaml
 from    PyQt6.QtWidgets    import QApplication, QMainWindow, QVBoxLayout
 from    PyQt6.uic          import loadUi
-from    PyQt6.QtCore       import QTimer
+from    PyQt6.QtCore       import QTimer, Qt, pyqtSignal
 
 import numpy as np
 
@@ -11,8 +11,12 @@ from python_rf_course.utils.pyqt2python     import h_gui
 from python_rf_course.utils.plot_widget     import PlotWidget
 from python_rf_course.utils.logging_widget  import setup_logger
 from python_rf_course.utils.SCPI_wrapper    import *
-from python_rf_course.utils.multitone       import multitone
+from python_rf_course.utils.scpi_stats      import SCPIStats
+from python_rf_course.utils.stats_widget    import StatsDock
+from python_rf_course.utils.instrument_actor import InstrumentActor, HIGH, LOW
+from python_rf_course.utils.scan_journal    import ScanJournal
 
+from python_rf_course.utils.pa_scan         import POINT_DTYPE, load_two_tone, setup_pa_bench
 from pa_app_thread import PaScan
 
 import pyvisa
@@ -22,6 +26,13 @@ import pyarbtools as arb
 import logging
 import time
 
+# Scan plot and LCD refresh period (ms): the points are buffered and drawn at most at this rate
+SCAN_REDRAW_MS  = 100
+# Scan series plotted: POINT_DTYPE field, legend, color
+SCAN_SERIES     = (('gain', 'Gain', 'k'), ('op1db', 'OP1dB', 'b'), ('oip3', 'OIP3', 'g'), ('oip5', 'OIP5', 'r'))
+# LCD widget: POINT_DTYPE field (ScanPout follows the OP1dB search, lcd_p_out)
+SCAN_LCDS       = dict(ScanG='gain', ScanOP1dB='op1db', ScanOIP3='oip3', ScanOIP5='oip5')
+
 def is_valid_ip(ip:str) -> bool:
     # Regular expression pattern for matching IP address
     ip_pattern = r'^((25[0-5]|2[0-4][0-9]|[01]?[0-9][0-9]?)\.){3}(25[0-5]|2[0-4][0-9]|[01]?[0-9][0-9]?)$'
@@ -30,6 +41,9 @@ def is_valid_ip(ip:str) -> bool:
 
 # The GUI controller clas inherit from QMainWindow object as defined in the ui file
 class PA_App(QMainWindow):
+    # Trace and frequency axis read by the SA I/O thread (delivered to the GUI thread)
+    trace_ready = pyqtSignal(object, object)
+
     def __init__(self):
         super().__init__()
         # Load the UI file into the Class (LabDemoVsaControl) object
@@ -68,6 +82,10 @@ class PA_App(QMainWindow):
         self.sa         = None
         self.sg         = None
         self.arb        = None
+        # One I/O thread per instrument, shared by the GUI (live view, Ptx) and the scan thread
+        self.sa_actor   = None
+        self.sg_actor   = None
+        self.trace_job  = None
 
         # Load the configuration/default values from the YAML file
         self.Params     = None
@@ -81,23 +99,41 @@ class PA_App(QMainWindow):
             self.log.warning("No last.yaml file found")
 
         self.h_gui['Save'].emit() #  self.cb_save
+
+        # SCPI round trip statistics (opt-in, Stats in the YAML file)
+        self.stats      = SCPIStats() if self.Params.get('Stats', False) else None
+        if self.stats is not None:
+            self.addDockWidget(Qt.DockWidgetArea.RightDockWidgetArea, StatsDock(self.stats, self))
         self.h_gui['Ptx'].set_val(self.h_gui['Ptx'].get_val()) #  Update the signal (event)
 
-        # Create a widget for the Spectrum Analyzer plot
+        # Create a widget for the Spectrum Analyzer plot (live view, also during a scan)
         self.plot_sa        = PlotWidget()
+        # and one for the scan results
+        self.plot_scan      = PlotWidget()
         layout              = QVBoxLayout(self.widget)
         layout.addWidget(self.plot_sa)
-        # Change the background color of the plot to white
+        layout.addWidget(self.plot_scan)
+        # Change the background color of the plots to white
         self.plot_sa.set_background_color('w')
+        self.plot_scan.set_background_color('w')
 
         # Iinitilize the freq and power arrays to empty
         self.f_scan = np.array([])
         self.Fspan  = None
         self.thread = None
+        # Scan series (preallocated at the scan start), curves and the LCD values waiting for the redraw
+        self.scan_data      = np.full(0, np.nan, dtype=POINT_DTYPE)
+        self.scan_n         = 0
+        self.scan_dirty     = False
+        self.scan_curves    = {}
+        self.lcd_pending    = {}
+        self.scan_timer     = QTimer()
+        self.scan_timer.timeout.connect(self.cb_scan_redraw)
 
         # Create a timer for the Spectrum Analyzer plot
         self.timer          = QTimer()
         self.timer.timeout.connect(self.cb_timer_trace)
+        self.trace_ready.connect(self.plot_trace)
         self.timer.start(250)
 
 
@@ -115,8 +151,13 @@ class PA_App(QMainWindow):
                 self.arb       = arb.instruments.VSG(ip_sg, timeout=5)
                 self.sa.timeout = 5000
                 self.sg.timeout = 5000
-                self.scpi_sa    = SCPIWrapper(instr=self.sa, log= self.log, name='SA')
-                self.scpi_sg    = SCPIWrapper(instr=self.sg, log= self.log, name='SG')
+                # The wrappers do their I/O on the instrument threads (blocking calls from any thread)
+                self.sa_actor   = InstrumentActor(self.sa, name='SA', log=self.log)
+                self.sg_actor   = InstrumentActor(self.sg, name='SG', log=self.log)
+                self.scpi_sa    = SCPIWrapper(instr=self.sa_actor.resource(), log= self.log, name='SA',
+                                              error_check='sync', cache=True, stats=self.stats)
+                self.scpi_sg    = SCPIWrapper(instr=self.sg_actor.resource(), log= self.log, name='SG',
+                                              error_check='sync', cache=True, stats=self.stats)
 
                 self.log.info(f"Connected to {ip_sa=} and {ip_sg=}")
 
@@ -132,55 +173,47 @@ class PA_App(QMainWindow):
                 self.scpi_sg.write("*RST")
                 self.scpi_sg.write("*CLS")
                 # Load the arb with a two tone signal
-                sig = multitone(BW=self.Params['ArbFd'], Ntones=2,
-                                Fs=self.Params['ArbFs'], Nfft=2048)
-
-                self.arb.configure(fs=self.Params['ArbFs']*1e6, iqScale=70 )
-                self.arb.download_wfm(sig, wfmID='TwoTones')
-                self.arb.set_alcState(0) # ALC Off (DO not use bool)
-                self.arb.play('TwoTones')
-                # Set the signal generator to output power
-                self.scpi_sg.write(f":POW:LEV {self.h_gui["Ptx"].get_val()} dBm")
-                # Set the spectrum analyzer span and RBW detector AVG and trace to clear/write
-                self.Fspan = self.Params['ArbFd']*5.0 + 2.0 # Contains the 5th harmonic
-                self.scpi_sa.write(f"freq:span {self.Fspan} MHz")
-                self.scpi_sa.write(f"sense:BANDwidth:RESolution {self.Params['ArbFd']/8.0} MHz") # Maximal RBW for the scan
-                self.scpi_sa.write("sense:DETEctor AVERage")
-                self.scpi_sa.write("TRACe:MODE WRITe")
-                self.scpi_sa.write("INITiate:CONTinuous On")
-                # Set the spectrum analyzer center frequency and the signal generator frequency
-                self.scpi_sa.write(f"freq:cent {self.Params['Fnominal']} MHz")
-                self.scpi_sg.write(f"freq {     self.Params['Fnominal']} MHz")
-                # Save the signal generator and spectrum analyzer state
-                self.scpi_sa.write("*SAV 1")
-                self.scpi_sg.write("*SAV 1")
+                load_two_tone(self.arb, self.Params)
+                # SA span, RBW and detector, SG power and frequency (shared with the command line runner)
+                self.Fspan = setup_pa_bench(self.scpi_sa, self.scpi_sg, self.Params, self.h_gui["Ptx"].get_val())
+                # Drain the error queues of the setup sequence
+                self.scpi_sa.check_errors()
+                self.scpi_sg.check_errors()
                 time.sleep(0.01)
             except Exception:
                 self.log.error("Connection failed")
-                if self.sa is not None:
-                    self.sa.close()
-                    self.sa = None
-                if self.sg is not None:
-                    self.sg.close()
-                    self.sg = None
+                self.close_instruments()
                 # Clear Button state
                 self.h_gui['Connect'].set_val(False, is_callback=True)
         else:
             self.log.info("Connect button Cleared")
             # Close the connection to the signal generator
-            if self.sa is not None:
-                self.sa.close()
-                self.sa = None
-            if self.sg is not None:
-                self.sg.close()
-                self.sg = None
-                
+            self.close_instruments()
             self.scpi = None
 
+    def close_instruments(self):
+        # Stop the I/O threads (queued requests are served first) and close the sessions
+        for actor in (self.sa_actor, self.sg_actor):
+            if actor is not None:
+                actor.stop()
+        self.sa_actor   = None
+        self.sg_actor   = None
+        self.trace_job  = None
+        if self.sa is not None:
+            self.sa.close()
+            self.sa = None
+        if self.sg is not None:
+            self.sg.close()
+            self.sg = None
+
     def cb_ptx(self):
         ptx = self.h_gui['Ptx'].get_val()
-        if self.sg is not None:
-            self.scpi_sg.write(f":POW:LEV {ptx} dBm")
+        if self.thread is not None and self.thread.isRunning():
+            # The scan steps use the SG wrapper from the SA I/O thread (and the scan power is read at its start)
+            self.log.info(f"Ptx {ptx} dBm is set at the end of the scan")
+        elif self.sg is not None:
+            # Queued ahead of the live view requests, the GUI does not wait for the instrument
+            self.sg_actor.submit(self.scpi_sg.write, f":POW:LEV {ptx} dBm", priority=HIGH)
 
 
     # Callback function for the IP lineEdit
@@ -207,51 +240,99 @@ class PA_App(QMainWindow):
         self.log.info(f"SG IP = {ip}")
 
     def sa_read_trace(self):
-        if self.sa is not None:
-            # Query trace data PyVISA method for reading numerical data from instruments
-            p           = self.sa.query_ascii_values(":TRACe:DATA? TRACE1", container=np.array)
-            # Calculate frequency points
-            f           = np.linspace(self.Params['Fnominal'] - self.Fspan/2, self.Params['Fnominal'] + self.Fspan/2, len(p))
+        # Runs on the SA I/O thread
+        # Read the trace as a binary block into a float32 buffer (ASCII fallback)
+        # The buffer of the wrapper is reused by the next read, the GUI gets a copy
+        p           = self.scpi_sa.read_trace(1).copy()
+        # Frequency points (rebuilt only when the SA frequency settings change)
+        f           = self.scpi_sa.freq_axis.get()
 
-            return p, f
+        return p, f
 
     def cb_timer_trace(self):
-        if self.sa is not None:
-            # Get the trace from the spectrum analyzer
-            trace, freq = self.sa_read_trace()
-            # Check if checkbox of freeze Y axis is checked
-            if self.h_gui['FreezeYAxis'].get_val():
-                # Get the Y axis current limits
-                y_min, y_max = self.plot_sa.get_y_range()
-                # Round to the nearest 10 dB
-                y_min = np.ceil( y_min/10.0)*10.0
-                y_max = np.floor(y_max/10.0)*10.0
-            else:
-                # Set the Y axis limits to the trace
-                y_min = None
-                y_max = None
+        if self.sa_actor is not None:
+            # A poll that is still queued is not repeated (slow sweeps do not pile up requests)
+            job = self.sa_actor.submit_latest('trace', self.sa_read_trace, priority=LOW)
+            if job is not self.trace_job:
+                self.trace_job = job
+                job.add_done_callback(self.trace_done)
+
+    def trace_done(self, job):
+        # Runs on the SA I/O thread, the signal queues the plot to the GUI thread
+        if job.cancelled():
+            return
+        if job.exception() is not None:
+            self.log.error(f"SA trace read failed: {job.exception()}")
+            return
+        self.trace_ready.emit(*job.result())
+
+    def plot_trace(self, trace, freq):
+        # The live view polls run between the scan steps (one SA actor job each), so it keeps running during a scan
+        # Check if checkbox of freeze Y axis is checked
+        if self.h_gui['FreezeYAxis'].get_val():
+            # Get the Y axis current limits
+            y_min, y_max = self.plot_sa.get_y_range()
+            # Round to the nearest 10 dB
+            y_min = np.ceil( y_min/10.0)*10.0
+            y_max = np.floor(y_max/10.0)*10.0
+        else:
+            # Set the Y axis limits to the trace
+            y_min = None
+            y_max = None
 
 
-            # Plot the trace
-            self.plot_sa.plot(freq, trace, line='b-', line_width=3.0,
-                              y_lim_min=y_min       , y_lim_max=y_max,
-                              xlabel='Frequency (MHz)', ylabel='Power dBm',
-                              title='Spectrum Analyzer', xlog=False, clf=True)
+        # Plot the trace
+        self.plot_sa.plot(freq, trace, line='b-', line_width=3.0,
+                          y_lim_min=y_min       , y_lim_max=y_max,
+                          xlabel='Frequency (MHz)', ylabel='Power dBm',
+                          title='Spectrum Analyzer', xlog=False, clf=True)
 
     # thread callback functions
     def tcb_progress(self, i):
         self.h_gui['TestPaProgress'].set_val(i)
 
     # thread callback functions
-    def tcb_plot(self, freq, power, clf= True,legend='Gain',color='b-'):
-        freq_v  = self.f_scan
-        power_v = np.concatenate((power, np.ones(len(freq_v)-len(power))*power[0]))
-        self.plot_sa.plot( freq_v , power_v,
-                           line=color , line_width=6.0,
-                           xlabel='Frequency (MHz)', ylabel='Power dBm',
-                           title='Filter response', xlog=False, clf=clf, legend=legend)
-
-    def tcb_dump_csv(self, freq, gain, op1dB, oip3, oip5):
+    def tcb_point(self, i, row):
+        # Append the new row, the plot and the LCDs are updated by the redraw timer
+        self.scan_data[i]   = row
+        self.scan_n         = max(self.scan_n, i + 1)
+        self.scan_dirty     = True
+        for key, name in SCAN_LCDS.items():
+            self.lcd_pending[key] = float(row[name])
+
+    def tcb_p_out(self, p_out):
+        self.lcd_pending['ScanPout'] = p_out
+
+    def cb_scan_redraw(self):
+        # Runs at most every SCAN_REDRAW_MS: coalesced LCD values and the new points of the series
+        for key, value in self.lcd_pending.items():
+            self.h_gui[key].set_val(value)
+        self.lcd_pending.clear()
+        if not self.scan_dirty:
+            return
+        self.scan_dirty = False
+        done    = self.scan_data[:self.scan_n]
+        for i, (name, legend, color) in enumerate(SCAN_SERIES):
+            curve = self.scan_curves.get(name)
+            if curve is None:
+                self.scan_curves[name] = self.plot_scan.plot(done['freq'], done[name],
+                                                           line=color , line_width=6.0,
+                                                           xlabel='Frequency (MHz)', ylabel='Power dBm',
+                                                           title='PA scan', xlog=False, clf=i == 0,
+                                                           legend=legend)
+                if i == 0 and len(self.f_scan) > 1:
+                    # The axis spans the whole scan from the first point
+                    self.plot_scan.set_x_range(self.f_scan[0], self.f_scan[-1])
+            else:
+                curve.setData(done['freq'], done[name])
+        self.tcb_progress(100 * self.scan_n // len(self.f_scan))
+
+    def tcb_finished(self):
+        # Draw the last points
+        self.scan_timer.stop()
+        self.cb_scan_redraw()
+
+    def tcb_dump_csv(self, freq, gain, op1dB, oip3, oip5, oip_sides):
         # Create a CSV file name with date and time
         # Get the current date and time
         current_time = time.strftime("%Y%m%d_%H%M%S")
@@ -260,35 +341,58 @@ class PA_App(QMainWindow):
         csv_file = f"PA_Scan_{current_time}.csv"
         # Save the data to a CSV file
         with open(csv_file, "w") as f:
-            f.write("Frequency (MHz), Gain (dB), OP1dB (dBm), OIP3 (dBm), OIP5 (dBm)\n")
+            f.write("Frequency (MHz), Gain (dB), OP1dB (dBm), OIP3 (dBm), OIP5 (dBm), "
+                    "OIP3 lower (dBm), OIP3 upper (dBm), OIP5 lower (dBm), OIP5 upper (dBm)\n")
             for i in range(len(freq)):
-                f.write(f"{freq[i]},{gain[i]},{op1dB[i]},{oip3[i]},{oip5[i]}\n")
+                f.write(f"{freq[i]},{gain[i]},{op1dB[i]},{oip3[i]},{oip5[i]},{','.join(map(str, oip_sides[i]))}\n")
         self.log.info(f"Data saved to {csv_file}")
 
 
     def cb_testpa(self):
         if self.sender().isChecked():
             if self.sa is not None:
-                self.timer.stop()
                 self.log.info("Initialize scan params")
                 self.f_scan = np.linspace(self.h_gui['Fstart' ].get_val(),
                                           self.h_gui['Fstop'  ].get_val(),
                                           self.h_gui['Npoints'].get_val())
 
 
+                # Journal of the completed points: a new one, or the journal of a stopped scan to resume
+                journal = None
+                resume  = self.Params.get('Resume', '')
+                if self.Params.get('Journal', False) or resume:
+                    path    = resume if resume else f"PA_Scan_{time.strftime('%Y%m%d_%H%M%S')}.journal"
+                    try:
+                        journal = ScanJournal(path, sync=self.Params.get('JournalSync', 'flush'), resume=bool(resume))
+                    except (OSError, ValueError) as e:
+                        self.log.error(f"Scan journal: {e}")
+                        self.h_gui['TestPa'].set_val(False)
+                        return
+                    self.log.info(f"Scan journal: {path}" + (f", {len(journal.completed)} points done" if resume else ""))
+
                 # Create the thread object
-                self.thread = PaScan(f_scan=self.f_scan, scpi_sa=self.scpi_sa,scpi_sg=self.scpi_sg, loss= self.Params['Loss']) # Create the thread object
-                self.thread.progress.connect(self.tcb_progress  )
-                self.thread.data    .connect(self.tcb_plot      )
+                self.thread = PaScan(f_scan=self.f_scan, scpi_sa=self.scpi_sa,scpi_sg=self.scpi_sg, loss= self.Params['Loss'],
+                                     op1db_method=self.Params.get('OP1dBMethod', 'model'),
+                                     warm_start=self.Params.get('WarmStart', False),
+                                     imd_method=self.Params.get('IMDMethod', 'trace'),
+                                     imd_side=self.Params.get('IMDSide', 'worst'),
+                                     journal=journal, settings=dict(self.Params),
+                                     # Each scan step is a job of the SA I/O thread, the live view polls run between them
+                                     step=self.sa_actor.call) # Create the thread object
+                self.thread.point   .connect(self.tcb_point     )
                 self.thread.log     .connect(self.log.info      )
                 self.thread.csv     .connect(self.tcb_dump_csv  )
-                # Connect to LCD real time display
-                self.thread.lcd_g    .connect(self.h_gui['ScanG'     ].set_val)
-                self.thread.lcd_op1dB.connect(self.h_gui['ScanOP1dB' ].set_val)
-                self.thread.lcd_oip3 .connect(self.h_gui['ScanOIP3'  ].set_val)
-                self.thread.lcd_oip5 .connect(self.h_gui['ScanOIP5'  ].set_val)
-                self.thread.lcd_p_out .connect(self.h_gui['ScanPout' ].set_val)
-
+                self.thread.finished.connect(self.tcb_finished  )
+                # LCD real time display (coalesced, shown by the redraw timer)
+                self.thread.lcd_p_out.connect(self.tcb_p_out    )
+
+                # Preallocated series, the curves are created at the first redraw
+                self.scan_data      = np.full(len(self.f_scan), np.nan, dtype=POINT_DTYPE)
+                self.scan_n         = 0
+                self.scan_dirty     = False
+                self.scan_curves    = {}
+                self.lcd_pending    = {}
+                self.scan_timer.start(SCAN_REDRAW_MS)
                 self.thread.start() # Start the thread calling the run method
         else:
             self.log.info("Stop the thread")
@@ -296,10 +400,12 @@ class PA_App(QMainWindow):
                 self.thread.stop()
                 self.thread.wait()
                 self.thread = None
-                # Recall signal generator and spectrum analyzer state
-                self.scpi_sa.write("*RCL 1")
-                self.scpi_sg.write("*RCL 1")
-                self.timer.start()
+                self.tcb_finished()
+                # Recall signal generator and spectrum analyzer state (on the I/O threads, after the queued polls)
+                self.sa_actor.submit(self.scpi_sa.write, "*RCL 1", priority=HIGH)
+                self.sg_actor.submit(self.scpi_sg.write, "*RCL 1", priority=HIGH)
+                # The power set during the scan
+                self.cb_ptx()
 
 
     def cb_save(self):
@@ -353,12 +459,10 @@ class PA_App(QMainWindow):
     def closeEvent(self, event):
         self.log.info("Exiting the application")
         self.timer.stop()
+        self.scan_timer.stop()
         # Clean up the resources
         # Close the connection to the signal generator
-        if self.sa is not None:
-            self.sa.close()
-        if self.sg is not None:
-            self.sg.close()
+        self.close_instruments()
         # Close the Resource Manager
         self.rm.close()
 
@@ -1,32 +1,313 @@
 import logging
 import sys
+import threading
+import time
 import pyvisa
 import pyvisa_py
 
+from python_rf_course.utils.trace_reader import TraceReader
+from python_rf_course.utils.scpi_cache   import StateCache
+from python_rf_course.utils.freq_axis    import FrequencyAxis
+
+# Error check policies
+# 'command' - Query SYST:ERR? after every write/query (one extra round trip per command)
+# 'sync'    - Drain the error queue only at sync points (*OPC?, trace fetch) or on check_errors()
+# 'manual'  - Drain the error queue only when check_errors() is called
+ERROR_CHECK_POLICIES = ('command', 'sync', 'manual')
+
+# Commands that reset/recall the instrument state (including the trace data format)
+RESET_HEADERS = ('*RST', '*RCL', 'SYST:PRES', 'SYSTEM:PRESET')
+
+def scpi_header(cmd: str) -> str:
+    # The header is the command without its arguments (upper case, no leading colon)
+    cmd = cmd.strip()
+    if not cmd:
+        return ''
+    return cmd.split(None, 1)[0].upper().lstrip(':')
+
+def is_sync_point(cmd: str) -> bool:
+    # Sync points: operation complete query and trace data fetch (:TRAC? TRACE1, :TRACe:DATA? TRACE1)
+    header = scpi_header(cmd)
+    return header == '*OPC?' or (header.startswith('TRAC') and header.endswith('?'))
+
+def is_query(cmd: str) -> bool:
+    return scpi_header(cmd).endswith('?')
+
+def rooted(cmd: str) -> str:
+    # In a compound (semicolon joined) message a header is relative to the previous one
+    # unless it starts with a colon. Common commands (*OPC?, *RST) are not part of the tree.
+    cmd = cmd.strip()
+    if cmd.startswith((':', '*')):
+        return cmd
+    return ':' + cmd
+
+
+class SCPITransaction:
+    """
+    Collect commands and send them as semicolon joined messages when the context exits.
+    Use SCPIWrapper.transaction() to create it:
+
+        with scpi.transaction() as t:
+            t.write("sense:FREQuency:CENTer 1000 MHz")
+            t.write("INITiate:IMMediate")
+            t.query("*OPC?")
+            t.query("CALCulate:MARKer:Y?")
+        opc, peak = t.answers
+    """
+    def __init__(self, scpi):
+        self.scpi       = scpi
+        self.commands   = []
+        self.answers    = []
+
+    def write(self, cmd: str):
+        self.commands.append(cmd)
+
+    def query(self, cmd: str):
+        # The answer is available in self.answers (in order) after the transaction is sent
+        self.commands.append(cmd)
+
+    def send(self):
+        commands        = self.commands
+        self.commands   = []
+        if commands:
+            self.answers += self.scpi._send_batch(commands)
+        return self.answers
+
+    def __enter__(self):
+        self.scpi._local.transaction = self
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.scpi._local.transaction = None
+        # Do not send a partially built transaction
+        if exc_type is None:
+            self.send()
+        return False
+
+
 class SCPIWrapper:
-    def __init__(self, instr , log, name = 'SA'):
+    def __init__(self, instr , log, name = 'SA', error_check = 'command', max_errors = 32, max_message_len = 1024,
+                 cache = False, stats = None):
+        if error_check not in ERROR_CHECK_POLICIES:
+            raise ValueError(f"Error: Unknown error check policy {error_check}")
         self.instr      = instr
         self.log        = log
         self.name       = name
+        self.error_check= error_check
+        self.max_errors = max_errors # Guard for the error queue drain loop
+        self.pending    = []         # Commands sent since the last error check
+        self.errors     = []         # History of (command, code, message)
+        self.max_message_len = max_message_len # Instrument input buffer limit for a single message
+        self._local     = threading.local()    # Open transaction (per thread)
+        self.trace_reader = None               # Binary trace reader (created on first read_trace)
+        # Host side shadow of the instrument settings: skip writes of the current value and
+        # answer setting queries without a round trip (see scpi_cache)
+        self.cache      = StateCache() if cache else None
+        self._freq_axis = None                 # Trace frequency axis (created on first use)
+        self.stats      = stats                # Optional SCPIStats (round trip time per header)
+
+    def transaction(self) -> SCPITransaction:
+        # While the transaction is open, write() of the same thread is collected into it
+        return SCPITransaction(self)
+
+    @property
+    def freq_axis(self) -> FrequencyAxis:
+        # Frequency axis of the analyzer session, kept in line with the commands sent through the wrapper
+        if self._freq_axis is None:
+            self._freq_axis = FrequencyAxis(self)
+        return self._freq_axis
 
+    def _io(self, fn, cmd: str):
+        # Instrument call, timed when the statistics are enabled
+        if self.stats is None:
+            return fn(cmd)
+        t   = time.perf_counter()
+        ans = fn(cmd)
+        self.stats.record(cmd, time.perf_counter() - t, ans)
+        return ans
+
+    def _open_transaction(self):
+        return getattr(self._local, 'transaction', None)
 
     def write(self, cmd: str):
+        t = self._open_transaction()
+        if t is not None:
+            t.write(cmd)
+            return
         if self.instr is not None:
+            if self.cache is not None and self.cache.is_current(cmd):
+                self.log.debug(f"{self.name}: Write (cached): {cmd}")
+                return
             # Add logging to the write command (Debug Level)
             self.log.debug(f"{self.name}: Write: {cmd}")
-            self.instr.write(cmd)
-            # Check for errors
-            e = self.instr.query('SYST:ERR?').strip().split(',')
-            if int(e[0]) != 0:
-                self.log.error(f"{self.name}: Error: {e[1]}")
+            self._io(self.instr.write, cmd)
+            self._track(cmd)
+            # Check for errors (according to the error check policy)
+            self._after_command(cmd)
 
     def query(self, cmd: str):
+        t = self._open_transaction()
+        if t is not None:
+            # The answer is needed now: send what was collected so far to keep the order
+            t.send()
         if self.instr is not None:
+            if self.cache is not None:
+                ans = self.cache.answer(cmd)
+                if ans is not None:
+                    self.log.debug(f"{self.name}: Query (cached): {cmd} -> {ans}")
+                    return ans
             # Add logging to the query command (Debug Level)
             self.log.debug(f"{self.name}: Query: {cmd}")
-            ans = self.instr.query(cmd).strip()
-            # Check for errors
-            e = self.instr.query('SYST:ERR?').strip().split(',')
-            if int(e[0]) != 0:
-                self.log.error(f"{self.name} Error: {e[1]}")
+            ans = self._io(self.instr.query, cmd).strip()
+            self._track(cmd, ans)
+            # Check for errors (according to the error check policy)
+            self._after_command(cmd)
             return ans
+
+    def _send_batch(self, commands):
+        """
+        Send commands as semicolon joined messages (split by max_message_len)
+        and run a single error check at the end (according to the error check policy).
+        :return: List of the query answers in order
+        """
+        if self.instr is None:
+            return []
+        commands, messages = self.prepare_batch(commands)
+        answers = []
+        for msg, n_query in messages:
+            if n_query:
+                ans  = self._io(self.instr.query, msg).strip().split(';')
+                if len(ans) != n_query:
+                    self.log.error(f"{self.name}: Expected {n_query} answers, got {len(ans)}: {ans}")
+                answers += [a.strip() for a in ans]
+            else:
+                self._io(self.instr.write, msg)
+        return self.finish_batch(commands, answers)
+
+    def prepare_batch(self, commands):
+        """
+        Messages of a transaction (for a transport that sends them itself, e.g. async_scpi.gather_transactions)
+        :return: Commands to send (writes of the current value removed) and list of (message, number of queries)
+        """
+        # Writes of the current value are not sent
+        if self.cache is not None:
+            commands = self.cache.changed(commands)
+
+        # Split into messages that fit the instrument input buffer
+        messages = [[]]
+        length   = 0
+        for cmd in commands:
+            cmd = rooted(cmd)
+            if messages[-1] and length + len(cmd) + 1 > self.max_message_len:
+                messages.append([])
+                length = 0
+            messages[-1].append(cmd)
+            length += len(cmd) + 1
+
+        batch = []
+        for message in messages:
+            if not message:
+                continue
+            msg      = ';'.join(message)
+            n_query  = sum(is_query(cmd) for cmd in message)
+            self.log.debug(f"{self.name}: {'Query' if n_query else 'Write'}: {msg}")
+            batch.append((msg, n_query))
+        return commands, batch
+
+    def finish_batch(self, commands, answers):
+        # Track the sent commands (cache, frequency axis) and run the error check of the transaction
+        answer_iter = iter(answers)
+        for cmd in commands:
+            self._track(cmd, next(answer_iter, None) if is_query(cmd) else None)
+        # The transaction counts as a single command for the error check policy
+        self.pending += commands
+        if self.error_check == 'command' or (self.error_check == 'sync' and any(map(is_sync_point, commands))):
+            self.check_errors()
+        return answers
+
+    def read_trace(self, trace: int = 1, out = None):
+        """
+        Read a trace as binary REAL,32 (ASCII fallback) into a float32 buffer (see TraceReader).
+        The trace fetch is a sync point for the error check policy.
+        :param trace: Trace number
+        :param out: Optional preallocated float32 buffer
+        :return: float32 array view with the trace data
+        """
+        t = self._open_transaction()
+        if t is not None:
+            t.send()
+        if self.instr is not None:
+            if self.trace_reader is None:
+                self.trace_reader = TraceReader(self.instr, log=self.log)
+            if not self.trace_reader.configured and self.pending:
+                # Errors of earlier commands are not mixed with the data format errors
+                self.check_errors()
+            self.log.debug(f"{self.name}: Read trace: TRACE{trace}")
+            cmd  = f":TRACe:DATA? TRACE{trace}"
+            data = self._io(lambda _: self.trace_reader.read(trace, out=out), cmd)
+            self._after_command(cmd)
+            return data
+
+    def _track(self, cmd: str, ans: str = None):
+        # Keep the host side state in line with the commands that were sent
+        if self.trace_reader is not None and scpi_header(cmd).startswith(RESET_HEADERS):
+            self.trace_reader.invalidate()
+        if self.cache is not None:
+            if ans is None:
+                self.cache.written(cmd)
+            else:
+                self.cache.answered(cmd, ans)
+        if self._freq_axis is not None and ans is None:
+            self._freq_axis.written(cmd)
+
+    def _after_command(self, cmd: str):
+        self.pending.append(cmd)
+        if self.error_check == 'command' or (self.error_check == 'sync' and is_sync_point(cmd)):
+            self.check_errors()
+
+    def check_errors(self):
+        """
+        Drain the instrument error queue (SYST:ERR? until it reports 0)
+        and tie each error to the command that caused it.
+        :return: List of (command, code, message) tuples, empty if there were no errors
+        """
+        found = []
+        if self.instr is None:
+            return found
+
+        for _ in range(self.max_errors):
+            e       = self._io(self.instr.query, 'SYST:ERR?').strip().split(',', 1)
+            code    = int(e[0])
+            if code == 0:
+                break
+            msg     = e[1].strip().strip('"') if len(e) > 1 else ''
+            cmd     = self._error_source(msg)
+            found.append((cmd, code, msg))
+            if self._freq_axis is not None:
+                self._freq_axis.invalidate()
+            if self.cache is not None:
+                # The instrument did not take the value (or a batch failed)
+                if cmd in self.pending:
+                    self.cache.forget(cmd)
+                else:
+                    self.cache.clear()
+            self.log.error(f"{self.name}: Error: {msg} (command: {cmd})")
+        else:
+            self.log.error(f"{self.name}: Error queue not empty after {self.max_errors} reads")
+
+        self.pending = []
+        self.errors.extend(found)
+        return found
+
+    def _error_source(self, msg: str) -> str:
+        # A single pending command is the source by definition
+        if len(self.pending) == 1:
+            return self.pending[0]
+        # Many instruments append the offending text to the message: -113,"Undefined header;FREQ:CENTR 1 MHz"
+        if ';' in msg:
+            detail = msg.split(';', 1)[1].strip().upper()
+            for cmd in reversed(self.pending):
+                if detail and detail in cmd.upper():
+                    return cmd
+        # Otherwise the error belongs to the batch
+        return ' ; '.join(self.pending)
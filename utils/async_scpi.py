@@ -0,0 +1,237 @@
+import asyncio
+import logging
+import threading
+
+import numpy as np
+
+# asyncio SCPI client over a raw TCP socket (port 5025).
+#
+# A single event loop can drive a whole rack: each AsyncSCPIClient serializes its own commands
+# (per instrument ordering), while different instruments run concurrently, for example:
+#
+#     await asyncio.gather(sg.write(f"freq {f} MHz"), sa.write(f"sense:FREQuency:CENTer {f} MHz"))
+#
+# SyncSCPIClient is a blocking facade with the pyvisa resource API (write, query, query_ascii_values,
+# query_binary_values, timeout in ms), so it can be passed as instr to SCPIWrapper from QThread code.
+# gather_transactions() sends the transactions of several such wrappers at the same time, e.g. the SG and
+# SA retune of NetScanEngine (concurrent=True):
+#
+#     sg_answers, sa_answers = gather_transactions((scpi_sg, [f"freq {f} MHz", "*OPC?"]),
+#                                                  (scpi_sa, [f"sense:FREQuency:CENTer {f} MHz"]))
+
+
+class AsyncSCPIClient:
+    def __init__(self, host: str, port: int = 5025, timeout: float = 5.0, name: str = 'SCPI', log = None):
+        self.host       = host
+        self.port       = port
+        self.timeout    = timeout   # seconds (per request)
+        self.name       = name
+        self.log        = log if log is not None else logging.getLogger(__name__)
+        self.reader     = None
+        self.writer     = None
+        self.lock       = None      # Per instrument ordering (created in the event loop)
+
+    async def connect(self):
+        if self.lock is None:
+            self.lock = asyncio.Lock()
+        await self._open()
+        self.log.debug(f"{self.name}: Connected to {self.host}:{self.port}")
+        return self
+
+    async def _open(self):
+        self.reader, self.writer = await asyncio.wait_for(
+            asyncio.open_connection(self.host, self.port), self.timeout)
+
+    async def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            try:
+                await self.writer.wait_closed()
+            except ConnectionError:
+                pass
+            self.writer = None
+
+    async def __aenter__(self):
+        return await self.connect()
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.close()
+
+    async def _send(self, cmd: str):
+        if self.writer is None:
+            await self._open()
+        self.writer.write(cmd.encode() + b'\n')
+        await self.writer.drain()
+
+    async def _read_line(self) -> bytes:
+        return await self.reader.readuntil(b'\n')
+
+    async def _read_block(self) -> bytes:
+        # IEEE 488.2 definite length block: #<n><length><data>
+        head = await self.reader.readexactly(2)
+        if head[:1] != b'#':
+            # Not a block (e.g. ASCII data): consume the rest of the message
+            await self._read_line()
+            raise ValueError(f"{self.name}: Expected a binary block, got {head}")
+        n_digits = int(head[1:2])
+        if n_digits == 0:
+            # Indefinite length block, terminated by the message terminator
+            return (await self._read_line())[:-1]
+        length   = int(await self.reader.readexactly(n_digits))
+        data     = await self.reader.readexactly(length)
+        # Message terminator
+        await self._read_line()
+        return data
+
+    async def _request(self, coro):
+        async with self.lock:
+            try:
+                return await asyncio.wait_for(coro(), self.timeout)
+            except asyncio.TimeoutError:
+                # The answer of a timed out request could be read by the next one: reconnect
+                self.log.error(f"{self.name}: Timeout")
+                try:
+                    await self.close()
+                    await self._open()
+                except (OSError, asyncio.TimeoutError) as e:
+                    # Reconnected on the next request, the timeout is the error of this one
+                    self.log.error(f"{self.name}: Reconnect failed: {e}")
+                    self.writer = None
+                raise
+
+    async def write(self, cmd: str):
+        self.log.debug(f"{self.name}: Write: {cmd}")
+        async def request():
+            await self._send(cmd)
+        await self._request(request)
+
+    async def query(self, cmd: str) -> str:
+        self.log.debug(f"{self.name}: Query: {cmd}")
+        async def request():
+            await self._send(cmd)
+            return (await self._read_line()).decode().strip()
+        return await self._request(request)
+
+    async def query_ascii_values(self, cmd: str, container = np.array):
+        ans = await self.query(cmd)
+        return container([float(x) for x in ans.split(',')])
+
+    async def query_binary_values(self, cmd: str, datatype: str = 'f', is_big_endian: bool = False,
+                                  container = np.array):
+        self.log.debug(f"{self.name}: Query binary: {cmd}")
+        async def request():
+            await self._send(cmd)
+            return await self._read_block()
+        block = await self._request(request)
+        dtype = np.dtype(datatype).newbyteorder('>' if is_big_endian else '<')
+        data  = np.frombuffer(block, dtype=dtype)
+        return data if container in (np.array, np.ndarray) else container(data)
+
+    async def check_errors(self, max_errors: int = 32):
+        # Drain the error queue: list of (code, message)
+        errors = []
+        for _ in range(max_errors):
+            e = (await self.query('SYST:ERR?')).split(',', 1)
+            if int(e[0]) == 0:
+                break
+            errors.append((int(e[0]), e[1].strip().strip('"') if len(e) > 1 else ''))
+            self.log.error(f"{self.name}: Error: {errors[-1][1]}")
+        return errors
+
+
+class EventLoopThread:
+    """
+    Event loop running in a background thread, shared by the synchronous facades
+    (one loop for the whole rack).
+    """
+    def __init__(self):
+        self.loop   = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+
+    def run(self, coro, timeout = None):
+        # Run a coroutine in the loop and wait for the result (from any thread)
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result(timeout)
+
+    def gather(self, *coros):
+        # Run coroutines concurrently (e.g. retune the SG and the SA at the same time)
+        async def gather():
+            return await asyncio.gather(*coros)
+        return self.run(gather())
+
+    def stop(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+
+
+_default_loop = None
+
+def default_loop() -> EventLoopThread:
+    global _default_loop
+    if _default_loop is None:
+        _default_loop = EventLoopThread()
+    return _default_loop
+
+
+class SyncSCPIClient:
+    """
+    Blocking facade of AsyncSCPIClient with the pyvisa resource API.
+    scpi = SCPIWrapper(instr=SyncSCPIClient('10.0.0.26'), log=log, name='SA')
+    The async client is available as .client for use with loop.gather().
+    """
+    def __init__(self, host: str, port: int = 5025, timeout: float = 5.0, name: str = 'SCPI', log = None,
+                 loop: EventLoopThread = None):
+        self.loop   = loop if loop is not None else default_loop()
+        self.client = AsyncSCPIClient(host, port, timeout, name, log)
+        self.loop.run(self.client.connect())
+
+    @property
+    def timeout(self):
+        # pyvisa compatible (ms)
+        return self.client.timeout * 1000
+
+    @timeout.setter
+    def timeout(self, value):
+        self.client.timeout = value / 1000
+
+    def write(self, cmd: str):
+        self.loop.run(self.client.write(cmd))
+
+    def query(self, cmd: str) -> str:
+        return self.loop.run(self.client.query(cmd))
+
+    def query_ascii_values(self, cmd: str, container = np.array):
+        return self.loop.run(self.client.query_ascii_values(cmd, container=container))
+
+    def query_binary_values(self, cmd: str, datatype: str = 'f', is_big_endian: bool = False,
+                            container = np.array):
+        return self.loop.run(self.client.query_binary_values(cmd, datatype, is_big_endian, container))
+
+    def close(self):
+        self.loop.run(self.client.close())
+
+
+def gather_transactions(*batches):
+    """
+    Send the transactions of several SCPIWrappers (SyncSCPIClient instruments on the same loop) concurrently
+    with asyncio.gather. Each wrapper keeps its cache, frequency axis and error check in line.
+    :param batches: (SCPIWrapper, list of commands) pairs, one per instrument
+    :return: List of the query answers of each batch
+    """
+    loops = {scpi.instr.loop for scpi, _ in batches}
+    if len(loops) != 1:
+        raise ValueError("Error: gather_transactions needs SyncSCPIClient instruments on a single loop")
+
+    async def send(client, messages):
+        answers = []
+        for msg, n_query in messages:
+            if n_query:
+                answers += [a.strip() for a in (await client.query(msg)).split(';')]
+            else:
+                await client.write(msg)
+        return answers
+
+    prepared    = [scpi.prepare_batch(commands) for scpi, commands in batches]
+    answers     = loops.pop().gather(*(send(scpi.instr.client, messages)
+                                       for (scpi, _), (_, messages) in zip(batches, prepared)))
+    return [scpi.finish_batch(commands, ans) for (scpi, _), (commands, _), ans in zip(batches, prepared, answers)]
@@ -0,0 +1,377 @@
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import queue
+import sys
+import time
+
+import pyvisa
+import yaml
+
+from python_rf_course.utils.SCPI_wrapper import SCPIWrapper
+from python_rf_course.utils.scan_cli     import open_instrument, load_params, run_pa, pa_row
+from python_rf_course.utils.scan_journal import ScanJournal
+
+# PA scans of a queue of DUTs on several SA/SG stations in parallel: one worker process per station pulls
+# the next job from a shared queue, so a fast station takes more jobs and the throughput scales with the
+# number of stations. Each worker opens its instrument sessions once and keeps them for all its jobs
+# (reopened after a failed job, a station that cannot connect leaves the farm). The points of all the jobs
+# go to a single results file (JSON lines).
+#
+#     farm = BenchFarm([dict(name='Bench1', sa='10.0.0.26', sg='10.0.0.25'),
+#                       dict(name='Bench2', sa='10.0.0.36', sg='10.0.0.35')], 'farm_results.jsonl')
+#     for sn in ('SN1234', 'SN1235', 'SN1236'):
+#         farm.submit(sn, load_params('pa_defaults.yaml', []))
+#     summary = farm.run()                    # blocks until the queue is empty
+#     print(farm.status())                    # queue depth, utilization, per job timing
+#
+#     python -m python_rf_course.utils.bench_farm farm.yaml --out farm_results.jsonl
+#
+# Farm file (YAML): the job plans are YAML files of the PA GUI (pa_defaults.yaml), relative to the farm file
+#     stations:
+#       - {name: Bench1, sa: 10.0.0.26, sg: 10.0.0.25}
+#       - {name: Bench2, sa: 10.0.0.36, sg: 10.0.0.35, no_arb: true}
+#     plan: pa_defaults.yaml                  # Default plan of the jobs
+#     jobs:
+#       - {sn: SN1234}
+#       - {sn: SN1235, set: {Npoints: 41}}    # Plan overrides
+#       - {sn: SN1236, plan: pa_narrow.yaml}
+#
+# Results records (type field):
+#     farm    First line: created, stations
+#     start   job, sn, station, time
+#     point   job, sn, station, i, row (POINT_DTYPE field: value)
+#     done    job, sn, station, status (done, failed, stopped), error, queued, start, end, points
+
+STATUS_PERIOD   = 10.0  # Status log period (s)
+DEAD_GRACE      = 2.0   # Time to read the last messages of a dead station process (s)
+JOB_STATUS      = ('queued', 'running', 'done', 'failed', 'stopped')
+
+
+def station_worker(station: dict, jobs, results, stopping, timeout: int = 60000, journal_dir: str = None):
+    """
+    Worker process of a station: runs the jobs of the shared queue until the None sentinel (sent by the farm
+    when all the jobs are finished) or stopping.
+    :param station: name, sa, sg (IP or VISA resource name), no_arb (TwoTones already in the SG memory)
+    :param jobs: Queue of (job id, sn, params)
+    :param results: Queue of the (kind, station, job id, time, payload) messages to the farm
+    :param journal_dir: Journal of each job in <journal_dir>/<sn>.job<job id>.journal, resumed if the job is run
+                        again after a stop or a failure (a completed journal is started again)
+    """
+    name    = station['name']
+    ip_sg   = station['sg'] if '::' not in station['sg'] else None
+    rm      = pyvisa.ResourceManager('@py')
+    session = None
+
+    def post(kind, job_id=None, payload=None):
+        results.put((kind, name, job_id, time.time(), payload))
+
+    def open_session():
+        # The session pool of the station: SA and SG, shared by all the jobs of the worker
+        sa      = open_instrument(rm, station['sa'], timeout)
+        sg      = open_instrument(rm, station['sg'], timeout)
+        log     = logging.getLogger(f"bench_farm.{name}")
+        scpi_sa = SCPIWrapper(instr=sa, log=log, name=f"{name} SA", error_check='sync', cache=True)
+        scpi_sg = SCPIWrapper(instr=sg, log=log, name=f"{name} SG", error_check='sync', cache=True)
+        post('log', payload=f"Connected to SA: {scpi_sa.query('*IDN?').strip()} | "
+                            f"SG: {scpi_sg.query('*IDN?').strip()}")
+        return sa, sg, scpi_sa, scpi_sg
+
+    def close_session():
+        for instr in session[:2]:
+            try:
+                instr.close()
+            except Exception:
+                pass
+
+    try:
+        while not stopping.is_set():
+            try:
+                job = jobs.get(timeout=1.0)
+            except queue.Empty:
+                continue
+            if job is None:
+                break
+            job_id, sn, params = job
+            post('start', job_id)
+            journal = None
+            if session is None:
+                try:
+                    session = open_session()
+                except Exception as e:
+                    # The station is down: the job goes back to the queue for the other stations
+                    post('requeue', job_id, f"{type(e).__name__}: {e}")
+                    jobs.put(job)
+                    break
+            try:
+                if journal_dir is not None:
+                    path    = os.path.join(journal_dir, f"{sn}.job{job_id}.journal")
+                    sync    = params.get('JournalSync', 'flush')
+                    journal = ScanJournal(path, sync=sync, resume=True)
+                    if journal.ended is not None and not journal.ended['stopped']:
+                        # Completed by a previous run: a new scan
+                        journal.file.close()
+                        journal = ScanJournal(path, sync=sync)
+
+                def handler(event, *args):
+                    if event == 'point':
+                        post('point', job_id, (args[0], pa_row(args[1])))
+                    elif event == 'log':
+                        post('debug', job_id, args[0])
+
+                run_pa(dict(params, SN=sn, Station=name), session[2], session[3], handler,
+                       no_arb=station.get('no_arb', False), ip_sg=ip_sg, journal=journal)
+                post('done', job_id, ('done', None))
+            except KeyboardInterrupt:
+                post('done', job_id, ('stopped', None))
+                break
+            except Exception as e:
+                post('done', job_id, ('failed', f"{type(e).__name__}: {e}"))
+                # A new session for the next job (the instruments may be left in any state)
+                if session is not None:
+                    close_session()
+                    session = None
+            finally:
+                # Closed by the scan engine, unless the job failed before the scan
+                if journal is not None:
+                    journal.close(stopped=True)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if session is not None:
+            close_session()
+        rm.close()
+        post('exit')
+
+
+class BenchFarm:
+    """
+    Queue of PA scan jobs dispatched to the stations (one process per station)
+    :param stations: List of dict: name, sa, sg, no_arb (see station_worker)
+    :param store: Results file (JSON lines, see the record types above), None: no file
+    :param journal_dir: Directory of the per job scan journals (None: no journal)
+    """
+    def __init__(self, stations: list, store: str = None, journal_dir: str = None, timeout: int = 60000,
+                 log = None):
+        names = [s['name'] for s in stations]
+        if len(set(names)) != len(names):
+            raise ValueError("Error: Station names must be unique")
+        self.stations       = stations
+        self.store          = store
+        self.journal_dir    = journal_dir
+        self.timeout        = timeout
+        self.log            = log or logging.getLogger('bench_farm')
+        self.context        = multiprocessing.get_context()
+        self.jobs           = []    # Job id -> dict: sn, params, station, status, queued, start, end, points
+        self.t_start        = None
+        self.t_end          = None
+        self.busy           = {name: 0.0 for name in names}   # Busy time of the finished jobs (s)
+        self.running        = {}    # Station name -> job id
+        self.stopping       = self.context.Event()
+
+    def submit(self, sn: str, params: dict) -> int:
+        """
+        Add a job (jobs are submitted before run())
+        :param sn: DUT serial number
+        :param params: Scan plan (YAML file of the PA GUI as a dict)
+        :return: Job id
+        """
+        self.jobs.append(dict(sn=sn, params=params, station=None, status='queued', queued=time.time(),
+                              start=None, end=None, points=0, error=None))
+        return len(self.jobs) - 1
+
+    def status(self) -> dict:
+        """
+        :return: dict: queue_depth (jobs not started), running, done, failed, stopped, elapsed (s),
+                 utilization {station: busy time / elapsed}, jobs (list of per job timing: wait, run (s), points)
+        """
+        now     = self.t_end or time.time()
+        elapsed = now - self.t_start if self.t_start is not None else 0.0
+        busy    = dict(self.busy)
+        for name, job_id in self.running.items():
+            busy[name] += now - self.jobs[job_id]['start']
+        count   = {s: sum(job['status'] == s for job in self.jobs) for s in JOB_STATUS}
+        jobs    = [dict(job=i, sn=job['sn'], station=job['station'], status=job['status'], points=job['points'],
+                        wait=(job['start'] or now) - job['queued'],
+                        run=(job['end'] or now) - job['start'] if job['start'] is not None else 0.0,
+                        error=job['error'])
+                   for i, job in enumerate(self.jobs)]
+        return dict(queue_depth=count['queued'], running=count['running'], done=count['done'],
+                    failed=count['failed'], stopped=count['stopped'], elapsed=elapsed,
+                    utilization={name: b / elapsed if elapsed > 0 else 0.0 for name, b in busy.items()},
+                    jobs=jobs)
+
+    def stop(self):
+        # The stations finish their running job and take no new job
+        self.stopping.set()
+
+    def _record(self, file, record: dict):
+        if file is not None:
+            file.write(json.dumps(record) + '\n')
+            file.flush()
+
+    def _message(self, file, kind, station, job_id, t, payload):
+        # A message of a worker: update the job table and the results file
+        if kind == 'log':
+            self.log.info(f"{station}: {payload}")
+            return
+        if kind == 'debug':
+            self.log.debug(f"{station} job {job_id}: {payload}")
+            return
+        job = self.jobs[job_id]
+        if kind == 'start':
+            job.update(station=station, status='running', start=t)
+            self.running[station] = job_id
+            self._record(file, dict(type='start', job=job_id, sn=job['sn'], station=station, time=t))
+            self.log.info(f"{station}: job {job_id} ({job['sn']}) started")
+        elif kind == 'requeue':
+            self.running.pop(station, None)
+            if job['station'] == station:
+                # Not yet started again by another station
+                job.update(station=None, status='queued', start=None)
+            self.log.error(f"{station}: station removed from the farm, job {job_id} ({job['sn']}) requeued: "
+                           f"{payload}")
+        elif kind == 'point':
+            job['points'] += 1
+            i, row = payload
+            self._record(file, dict(type='point', job=job_id, sn=job['sn'], station=station, i=i, row=row))
+        elif kind == 'done':
+            status, error = payload
+            job.update(status=status, end=t, error=error)
+            self.busy[station] += t - job['start']
+            self.running.pop(station, None)
+            self._record(file, dict(type='done', job=job_id, sn=job['sn'], station=station, status=status,
+                                    error=error, queued=job['queued'], start=job['start'], end=t,
+                                    points=job['points']))
+            if status != 'failed':
+                self.log.info(f"{station}: job {job_id} ({job['sn']}) {status} in {t - job['start']:.1f} s, "
+                              f"{job['points']} points")
+            else:
+                self.log.error(f"{station}: job {job_id} ({job['sn']}) failed: {error}")
+
+    def run(self, status_period: float = STATUS_PERIOD) -> dict:
+        """
+        Run all the submitted jobs (blocking)
+        :param status_period: Period of the status log (s)
+        :return: Final status (see status())
+        """
+        jobs    = self.context.Queue()
+        results = self.context.Queue()
+        for i, job in enumerate(self.jobs):
+            jobs.put((i, job['sn'], job['params']))
+        if self.journal_dir is not None:
+            os.makedirs(self.journal_dir, exist_ok=True)
+
+        self.t_start    = time.time()
+        self.t_end      = None
+        self.stopping.clear()
+        workers = [self.context.Process(target=station_worker, name=f"bench_farm.{s['name']}",
+                                        args=(s, jobs, results, self.stopping, self.timeout, self.journal_dir))
+                   for s in self.stations]
+        for worker in workers:
+            worker.start()
+
+        file    = open(self.store, 'w') if self.store is not None else None
+        self._record(file, dict(type='farm', created=self.t_start, stations=self.stations))
+        exited  = set()
+        dead    = {}    # Station name -> time the process was found dead
+        t_log   = self.t_start
+        ended   = False
+        try:
+            while len(exited) < len(workers):
+                try:
+                    message = results.get(timeout=1.0)
+                except queue.Empty:
+                    message = None
+                except KeyboardInterrupt:
+                    # Ctrl-C also stops the workers (same process group): collect their stopped jobs
+                    if self.stopping.is_set():
+                        raise
+                    self.log.warning("Farm stopped")
+                    self.stop()
+                    continue
+                if message is not None:
+                    if message[0] == 'exit':
+                        exited.add(message[1])
+                    else:
+                        self._message(file, *message)
+                for s, worker in zip(self.stations, workers):
+                    if s['name'] not in exited and not worker.is_alive():
+                        # No exit message DEAD_GRACE s after the end of the process (its last messages are read
+                        # first): the worker died, its job failed
+                        if time.time() - dead.setdefault(s['name'], time.time()) > DEAD_GRACE:
+                            exited.add(s['name'])
+                            if s['name'] in self.running:
+                                self._message(file, 'done', s['name'], self.running[s['name']], time.time(),
+                                              ('failed', f"Station process exit code {worker.exitcode}"))
+                if not ended and not any(job['status'] in ('queued', 'running') for job in self.jobs):
+                    # All the jobs are finished (a requeued job may follow the last one): one sentinel per station
+                    ended = True
+                    for _ in workers:
+                        jobs.put(None)
+                if time.time() - t_log >= status_period:
+                    t_log   = time.time()
+                    status  = self.status()
+                    self.log.info(f"Queue {status['queue_depth']}, running {status['running']}, "
+                                  f"done {status['done']}, failed {status['failed']}, utilization " +
+                                  ", ".join(f"{n} {u:.0%}" for n, u in status['utilization'].items()))
+        finally:
+            self.t_end = time.time()
+            for worker in workers:
+                worker.join(timeout=5.0)
+                if worker.is_alive():
+                    worker.terminate()
+            # Jobs left in the queue (stop) must not block the exit
+            jobs.cancel_join_thread()
+            if file is not None:
+                file.close()
+        return self.status()
+
+
+def load_farm(path: str) -> tuple:
+    """
+    :return: Stations (list of dict) and jobs (list of (sn, params)) of a farm file
+    """
+    with open(path, "r") as f:
+        farm = yaml.safe_load(f)
+    folder  = os.path.dirname(os.path.abspath(path))
+    plans   = {}
+    jobs    = []
+    for job in farm['jobs']:
+        plan = os.path.join(folder, job.get('plan', farm.get('plan', 'pa_defaults.yaml')))
+        if plan not in plans:
+            plans[plan] = load_params(plan, [])
+        jobs.append((str(job['sn']), dict(plans[plan], **job.get('set', {}))))
+    return farm['stations'], jobs
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="PA scans of a queue of DUTs on several stations in parallel")
+    parser.add_argument('farm', help="Farm file (YAML): stations, plan, jobs")
+    parser.add_argument('--out', default='farm_results.jsonl', help="Results file (JSON lines)")
+    parser.add_argument('--journal-dir', help="Scan journal of each job (<sn>.job<id>.journal), resumed on a new run")
+    parser.add_argument('--timeout', type=int, default=60000, help="VISA timeout (ms)")
+    parser.add_argument('--status', type=float, default=STATUS_PERIOD, help="Status log period (s)")
+    parser.add_argument('-v', '--verbose', action='store_true')
+    args    = parser.parse_args()
+
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO, stream=sys.stderr,
+                        format='%(asctime)s %(levelname)s %(message)s')
+    stations, jobs = load_farm(args.farm)
+    farm    = BenchFarm(stations, args.out, journal_dir=args.journal_dir, timeout=args.timeout)
+    for sn, params in jobs:
+        farm.submit(sn, params)
+    try:
+        status = farm.run(args.status)
+    except KeyboardInterrupt:
+        status = farm.status()
+    print(f"{status['done']} of {len(jobs)} jobs done, {status['failed']} failed, {status['stopped']} stopped "
+          f"in {status['elapsed']:.1f} s")
+    for name, u in status['utilization'].items():
+        print(f"  {name:12s} utilization {u:.0%}")
+    for job in status['jobs']:
+        print(f"  job {job['job']:3d} {job['sn']:12s} {str(job['station']):12s} {job['status']:8s} "
+              f"wait {job['wait']:7.1f} s  run {job['run']:7.1f} s  {job['points']} points")
+    sys.exit(0 if status['done'] == len(jobs) else 1)
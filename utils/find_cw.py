@@ -0,0 +1,340 @@
+import logging
+import math
+import time
+
+import numpy as np
+from scipy.signal import find_peaks
+
+# CW carrier finder: zoom from the current (wide) span to the target frequency accuracy in the fewest,
+# shortest sweeps. The sweep time of a swept analyzer is about k * span / RBW^2, and with the RBW coupled
+# to the span (RBW = span / ratio) it grows as 1 / span: the narrow spans cost most of the time.
+# So the planner compares the zoom plans by their predicted time (the sweep time model, from SWE:TIME?).
+#
+#     scpi    = SCPIWrapper(instr=sa, log=log, name='SA')
+#     result  = find_cw(scpi, accuracy=1.0)   # Hz
+#     print(result['freq'], result['power'], result['timing'])
+#
+#     result  = find_carriers(scpi, threshold=-70, accuracy=100.0)   # every peak above -70 dBm
+#     for carrier in result['carriers']:
+#         print(carrier['freq'], carrier['power'], carrier['accuracy'])
+
+# Frequency error of a single sweep estimate, in trace bins (span / (points - 1))
+BIN_ERROR = {'marker': 0.5,     # Marker peak search: the nearest trace point
+             'trace' : 0.1}     # Parabola fitted to the peak (dB) on the host
+
+
+class SweepModel:
+    """
+    Sweep time of the analyzer: max(k * span / rbw^2, t_min) + t_overhead, rbw = min(span / ratio, rbw_max)
+    (ratio 106 is the span/RBW auto coupling of the Keysight analyzers)
+    """
+    def __init__(self, k: float, points: int, ratio: float = 106.0, rbw_max: float = None, t_min: float = 1e-3,
+                 t_overhead: float = 0.02):
+        self.k          = k
+        self.points     = points
+        self.ratio      = ratio
+        self.rbw_max    = rbw_max
+        self.t_min      = t_min
+        self.t_overhead = t_overhead    # Retune, trigger and readout (s)
+
+    @classmethod
+    def from_instrument(cls, scpi, ratio: float = 106.0, **kwargs):
+        # Single round trip: the current span, RBW, sweep time and points
+        with scpi.transaction() as t:
+            t.query(":SENSe:FREQuency:SPAN?")
+            t.query(":SENSe:BANDwidth:RESolution?")
+            t.query(":SENSe:SWEep:TIME?")
+            t.query(":SENSe:SWEep:POINts?")
+        span, rbw, sweep_time, points = (float(a) for a in t.answers)
+        # A wide span runs at the maximal RBW of the analyzer
+        rbw_max = rbw if span / rbw > ratio * 1.5 else None
+        return cls(k=sweep_time * rbw ** 2 / span, points=int(points), ratio=ratio, rbw_max=rbw_max, **kwargs)
+
+    def rbw(self, span: float) -> float:
+        rbw = span / self.ratio
+        return min(rbw, self.rbw_max) if self.rbw_max is not None else rbw
+
+    def sweep_time(self, span: float) -> float:
+        return max(self.k * span / self.rbw(span) ** 2, self.t_min) + self.t_overhead
+
+
+def plan_zoom(span: float, accuracy: float, model: SweepModel, method: str = 'trace', margin: float = 4.0,
+              extra_steps: int = 2):
+    """
+    Spans of the zoom steps after the first (wide) sweep, the plan with the least predicted time
+    (sum of model.sweep_time).
+    The estimate of a sweep is within c * span / (points - 1) (c = BIN_ERROR[method]), the next span holds
+    +-margin times that error, so the zoom ratio is at most (points - 1) / (2 * margin * c).
+    The last span reaches the accuracy. The sweep time grows as 1 / span with the RBW coupled to the span,
+    so the candidates take the maximal zoom at the last m steps (the narrow spans as wide as possible) and
+    spread the rest of the ratio evenly over the first steps, for m = 0 (even plan) to all the steps, and
+    for the fewest steps up to extra_steps more.
+    :param span: Span of the first sweep (Hz)
+    :param accuracy: Target frequency accuracy (Hz)
+    :return: List of spans (Hz), empty if the first sweep is accurate enough
+    """
+    c           = BIN_ERROR[method]
+    bins        = model.points - 1
+    final       = accuracy * bins / c
+    if final >= span:
+        return []
+    max_ratio   = bins / (2 * margin * c)
+    fewest      = math.ceil(math.log(span / final) / math.log(max_ratio))
+    plans       = []
+    for steps in range(fewest, fewest + extra_steps + 1):
+        for m in range(steps):
+            # Ratio left for the first steps - m steps
+            rest    = span / (final * max_ratio ** m)
+            ratio   = rest ** (1 / (steps - m)) if rest > 1 else 0.0
+            if not 1 < ratio <= max_ratio * (1 + 1e-9):
+                continue
+            plans.append([span / ratio ** (i + 1) for i in range(steps - m)] +
+                         [final * max_ratio ** (m - 1 - i) for i in range(m)])
+    return min(plans, key=lambda plan: sum(model.sweep_time(s) for s in plan))
+
+
+def peak_interp(freq: np.ndarray, power: np.ndarray, width: float = 3.0):
+    """
+    Peak of a trace: least squares parabola through the points within width dB of the maximum, around it
+    (a Gaussian RBW filter is a parabola in dB). Falls back to the maximum point.
+    :return: Frequency and power of the peak
+    """
+    i       = int(np.argmax(power))
+    top     = power[i] - width
+    lo      = i
+    while lo > 0 and power[lo - 1] >= top:
+        lo -= 1
+    hi      = i + 1
+    while hi < len(power) and power[hi] >= top:
+        hi += 1
+    if hi - lo < 3:
+        lo, hi = max(i - 1, 0), min(i + 2, len(power))
+    if hi - lo < 3:
+        return float(freq[i]), float(power[i])
+    x       = freq[lo:hi] - freq[i]
+    a, b, c = np.polyfit(x, power[lo:hi].astype(np.float64), 2)
+    if a >= 0:
+        return float(freq[i]), float(power[i])
+    x0      = float(np.clip(-b / (2 * a), x[0], x[-1]))
+    return float(freq[i] + x0), float((a * x0 + b) * x0 + c)
+
+
+def find_cw(scpi, accuracy: float = 10.0, method: str = 'trace', margin: float = 4.0, model: SweepModel = None,
+            log = None) -> dict:
+    """
+    Find the strongest CW carrier in the current span.
+    The first sweep uses the current span (the caller sets e.g. full span and the detector) with auto RBW,
+    the zoom steps set the RBW to span / model.ratio. The analyzer is left in single sweep.
+    :param scpi: SCPIWrapper of the analyzer
+    :param accuracy: Target frequency accuracy (Hz)
+    :param method: 'marker' - marker peak search on the analyzer, 'trace' - host side peak interpolation
+    :param model: Sweep time model (default: SweepModel.from_instrument at the first span)
+    :return: dict: freq (Hz), power (dBm), accuracy (Hz, estimate), steps (span, rbw, predicted and measured
+             time of each sweep), timing (s: calibration, sweeps, host, total)
+    """
+    if method not in BIN_ERROR:
+        raise ValueError(f"Error: Unknown peak search method {method}")
+    log     = log if log is not None else logging.getLogger(__name__)
+    t0      = time.perf_counter()
+    scpi.write(":SENSe:BANDwidth:RESolution:AUTO ON")
+    scpi.write(":INITiate:CONTinuous OFF")
+    if model is None:
+        model = SweepModel.from_instrument(scpi)
+    span    = float(scpi.query(":SENSe:FREQuency:SPAN?"))
+    plan    = plan_zoom(span, accuracy, model, method, margin)
+    t_cal   = time.perf_counter() - t0
+    log.info(f"find_cw: {len(plan) + 1} sweeps, spans {[f'{s:.4g}' for s in [span] + plan]} Hz, "
+             f"predicted {sum(model.sweep_time(s) for s in [span] + plan):.3f} s")
+
+    steps   = []
+    t_host  = 0.0
+    freq    = None
+    power   = None
+    for span in [span] + plan:
+        t       = time.perf_counter()
+        with scpi.transaction() as tr:
+            if freq is not None:
+                tr.write(f":SENSe:FREQuency:CENTer {freq}")
+                tr.write(f":SENSe:FREQuency:SPAN {span}")
+                tr.write(f":SENSe:BANDwidth:RESolution {model.rbw(span)}")
+            tr.write(":INITiate:IMMediate")
+            tr.query("*OPC?")
+            if method == 'marker':
+                tr.write(":CALCulate:MARKer1:MAXimum")
+                tr.query(":CALCulate:MARKer1:X?")
+                tr.query(":CALCulate:MARKer1:Y?")
+        if method == 'marker':
+            t_sweep = time.perf_counter() - t
+            freq    = float(tr.answers[-2])
+            power   = float(tr.answers[-1])
+        else:
+            trace   = scpi.read_trace(1)
+            axis    = scpi.freq_axis.get()
+            t_sweep = time.perf_counter() - t
+            t_peak  = time.perf_counter()
+            freq, power = peak_interp(axis * 1e6, trace)
+            t_host += time.perf_counter() - t_peak
+        steps.append({'span': span, 'rbw': model.rbw(span), 'predicted': model.sweep_time(span),
+                      'measured': t_sweep})
+        log.debug(f"find_cw: span {span:.4g} Hz: {freq:.1f} Hz, {power:.2f} dBm ({t_sweep:.3f} s)")
+
+    total   = time.perf_counter() - t0
+    return {'freq': freq, 'power': power,
+            'accuracy': BIN_ERROR[method] * steps[-1]['span'] / (model.points - 1),
+            'steps': steps,
+            'timing': {'calibration': t_cal, 'sweeps': sum(s['measured'] for s in steps), 'host': t_host,
+                       'total': total}}
+
+
+def detect_peaks(freq: np.ndarray, power: np.ndarray, threshold: float = None, prominence: float = 6.0,
+                 min_separation: float = 0.0, max_peaks: int = None):
+    """
+    All peaks of a trace (vectorized: scipy.signal.find_peaks), refined by a 3 point parabola in dB.
+    :param threshold: Minimal peak power (dBm, default: median of the trace (noise floor) + prominence)
+    :param prominence: Minimal height of a peak above the higher of its two surrounding minima (dB)
+    :param min_separation: Minimal frequency distance of two peaks (the weaker one is dropped)
+    :param max_peaks: Keep the strongest max_peaks
+    :return: Frequency and power arrays of the peaks, sorted by frequency
+    """
+    power   = np.asarray(power, dtype=np.float64)
+    if threshold is None:
+        threshold = float(np.median(power)) + prominence
+    step    = (freq[-1] - freq[0]) / (len(freq) - 1)
+    index, _ = find_peaks(power, height=threshold, prominence=prominence,
+                          distance=max(1, int(round(min_separation / step))))
+    if max_peaks is not None and len(index) > max_peaks:
+        index = np.sort(index[np.argsort(power[index])[-max_peaks:]])
+    # Vertex of the parabola through the peak and its neighbours (edge peaks are not moved)
+    inner   = (index > 0) & (index < len(power) - 1)
+    left    = power[np.where(inner, index - 1, index)]
+    right   = power[np.where(inner, index + 1, index)]
+    centre  = power[index]
+    curve   = left - 2 * centre + right
+    with np.errstate(divide='ignore', invalid='ignore'):
+        delta = np.where(curve < 0, 0.5 * (left - right) / curve, 0.0)
+    return freq[index] + delta * step, centre - 0.25 * (left - right) * delta
+
+
+def group_peaks(freq: np.ndarray, span: float, guard: float) -> list:
+    """
+    Greedy grouping of sorted peak frequencies into the fewest sweeps of the span: each peak with +-guard
+    around it inside the span of its group.
+    :return: List of (centre, index array) of the groups, in frequency order
+    """
+    groups  = []
+    first   = 0
+    for i in range(1, len(freq) + 1):
+        if i == len(freq) or freq[i] - freq[first] > span - 2 * guard:
+            groups.append(((freq[first] + freq[i - 1]) / 2, np.arange(first, i)))
+            first = i
+    return groups
+
+
+def find_carriers(scpi, threshold: float = None, prominence: float = 6.0, min_separation: float = None,
+                  accuracy: float = 100.0, margin: float = 4.0, max_peaks: int = None, model: SweepModel = None,
+                  log = None) -> dict:
+    """
+    Find all the carriers (and spurs) in the current span.
+    One wide sweep (the current span, auto RBW) finds the peaks on the host, then each zoom step of
+    plan_zoom sweeps the peaks in groups: peaks closer than a span share one sweep, and the groups are
+    swept in frequency order (reversed at every step), so there is a single retune per group.
+    Peaks that the narrower RBW of a zoom sweep resolves are added to the next steps.
+    :param threshold: Minimal peak power (dBm, default: noise floor + prominence)
+    :param prominence: Minimal peak prominence (dB)
+    :param min_separation: Minimal peak distance (Hz, default: 2 RBW of the wide sweep)
+    :param accuracy: Target frequency accuracy (Hz)
+    :param max_peaks: Refine only the strongest max_peaks
+    :return: dict: carriers (list of dicts: freq (Hz), power (dBm), accuracy (Hz)), sweeps (centre, span,
+             rbw, number of peaks and measured time of each sweep), timing (s: calibration, sweeps, host, total)
+    """
+    log     = log if log is not None else logging.getLogger(__name__)
+    t0      = time.perf_counter()
+    scpi.write(":SENSe:BANDwidth:RESolution:AUTO ON")
+    scpi.write(":INITiate:CONTinuous OFF")
+    if model is None:
+        model = SweepModel.from_instrument(scpi)
+    span    = float(scpi.query(":SENSe:FREQuency:SPAN?"))
+    bins    = model.points - 1
+    # An RBW narrower than a few bins is sampled too sparsely for the parabola
+    method  = 'trace' if model.rbw(span) >= 3 * span / bins else 'marker'
+    plan    = plan_zoom(span, accuracy, model, method, margin)
+    t_cal   = time.perf_counter() - t0
+
+    sweeps  = []
+    t_host  = 0.0
+
+    def sweep(centre, span):
+        t = time.perf_counter()
+        with scpi.transaction() as tr:
+            if centre is not None:
+                tr.write(f":SENSe:FREQuency:CENTer {centre}")
+                tr.write(f":SENSe:FREQuency:SPAN {span}")
+                tr.write(f":SENSe:BANDwidth:RESolution {model.rbw(span)}")
+            tr.write(":INITiate:IMMediate")
+            tr.query("*OPC?")
+        trace   = scpi.read_trace(1)
+        axis    = scpi.freq_axis.get() * 1e6
+        sweeps.append({'centre': centre, 'span': span, 'rbw': model.rbw(span), 'peaks': 0,
+                       'measured': time.perf_counter() - t})
+        return axis, trace
+
+    axis, trace = sweep(None, span)
+    t       = time.perf_counter()
+    if threshold is None:
+        threshold = float(np.median(trace)) + prominence
+    separation = min_separation if min_separation is not None else 2 * model.rbw(span)
+    freq, power = detect_peaks(axis, trace, threshold, prominence, separation, max_peaks)
+    t_host += time.perf_counter() - t
+    sweeps[-1]['peaks'] = len(freq)
+    error   = np.full(len(freq), BIN_ERROR[method] * span / bins)   # Of each peak (Hz)
+    log.info(f"find_carriers: {len(freq)} peaks, zoom spans {[f'{s:.4g}' for s in plan]} Hz")
+
+    for level, zoom in enumerate(plan):
+        if len(freq) == 0:
+            break
+        guard   = min(margin * error.max(initial=0.0), zoom / 2)
+        groups  = group_peaks(freq, zoom, guard)
+        separation = min_separation if min_separation is not None else 2 * model.rbw(zoom)
+        found   = []
+        # Serpentine order: the next step starts where the previous one ended
+        for centre, index in (groups if level % 2 == 0 else groups[::-1]):
+            axis, trace = sweep(centre, zoom)
+            t       = time.perf_counter()
+            # Peaks resolved by the narrower RBW (e.g. a spur next to a carrier)
+            found.append(detect_peaks(axis, trace, threshold, prominence, separation))
+            for i in index:
+                # Window of the peak: +-guard, and not past the middle to its neighbours
+                lo  = max(freq[i] - guard, (freq[i - 1] + freq[i]) / 2 if i > 0 else -np.inf)
+                hi  = min(freq[i] + guard, (freq[i] + freq[i + 1]) / 2 if i < len(freq) - 1 else np.inf)
+                a, b = np.searchsorted(axis, (lo, hi))
+                if b - a > 0:
+                    freq[i], power[i] = peak_interp(axis[a:b], trace[a:b])
+                    error[i]    = BIN_ERROR['trace'] * zoom / bins
+            t_host += time.perf_counter() - t
+            sweeps[-1]['peaks'] = len(index)
+        t       = time.perf_counter()
+        new_freq    = np.concatenate([f for f, _ in found])
+        new_power   = np.concatenate([p for _, p in found])
+        distance    = np.abs(new_freq[:, None] - freq[None, :]).min(axis=1, initial=np.inf)
+        new         = distance > max(separation, guard)
+        if new.any() and (max_peaks is None or len(freq) < max_peaks):
+            # 3 point estimates: half a bin
+            freq    = np.concatenate([freq, new_freq[new]])
+            power   = np.concatenate([power, new_power[new]])
+            error   = np.concatenate([error, np.full(new.sum(), BIN_ERROR['marker'] * zoom / bins)])
+            order   = np.argsort(freq)
+            if max_peaks is not None and len(freq) > max_peaks:
+                # The strongest max_peaks, in frequency order
+                top     = np.argsort(power)[-max_peaks:]
+                order   = top[np.argsort(freq[top])]
+            freq, power, error = freq[order], power[order], error[order]
+            log.info(f"find_carriers: {new.sum()} more peaks at span {zoom:.4g} Hz")
+        t_host += time.perf_counter() - t
+        log.debug(f"find_carriers: span {zoom:.4g} Hz: {len(groups)} sweeps")
+
+    total   = time.perf_counter() - t0
+    return {'carriers': [{'freq': float(f), 'power': float(p), 'accuracy': float(e)}
+                         for f, p, e in zip(freq, power, error)],
+            'sweeps': sweeps,
+            'timing': {'calibration': t_cal, 'sweeps': sum(s['measured'] for s in sweeps), 'host': t_host,
+                       'total': total}}
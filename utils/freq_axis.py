@@ -0,0 +1,73 @@
+import numpy as np
+
+from python_rf_course.utils.scpi_cache import (normalize_header, parse_value, split_command, cacheable,
+                                               SAFE_HEADERS)
+
+# Settings that define the trace frequency axis (normalized headers)
+AXIS_HEADERS = ('FREQ:CENT', 'FREQ:SPAN', 'FREQ:STAR', 'FREQ:STOP', 'SWE:POIN')
+
+
+class FrequencyAxis:
+    """
+    Frequency axis of the analyzer trace, owned by the analyzer session (SCPIWrapper.freq_axis).
+    It is rebuilt only when a centre, span, start, stop or points setting changes
+    (or a command with unknown side effects is sent). A new centre with a known span
+    moves the axis without a query. The array is read-only and shared by all users.
+    """
+    def __init__(self, scpi, scale = 1e-6):
+        self.scpi       = scpi
+        self.scale      = scale # Hz to the axis unit (MHz)
+        self.start      = None  # Hz
+        self.stop       = None  # Hz
+        self.points     = None
+        self._array     = None
+        self.rebuilds   = 0     # Number of times the array was built (for diagnostics)
+
+    def invalidate(self):
+        self.start      = None
+        self._array     = None
+
+    def recenter(self, center: float):
+        if self.start is None:
+            return
+        half            = (self.stop - self.start) / 2
+        self.start      = center - half
+        self.stop       = center + half
+        self._array     = None
+
+    def written(self, cmd: str):
+        # Called by the SCPI wrapper for every command sent to the instrument
+        header, arg = split_command(cmd)
+        if header.endswith('?'):
+            return
+        key         = normalize_header(header)
+        if key == 'FREQ:CENT' and arg is not None:
+            value = parse_value(arg)
+            if isinstance(value, float):
+                self.recenter(value)
+                return
+        if key in AXIS_HEADERS or (not cacheable(key) and not key.startswith(SAFE_HEADERS)):
+            self.invalidate()
+
+    def read(self):
+        # Single round trip for the three settings
+        with self.scpi.transaction() as t:
+            t.query(":SENSe:FREQuency:STARt?")
+            t.query(":SENSe:FREQuency:STOP?")
+            t.query(":SENSe:SWEep:POINts?")
+        self.start      = float(t.answers[0])
+        self.stop       = float(t.answers[1])
+        self.points     = int(float(t.answers[2]))
+        self._array     = None
+
+    def get(self) -> np.ndarray:
+        """
+        :return: Read-only frequency axis (MHz by default)
+        """
+        if self.start is None:
+            self.read()
+        if self._array is None:
+            self._array = np.linspace(self.start * self.scale, self.stop * self.scale, self.points)
+            self._array.flags.writeable = False
+            self.rebuilds += 1
+        return self._array
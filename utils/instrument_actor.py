@@ -0,0 +1,133 @@
+import itertools
+import logging
+import queue
+import threading
+from concurrent.futures import Future
+
+# One I/O thread per instrument session. The thread owns the VISA resource and serves a priority queue
+# of requests, so the GUI thread never blocks on the instrument and the live view and a scan thread
+# can share the instrument: every request (a single message or a whole job) runs alone on the bus.
+#
+#     actor   = InstrumentActor(rm.open_resource(...), name='SA', log=log)
+#     scpi_sa = SCPIWrapper(instr=actor.resource(), log=log, name='SA')   # blocking calls, from any thread
+#     future  = actor.submit(job, priority=HIGH)                          # job() runs on the I/O thread
+#     future  = actor.submit_latest('trace', read_trace, priority=LOW)    # periodic poll (coalesced)
+
+HIGH    = 0 # User actions
+NORMAL  = 1 # Scans
+LOW     = 2 # Live view polls
+_STOP   = 99
+
+
+class _Request:
+    def __init__(self, fn, args, kwargs, key = None):
+        self.fn     = fn
+        self.args   = args
+        self.kwargs = kwargs
+        self.key    = key
+        self.future = Future()
+
+
+class InstrumentActor:
+    def __init__(self, instr, name = 'SCPI', log = None):
+        self.instr  = instr
+        self.name   = name
+        self.log    = log if log is not None else logging.getLogger(__name__)
+        self.queue  = queue.PriorityQueue()
+        self.seq    = itertools.count()     # FIFO order within a priority
+        self.lock   = threading.Lock()
+        self.latest = {}                    # Coalescing key -> queued request
+        self.thread = threading.Thread(target=self._run, name=f"{name} I/O", daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            _, _, request = self.queue.get()
+            if request is None:
+                break
+            if request.key is not None:
+                with self.lock:
+                    if self.latest.get(request.key) is request:
+                        del self.latest[request.key]
+            if not request.future.set_running_or_notify_cancel():
+                continue
+            try:
+                request.future.set_result(request.fn(*request.args, **request.kwargs))
+            except BaseException as e:
+                request.future.set_exception(e)
+
+    def submit(self, fn, *args, priority: int = NORMAL, **kwargs) -> Future:
+        """
+        Run fn(*args, **kwargs) on the I/O thread.
+        :return: Future with the result
+        """
+        request = _Request(fn, args, kwargs)
+        self.queue.put((priority, next(self.seq), request))
+        return request.future
+
+    def submit_latest(self, key, fn, *args, priority: int = LOW, **kwargs) -> Future:
+        """
+        Like submit(), but a request with the same key that is still queued is replaced
+        (its future is returned), so a slow instrument is not flooded by a periodic poll.
+        """
+        with self.lock:
+            request = self.latest.get(key)
+            if request is not None:
+                request.fn, request.args, request.kwargs = fn, args, kwargs
+                return request.future
+            request = self.latest[key] = _Request(fn, args, kwargs, key)
+        self.queue.put((priority, next(self.seq), request))
+        return request.future
+
+    def call(self, fn, *args, priority: int = NORMAL, timeout: float = None, **kwargs):
+        # Blocking call (runs inline when called from the I/O thread itself, e.g. inside a job)
+        if threading.current_thread() is self.thread:
+            return fn(*args, **kwargs)
+        return self.submit(fn, *args, priority=priority, **kwargs).result(timeout)
+
+    def resource(self, priority: int = NORMAL):
+        return ActorResource(self, priority)
+
+    def stop(self, timeout: float = None):
+        # Queued requests are served before the thread exits
+        self.queue.put((_STOP, next(self.seq), None))
+        if threading.current_thread() is not self.thread:
+            self.thread.join(timeout)
+
+
+class ActorResource:
+    """
+    pyvisa resource API served by the actor (each call is one request), e.g. as SCPIWrapper(instr=...)
+    """
+    def __init__(self, actor: InstrumentActor, priority: int = NORMAL):
+        self.actor      = actor
+        self.priority   = priority
+
+    @property
+    def timeout(self):
+        return self.actor.instr.timeout
+
+    @timeout.setter
+    def timeout(self, value):
+        self.actor.call(setattr, self.actor.instr, 'timeout', value, priority=self.priority)
+
+    def _call(self, method: str, *args, **kwargs):
+        return self.actor.call(getattr(self.actor.instr, method), *args, priority=self.priority, **kwargs)
+
+    def write(self, *args, **kwargs):
+        return self._call('write', *args, **kwargs)
+
+    def query(self, *args, **kwargs):
+        return self._call('query', *args, **kwargs)
+
+    def read(self, *args, **kwargs):
+        return self._call('read', *args, **kwargs)
+
+    def query_ascii_values(self, *args, **kwargs):
+        return self._call('query_ascii_values', *args, **kwargs)
+
+    def query_binary_values(self, *args, **kwargs):
+        return self._call('query_binary_values', *args, **kwargs)
+
+    def close(self):
+        return self._call('close')
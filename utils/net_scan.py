@@ -0,0 +1,230 @@
+import time
+
+import numpy as np
+import pyvisa
+
+from python_rf_course.utils.async_scpi import gather_transactions
+
+# Filter response scan engine (no Qt): the SG steps through the scan frequencies and the SA measures the
+# output of the filter. The results are reported to handler(event, *args), the GUI thread (LongProcess)
+# forwards the events to its signals and the command line runner (scan_cli) writes them out.
+#
+#     engine = NetScanEngine(f_scan, scpi_sa, scpi_sg, mode='list', handler=lambda event, *args: ...)
+#     engine.run()                                  # engine.stop() from another thread
+#
+# Events:
+#     log       message (str)
+#     progress  percent (int)
+#     point     i, freq (MHz), power (dBm) of a measured point
+#     data      freq, power arrays of the scan so far (partial updates and the complete scan at the end)
+
+# List mode: the points of one SG sweep are at least SEPARATION RBW apart, so the RBW skirt of a point
+# is below the filter stopband at its neighbours
+SEPARATION      = 4
+SWEEP_OVERHEAD  = 5e-3  # s, SA retrace and re-arm between the continuous sweeps
+
+
+def extract_response(axis: np.ndarray, trace: np.ndarray, f: np.ndarray, rbw: float) -> np.ndarray:
+    """
+    Power at the scan frequencies: maximum of the (max hold) trace within +-RBW/2 of each one (vectorized).
+    :param axis: Trace frequency axis (sorted)
+    :param f: Scan frequencies (same unit as the axis and the RBW)
+    """
+    last    = len(trace) - 1
+    lo      = np.clip(np.searchsorted(axis, f - rbw / 2), 0, last)
+    hi      = np.clip(np.searchsorted(axis, f + rbw / 2, 'right'), lo + 1, last + 1)
+    # reduceat over the (lo, hi) pairs, the trace is padded for hi = len(trace)
+    padded  = np.append(trace, -np.inf)
+    return np.maximum.reduceat(padded, np.stack((lo, hi), axis=1).ravel())[::2]
+
+
+class NetScanEngine:
+    def __init__(self, f_scan,scpi_sa, scpi_sg, mode = 'point', rbw = 1.0, concurrent = False, handler = None):
+        """
+        :param mode: 'point' - SG and SA retune at every point (reference), 'list' - SG step sweeps while
+                     the SA sweeps the band in max hold, the response is extracted from the trace
+        :param rbw: SA RBW of the list mode (MHz). A wider RBW sweeps faster, but takes more SG sweeps
+                    (the points of a sweep are SEPARATION RBW apart) and raises the noise floor.
+        :param concurrent: Point mode: the SG retunes and settles (*OPC?) while the SA retunes (asyncio.gather,
+                           both instruments are async_scpi.SyncSCPIClient on the same loop)
+        :param handler: handler(event, *args) of the results (see the events above)
+        """
+        self.f_scan     = f_scan
+        self.scpi_sa    = scpi_sa
+        self.scpi_sg    = scpi_sg
+        self.mode       = mode
+        self.rbw        = rbw
+        self.concurrent = concurrent
+        self.handler    = handler
+
+        self.running    = False
+
+    def emit(self, event: str, *args):
+        if self.handler is not None:
+            self.handler(event, *args)
+
+    def run(self):
+        # Save the instrument attributes for recall at the end of the scan
+        self.running = True
+        self.emit('log', f"Thread: Starting scan ({self.mode} mode)")
+
+        # Set RF output on
+        with self.scpi_sg.transaction():
+            self.scpi_sg.write(":OUTPUT:STATE ON")
+            self.scpi_sg.write(":OUTPUT:MOD:STATE OFF")
+        if self.mode == 'list':
+            freq, power = self.scan_list()
+        else:
+            freq, power = self.scan_point()
+
+        # Report any errors left in the queues
+        self.scpi_sa.check_errors()
+        self.scpi_sg.check_errors()
+        # Emit the data signal
+        self.emit('data', freq, power)
+
+    def set_level(self, peak_value: float, set_level: float) -> float:
+        # Set the reference level 10 dB above the peak
+        max_level  = np.ceil( peak_value/10 + 1)*10
+        if set_level != max_level:
+            self.emit('log', f"Thread: Setting reference level to {max_level}")
+            self.scpi_sa.write(f"DISP:WIND:TRAC:Y:RLEV {max_level}")
+        return max_level
+
+    def scan_point(self):
+        with self.scpi_sa.transaction():
+            # set the RBW
+            self.scpi_sa.write("sense:BANDwidth:RESolution 0.1 MHz")
+            self.scpi_sa.write("sense:DETEctor AVERage")
+            # Trace Clear/write mode
+            self.scpi_sa.write("TRACe:MODE WRITe")
+            self.scpi_sa.write("INITiate:CONTinuous OFF")
+
+        # Create a list to store the scan data
+        power = np.array([])
+        freq  = np.array([])
+        for i, f in enumerate(self.f_scan):
+            retune = [f"sense:FREQuency:CENTer {f} MHz", "sense:FREQuency:SPAN 5 MHz"]
+            if self.concurrent:
+                # SG retune and settle at the same time as the SA retune, the sweep starts after both
+                gather_transactions((self.scpi_sg, [f"freq {f} MHz", "*OPC?"]), (self.scpi_sa, retune))
+                retune = []
+            else:
+                # Set the SG to the frequency of the current scan point
+                self.scpi_sg.write(f"freq {f} MHz")
+            try:
+                # Single round trip for the SA retune, sweep and peak search
+                with self.scpi_sa.transaction() as t:
+                    # Set the SA center frequency and the span
+                    for cmd in retune:
+                        t.write(cmd)
+                    # Initiate a single sweep
+                    t.write("INITiate:IMMediate")
+                    t.query("*OPC?")
+                    # Set marker to peak
+                    t.write("CALCulate:MARKer:MAXimum")
+                    # Get the peak value and the reference level
+                    t.query("CALCulate:MARKer:Y?")
+                    t.query("DISP:WIND:TRAC:Y:RLEV?")
+                _, peak_value, set_level = [float(a) for a in t.answers]
+            except pyvisa.errors.VisaIOError:
+                self.emit('log', f"Thread: OPC Failed at {f} MHz")
+                self.scpi_sa.write("CALCulate:MARKer:MAXimum")
+                peak_value = float(self.scpi_sa.query("CALCulate:MARKer:Y?").strip())
+                set_level  = float(self.scpi_sa.query(f"DISP:WIND:TRAC:Y:RLEV?").strip() )
+
+            # Set the reference level
+            self.set_level(peak_value, set_level)
+            # save the peak value and frequency
+            power = np.append(power, peak_value)
+            freq  = np.append(freq, f)
+            self.emit('point', i, f, peak_value)
+            # Drain the SG error queue once per point (the SA is checked at its *OPC? sync points)
+            self.scpi_sg.check_errors()
+
+            if i%20==0:
+                self.emit('data', freq, power)
+
+            # Update the progress bar
+            self.emit('progress', 100 * (i + 1) // len(self.f_scan))
+            if not self.running:
+                break
+        return freq, power
+
+    def scan_list(self):
+        f_scan  = np.asarray(self.f_scan, dtype=np.float64)
+        n       = len(f_scan)
+        step    = (f_scan[-1] - f_scan[0]) / (n - 1) if n > 1 else self.rbw
+        # SA: the whole band (and one RBW on each side), two trace points per RBW, positive peak detector
+        span    = f_scan[-1] - f_scan[0] + 2 * self.rbw
+        points  = int(np.clip(np.ceil(2 * span / self.rbw) + 1, 1001, 40001))
+        with self.scpi_sa.transaction() as t:
+            t.write("INITiate:CONTinuous OFF")
+            t.write(f"sense:FREQuency:CENTer {(f_scan[0] + f_scan[-1]) / 2} MHz")
+            t.write(f"sense:FREQuency:SPAN {span} MHz")
+            t.write(f"sense:BANDwidth:RESolution {self.rbw} MHz")
+            t.write(f"sense:SWEep:POINts {points}")
+            t.write("sense:DETEctor POSitive")
+            t.query("sense:BANDwidth:RESolution?")
+            t.query("sense:SWEep:TIME?")
+            t.query("DISP:WIND:TRAC:Y:RLEV?")
+        rbw         = float(t.answers[0]) / 1e6     # MHz, as set by the analyzer
+        sweep_time  = float(t.answers[1])
+        set_level   = float(t.answers[2])
+        # Each SG point is on for at least one full SA sweep
+        dwell   = 2 * sweep_time + SWEEP_OVERHEAD
+        # Points closer than SEPARATION RBW go to different SG sweeps (interleaved)
+        passes  = min(n, max(1, int(np.ceil(SEPARATION * rbw / step))))
+        self.emit('log', f"Thread: {passes} SG sweeps, dwell {dwell * 1e3:.1f} ms, about {n * dwell:.1f} s")
+
+        # Points not measured yet (later passes, stopped scan) are NaN: not drawn by the plots
+        power   = np.full(n, np.nan)
+        for k in range(passes):
+            f_pass  = f_scan[k::passes]
+            # SG step sweep through the points of the pass, starting from its first point
+            with self.scpi_sg.transaction() as t:
+                t.write(f"freq {f_pass[0]} MHz")
+                t.write(":LIST:TYPE STEP")
+                t.write(f":FREQ:STARt {f_pass[0]} MHz")
+                t.write(f":FREQ:STOP {f_pass[-1]} MHz")
+                t.write(f":SWEep:POINts {max(len(f_pass), 2)}")
+                t.write(f":SWEep:DWELl {dwell}")
+                t.write(":FREQ:MODE LIST")
+            # Restart the max hold (continuous SA sweeps), then start the SG sweep
+            with self.scpi_sa.transaction() as t:
+                t.write("TRACe:MODE WRITe")
+                t.write("TRACe:MODE MAXHold")
+                t.write("INITiate:CONTinuous ON")
+            self.scpi_sg.write(":INITiate:IMMediate")
+            t_end = time.perf_counter() + max(len(f_pass), 2) * dwell
+            while self.running and time.perf_counter() < t_end:
+                time.sleep(min(0.1, max(t_end - time.perf_counter(), 0.0)))
+                done = 1 - max(t_end - time.perf_counter(), 0.0) / (max(len(f_pass), 2) * dwell)
+                self.emit('progress', int(100 * (k + done) / passes))
+            if not self.running:
+                self.scpi_sa.write("INITiate:CONTinuous OFF")
+                break
+            # Wait for the end of the SG sweep, then stop the SA on the max hold trace
+            self.scpi_sg.query("*OPC?")
+            self.scpi_sa.write("INITiate:CONTinuous OFF")
+            trace   = self.scpi_sa.read_trace(1)
+            axis    = self.scpi_sa.freq_axis.get()
+            power[k::passes] = extract_response(axis, trace, f_pass, rbw)
+            for i in range(k, n, passes):
+                self.emit('point', i, f_scan[i], power[i])
+            self.scpi_sg.check_errors()
+
+            # The reference level of the next SG sweeps
+            set_level = self.set_level(power[k::passes].max(), set_level)
+            self.emit('data', f_scan, power)
+            self.emit('progress', 100 * (k + 1) // passes)
+
+        # Back to CW and a write mode trace for the point mode and the GUI
+        self.scpi_sg.write(":FREQ:MODE CW")
+        self.scpi_sa.write("TRACe:MODE WRITe")
+        return f_scan, power
+
+
+    def stop(self):
+        self.running = False
+
@@ -0,0 +1,109 @@
+import math
+
+import numpy as np
+from scipy.optimize import least_squares
+
+# Model based search of the output 1 dB compression point of an amplifier.
+# The gain compression of the points measured so far is fitted with the Rapp AM/AM model and the next
+# drive level is the 1 dB point of the fit (a Newton step on the model), so 2-3 sweeps replace the
+# bisection (about 7 sweeps for 0.1 dB from an 11 dB range).
+#
+#     def measure(p_in):                      # Output power (dBm) at the input power p_in (dBm)
+#         ...
+#     result = find_op1db(measure, p_ref, gain_ref, p_start=p_nominal)
+#     print(result['op1db'], result['points'])
+
+PRIOR_WEIGHT = 0.05     # dB of compression per unit of smoothness away from the prior (weak)
+
+
+def log10_1p_exp10(x):
+    # log10(1 + 10^x) without overflow
+    return np.logaddexp(0.0, np.asarray(x) * math.log(10)) / math.log(10)
+
+def rapp_compression(p_in, p_sat_in: float, p: float):
+    """
+    Gain compression of the Rapp model (dB): (10/p)*log10(1 + 10^(p*(p_in - p_sat_in)/10))
+    :param p_sat_in: Input power at which the linear output would reach Psat (dBm)
+    :param p: Smoothness
+    """
+    return (10 / p) * log10_1p_exp10(p * (np.asarray(p_in) - p_sat_in) / 10)
+
+def fit_rapp(p_in, compression, p_ref: float, smoothness: float = 2.0):
+    """
+    Rapp parameters of the compression measured relative to the gain at p_ref.
+    The smoothness is pulled to its prior, so a single point fits p_sat_in at the prior smoothness.
+    :return: p_sat_in (dBm), smoothness
+    """
+    p_in        = np.asarray(p_in, dtype=np.float64)
+    compression = np.asarray(compression, dtype=np.float64)
+
+    def residual(v):
+        model = rapp_compression(p_in, v[0], v[1]) - rapp_compression(p_ref, v[0], v[1])
+        return np.append(model - compression, PRIOR_WEIGHT * (v[1] - smoothness))
+
+    # Start from the strongest point at the prior smoothness
+    k       = int(np.argmax(p_in))
+    c       = max(compression[k], 0.05)
+    x       = (10 / smoothness) * math.log10(10 ** (smoothness * c / 10) - 1)
+    fit     = least_squares(residual, [p_in[k] - x, smoothness], bounds=([-np.inf, 0.3], [np.inf, 20.0]))
+    return float(fit.x[0]), float(fit.x[1])
+
+def op1db_input(p_sat_in: float, p: float, p_ref: float, target: float = 1.0) -> float:
+    # Input power at which the gain is compressed by target dB relative to the gain at p_ref (closed form)
+    c = target + float(rapp_compression(p_ref, p_sat_in, p))
+    return p_sat_in + (10 / p) * math.log10(10 ** (p * c / 10) - 1)
+
+
+def find_op1db(measure, p_ref: float, gain_ref: float, p_start: float, p_min: float = -math.inf,
+               p_max: float = math.inf, resolution: float = 0.1, smoothness: float = 2.0,
+               window: float = None, max_steps: int = 6, log = None) -> dict:
+    """
+    Output 1 dB compression point (relative to the small signal gain measured at p_ref).
+    Each step measures at the 1 dB point predicted by the fit of all the points so far and stops when the
+    measured point is within resolution (input referred) of the new prediction.
+    :param measure: measure(p_in) -> output power (dBm)
+    :param p_ref: Input power of the small signal gain (dBm)
+    :param gain_ref: Small signal gain (dB)
+    :param p_start: First input power (dBm), e.g. the nominal drive
+    :param p_min: Drive range (dBm)
+    :param resolution: Input referred resolution (dB)
+    :param smoothness: Prior of the Rapp smoothness (e.g. the fit of the previous frequency)
+    :param window: Half width (dB) of the search window around p_start (warm start, default: the drive range).
+                   A step clipped to the window edge twice in a row widens the window to the prediction.
+    :return: dict: op1db (dBm, output; the last measured output if not converged, e.g. at the range limit),
+             p_in (dBm, input at the 1 dB point), uncertainty (dB, input referred distance of the last
+             measured point), smoothness, converged, points (list of (p_in, p_out, compression) measured)
+    """
+    points  = []
+    p_in    = float(np.clip(p_start, p_min, p_max))
+    centre  = p_in
+    lo, hi  = p_min, p_max
+    if window is not None:
+        lo, hi = max(centre - window, p_min), min(centre + window, p_max)
+    for _ in range(max_steps):
+        p_out   = measure(p_in)
+        points.append((p_in, p_out, gain_ref - (p_out - p_in)))
+        p_sat_in, p = fit_rapp([q[0] for q in points], [q[2] for q in points], p_ref, smoothness)
+        p_1db   = op1db_input(p_sat_in, p, p_ref)
+        uncertainty = abs(p_1db - p_in)
+        if log is not None:
+            log.debug(f"find_op1db: {p_in:.2f} dBm -> {points[-1][2]:.2f} dB, 1 dB point at {p_1db:.2f} dBm "
+                      f"(smoothness {p:.2f})")
+        if uncertainty < resolution:
+            break
+        p_next  = float(np.clip(p_1db, lo, hi))
+        if p_next == p_in:
+            # The 1 dB point is still past the window edge: widen the window until it holds the prediction
+            while not lo <= p_1db <= hi and (lo > p_min or hi < p_max):
+                window *= 2
+                lo, hi  = max(centre - window, p_min), min(centre + window, p_max)
+            p_next  = float(np.clip(p_1db, lo, hi))
+            if log is not None:
+                log.debug(f"find_op1db: window {lo:.2f} - {hi:.2f} dBm")
+        if p_next == p_in:
+            # The 1 dB point is out of the drive range
+            break
+        p_in    = p_next
+    converged = uncertainty < resolution
+    return {'op1db': p_1db + gain_ref - 1 if converged else points[-1][1], 'p_in': p_1db,
+            'uncertainty': uncertainty, 'smoothness': p, 'converged': converged, 'points': points}
@@ -0,0 +1,117 @@
+import math
+
+# Device under test models for the instrument simulator (see scpi_simulator).
+# A model maps the tones at its input to the tones at its output: list of (frequency Hz, power dBm).
+
+# Power amplifiers of Day2/CreatePaDataBase.m (gain dB, OIP3 dBm, P1dB dBm at 1500 MHz)
+PA_DATABASE = {
+    'SN1234': {'G': 21.1, 'OIP3': 23.2, 'P1dB': 14.3},
+    'SN4321': {'G': 22.8, 'OIP3': 25.5, 'P1dB': 16.0},
+    'SN2222': {'G': 23.7, 'OIP3': 26.1, 'P1dB': 17.5},
+    'SN3333': {'G': 23.4, 'OIP3': 25.9, 'P1dB': 19.4},
+    'SN4444': {'G': 22.5, 'OIP3': 28.1, 'P1dB': 20.1},
+}
+
+def db10(x: float) -> float:
+    return 10 * math.log10(x) if x > 0 else -math.inf
+
+def lin10(x: float) -> float:
+    return 10 ** (x / 10)
+
+def power_sum(levels) -> float:
+    # Total power (dBm) of a list of levels (dBm)
+    return db10(sum(lin10(p) for p in levels))
+
+
+class RappPA:
+    """
+    Power amplifier with the Rapp AM/AM model (smoothness p):
+        Pout = Pin + G - (10/p)*log10(1 + 10^(p*(Pin + G - Psat)/10))
+    Psat is set so that the gain is compressed by 1 dB at the output power OP1dB.
+    Third and fifth order products of tone pairs are set by OIP3 and OIP5.
+    Gain and P1dB drop above f_ref (dB/GHz) as in Day2/CreatePaDataBase.m.
+    """
+    def __init__(self, gain = 21.1, op1db = 14.3, oip3 = 23.2, oip5 = None, smoothness = 2.0,
+                 f_ref = 1500.0, gain_slope = 2.0, p1db_slope = 1.0):
+        self.gain       = gain          # dB
+        self.op1db      = op1db         # dBm
+        self.oip3       = oip3          # dBm
+        self.oip5       = oip5 if oip5 is not None else oip3 - 2.0 # dBm
+        self.p          = smoothness
+        self.f_ref      = f_ref         # MHz
+        self.gain_slope = gain_slope    # dB/GHz above f_ref
+        self.p1db_slope = p1db_slope    # dB/GHz above f_ref
+
+    @classmethod
+    def from_database(cls, sn: str, **kwargs):
+        pa = PA_DATABASE[sn]
+        return cls(gain=pa['G'], op1db=pa['P1dB'], oip3=pa['OIP3'], **kwargs)
+
+    def _drop(self, f_mhz: float) -> float:
+        return max(0.0, f_mhz - self.f_ref) / 1000
+
+    def gain_db(self, f_mhz: float) -> float:
+        return self.gain - self.gain_slope * self._drop(f_mhz)
+
+    def op1db_dbm(self, f_mhz: float) -> float:
+        return self.op1db - self.p1db_slope * self._drop(f_mhz)
+
+    def psat_dbm(self, f_mhz: float) -> float:
+        # Output (linear gain) 1 dB above OP1dB is compressed by 1 dB
+        x = (10 / self.p) * math.log10(10 ** (self.p / 10) - 1)
+        return self.op1db_dbm(f_mhz) + 1 - x
+
+    def compression(self, p_in: float, f_mhz: float) -> float:
+        """
+        :param p_in: Total input power (dBm)
+        :param f_mhz: Frequency (MHz)
+        :return: Gain compression (dB)
+        """
+        x = self.p * (p_in + self.gain_db(f_mhz) - self.psat_dbm(f_mhz)) / 10
+        # log10(1 + 10^x) without overflow
+        return (10 / self.p) * (x + math.log10(1 + 10 ** -x) if x > 30 else math.log10(1 + 10 ** x))
+
+    def output(self, tones):
+        if not tones:
+            return []
+        p_in    = power_sum(p for _, p in tones)
+        f_mean  = sum(f * lin10(p) for f, p in tones) / sum(lin10(p) for _, p in tones) / 1e6
+        comp    = self.compression(p_in, f_mean)
+        out     = [(f, p + self.gain_db(f / 1e6) - comp) for f, p in tones]
+
+        # Intermodulation of the strongest tone pairs (2f1-f2 and 3f1-2f2)
+        products = []
+        strong   = sorted(out, key=lambda t: -t[1])[:4]
+        for f1, p1 in strong:
+            for f2, p2 in strong:
+                if f1 == f2:
+                    continue
+                products.append((2 * f1 - f2, 2 * p1 + p2 - 2 * self.oip3))
+                products.append((3 * f1 - 2 * f2, 3 * p1 + 2 * p2 - 4 * self.oip5))
+        return out + [(f, p) for f, p in products if f > 0]
+
+
+class BandpassFilter:
+    """
+    Butterworth band pass filter (for the network measurement of Ex5)
+    """
+    def __init__(self, f0 = 900.0, bw = 20.0, order = 3, insertion_loss = 1.5):
+        self.f0     = f0    # MHz
+        self.bw     = bw    # MHz (3 dB bandwidth)
+        self.order  = order
+        self.il     = insertion_loss # dB
+
+    def response_db(self, f_mhz: float) -> float:
+        if f_mhz <= 0:
+            return -math.inf
+        x = (f_mhz / self.f0 - self.f0 / f_mhz) * self.f0 / self.bw
+        return -self.il - db10(1 + x ** (2 * self.order))
+
+    def output(self, tones):
+        return [(f, p + self.response_db(f / 1e6)) for f, p in tones]
+
+
+class Thru:
+    # Cable (no device): the tones are not changed
+    def output(self, tones):
+        return list(tones)
@@ -0,0 +1,482 @@
+import numpy as np
+import pyvisa
+
+from python_rf_course.utils.op1db import find_op1db
+from python_rf_course.utils.imd   import measure_imd, oip_summary
+from python_rf_course.utils.multitone import multitone
+
+# PA scan engine (no Qt): gain, OP1dB, OIP3 and OIP5 at each frequency of the scan.
+# The results are reported to handler(event, *args), the GUI thread (PaScan) forwards the events
+# to its signals and the command line runner (scan_cli) writes them out.
+#
+#     engine = PaScanEngine(f_scan, scpi_sa, scpi_sg, loss=32.5, handler=lambda event, *args: ...)
+#     engine.run()                                  # engine.stop() from another thread
+#
+# Events:
+#     log           message (str)
+#     point         i, POINT_DTYPE record of the new point
+#     csv           freq, gain, op1db, oip3, oip5, oip_sides (Nx4) of the completed points, at the end
+#     lcd_p_out     output power (dBm) of each sweep of the OP1dB search
+#     op1db_points  freq, input power and gain compression of the points of the OP1dB search
+
+# Warm start: half width (dB) of the OP1dB search window around the prediction from the previous frequencies
+WARM_WINDOW = 1.0
+# IMD: each tone of the two tone signal is at most TONE_RANGE dB below the CW output power (checked before
+# the intercepts are computed, warm start offsets included)
+TONE_RANGE  = 20.0
+# Settings of a resumed journal that must be the same as the ones of the scan (they change the results)
+JOURNAL_MATCH = ('loss', 'Ptx', 'ArbFd', 'op1db_method', 'imd_method', 'imd_side')
+# Result of a scan point (the lower/upper intercepts are NaN for the sides not measured)
+POINT_DTYPE = np.dtype([('freq', 'f8'), ('gain', 'f8'), ('p_out', 'f8'), ('op1db', 'f8'), ('oip3', 'f8'),
+                        ('oip5', 'f8'), ('oip3_lower', 'f8'), ('oip3_upper', 'f8'), ('oip5_lower', 'f8'),
+                        ('oip5_upper', 'f8')])
+
+
+def load_two_tone(arb, params: dict):
+    """
+    Load and play the two tone waveform (ArbFd apart) on the signal generator
+    :param arb: pyarbtools VSG of the signal generator
+    """
+    sig = multitone(BW=params['ArbFd'], Ntones=2, Fs=params['ArbFs'], Nfft=2048)
+    arb.configure(fs=params['ArbFs']*1e6, iqScale=70 )
+    arb.download_wfm(sig, wfmID='TwoTones')
+    arb.set_alcState(0) # ALC Off (DO not use bool)
+    arb.play('TwoTones')
+
+def play_two_tone(scpi_sg, params: dict):
+    # The TwoTones waveform is already in the signal generator memory (no download, no pyarbtools)
+    with scpi_sg.transaction():
+        scpi_sg.write(f":RADio:ARB:SCLock:RATE {params['ArbFs']} MHz")
+        scpi_sg.write(':RADio:ARB:WAVeform "WFM1:TwoTones"')
+        scpi_sg.write(":RADio:ARB:STATe ON")
+
+def setup_pa_bench(scpi_sa, scpi_sg, params: dict, p_tx: float):
+    """
+    SA span (holds the IM5 products), RBW, detector and centre, SG power and frequency,
+    both states are saved to register 1 (recalled when a scan is stopped)
+    :param p_tx: SG output power (dBm)
+    """
+    # Set the signal generator to output power
+    scpi_sg.write(f":POW:LEV {p_tx} dBm")
+    # Set the spectrum analyzer span and RBW detector AVG and trace to clear/write
+    span = params['ArbFd']*5.0 + 2.0 # Contains the 5th harmonic
+    # Send the SA setup sequence as a single message
+    with scpi_sa.transaction():
+        scpi_sa.write(f"freq:span {span} MHz")
+        scpi_sa.write(f"sense:BANDwidth:RESolution {params['ArbFd']/8.0} MHz") # Maximal RBW for the scan
+        scpi_sa.write("sense:DETEctor AVERage")
+        scpi_sa.write("TRACe:MODE WRITe")
+        scpi_sa.write("INITiate:CONTinuous On")
+        # Set the spectrum analyzer center frequency
+        scpi_sa.write(f"freq:cent {params['Fnominal']} MHz")
+        # Save the spectrum analyzer state
+        scpi_sa.write("*SAV 1")
+    # Set the signal generator frequency and save its state
+    with scpi_sg.transaction():
+        scpi_sg.write(f"freq {params['Fnominal']} MHz")
+        scpi_sg.write("*SAV 1")
+    return span
+
+
+class PaScanEngine:
+    def __init__(self, f_scan,scpi_sa, scpi_sg, loss = 0, op1db_method = 'model', warm_start = False,
+                 imd_method = 'trace', imd_side = 'worst', journal = None, settings = None, step = None,
+                 handler = None):
+        """
+        :param op1db_method: 'model' - Rapp fit of the measured points (2-3 sweeps), 'binary' - bisection
+        :param imd_method: 'trace' - one binary trace fetch, products of both sides located on the host,
+                           'marker' - marker peak search and the upper products only
+        :param imd_side: OIP3/OIP5 reported from the 'worst' or the 'mean' side (trace method)
+        :param warm_start: Seed each frequency from the previous ones: the reference level from the gain, a narrow
+                           OP1dB window (model method) and the subcarrier offsets of the IMD markers
+        :param journal: ScanJournal: each completed point is appended, the points already in the journal
+                        (resume) are not measured again
+        :param settings: Setup recorded in the journal (e.g. the YAML parameters)
+        :param step: step(fn, *args) runs each scan step (the setup, one point, the final error check) as a whole,
+                     e.g. InstrumentActor.call, so the requests of other users (live view) only run between
+                     the steps (default: called directly)
+        :param handler: handler(event, *args) of the results (see the events above)
+        """
+        self.f_scan     = f_scan
+        self.scpi_sa    = scpi_sa
+        self.scpi_sg    = scpi_sg
+        self.loss       = loss
+        self.op1db_method = op1db_method
+        self.warm_start = warm_start
+        self.imd_method = imd_method
+        self.imd_side   = imd_side
+        self.journal    = journal
+        self.settings   = settings or {}
+        self.step       = step
+        self.handler    = handler
+        # Warm start state: (freq, input 1 dB point) of the converged searches, Rapp smoothness, subcarrier offsets
+        self.history    = []
+        self.smoothness = 2.0
+        self.offsets    = None
+        # Scan results, preallocated (NaN until measured)
+        self.results    = np.full(len(f_scan), np.nan, dtype=POINT_DTYPE)
+
+        self.running    = False
+
+    def emit(self, event: str, *args):
+        if self.handler is not None:
+            self.handler(event, *args)
+
+    def run(self):
+        try:
+            self.scan()
+        except Exception as e:
+            self.emit('log', f"Thread: Scan failed: {e}")
+            raise
+        finally:
+            # The completed points are in the journal (resume from the next one)
+            if self.journal is not None:
+                self.journal.close(stopped=len(self.journal.completed) < len(self.f_scan))
+
+    def begin_journal(self):
+        # Plan, instruments and settings of a new journal (checked against the plan and settings of a resumed one)
+        with self.scpi_sa.transaction() as t:
+            t.query("*IDN?")
+        with self.scpi_sg.transaction() as u:
+            u.query("*IDN?")
+        settings = dict(self.settings, loss=self.loss, op1db_method=self.op1db_method,
+                        warm_start=self.warm_start, imd_method=self.imd_method, imd_side=self.imd_side)
+        self.journal.begin(plan=dict(freq=np.asarray(self.f_scan, dtype=np.float64).tolist()),
+                           instruments=dict(SA=t.answers[0].strip(), SG=u.answers[0].strip()), settings=settings,
+                           match=JOURNAL_MATCH)
+        # Results of the completed points
+        for i, row in self.journal.completed.items():
+            self.results[i] = tuple(row.get(name, np.nan) for name in POINT_DTYPE.names)
+            self.emit('point', i, self.results[i].copy())
+        if self.journal.completed:
+            self.emit('log', f"Thread: Resuming scan, {len(self.journal.completed)} of {len(self.f_scan)} points done")
+
+    def scan(self):
+        # Save the instrument attributes for recall at the end of the scan
+        self.running = True
+        self.emit('log', "Thread: Starting scan")
+
+        p_tx_nominal = self.run_step(self.setup_scan)
+
+        # Scan data (one POINT_DTYPE row per frequency)
+        results = self.results
+        results[:]      = np.nan
+        self.history    = []
+        self.offsets    = None
+        if self.journal is not None:
+            self.run_step(self.begin_journal)
+        for i, f in enumerate(self.f_scan):
+            if self.journal is not None and i in self.journal.completed:
+                continue
+            self.run_step(self.measure_point, i, f, p_tx_nominal)
+
+            # Durable record of the point before it is reported
+            if self.journal is not None:
+                self.journal.append(i, results[i])
+            # The GUI appends the new row to its series (plots and LCDs are redrawn on its timer)
+            self.emit('point', i, results[i].copy())
+            if not self.running:
+                break
+
+        # Report any errors left in the queues
+        self.run_step(self.check_errors)
+        # Dump the data to a CSV file
+        done    = results[~np.isnan(results['freq'])]
+        sides   = np.stack([done[name] for name in ('oip3_lower', 'oip3_upper', 'oip5_lower', 'oip5_upper')], axis=1)
+        self.emit('csv', done['freq'], done['gain'], done['op1db'], done['oip3'], done['oip5'], sides)
+
+    def measure_point(self, i: int, f: float, p_tx_nominal: float):
+        # Gain, OP1dB and OIP3/OIP5 of scan point i into self.results
+        results = self.results
+        # Set the SG to the frequency of the current scan point and power level
+        p_tx = p_tx_nominal - 5 # Check gain at low power
+        with self.scpi_sg.transaction():
+            self.scpi_sg.write(f"POW:LEV {p_tx}")
+            self.scpi_sg.write(f"freq {f} MHz")
+            # Small signal gain
+            self.scpi_sg.write(":OUTPUT:MOD:STATE OFF") # Modulation off
+
+        # Set the SA center frequency
+        self.scpi_sa.write(f"sense:FREQuency:CENTer {f} MHz")
+        if self.warm_start and i > 0 and not np.isnan(results['gain'][i - 1]):
+            # Reference level predicted from the previous gain (not written if unchanged)
+            gain_p = results['gain'][i - 1]
+            self.scpi_sa.write(f"DISP:WIND:TRAC:Y:RLEV {np.ceil((p_tx + gain_p - self.loss)/10 + 1)*10}")
+
+        peak_value = self.sa_sweep_marker_max()
+
+        # Set the reference level
+        max_level  = np.ceil( peak_value/10 + 1)*10
+        set_level  = float(self.scpi_sa.query(f"DISP:WIND:TRAC:Y:RLEV?") )
+        if set_level != max_level:
+            self.emit('log', f"Thread: Setting reference level to {max_level}")
+            self.scpi_sa.write(f"DISP:WIND:TRAC:Y:RLEV {max_level}")
+        # save the peak value and frequency
+        gain_i = peak_value + self.loss - p_tx
+        results['freq'][i]  = f
+        results['gain'][i]  = gain_i
+        results['p_out'][i] = peak_value + self.loss
+        self.emit('lcd_p_out', peak_value + self.loss)
+        # OP1dB
+        if self.op1db_method == 'binary':
+            op1dB_i = self.find_op1db_binary_search(p_tx_nominal - 6, p_tx_nominal + 5, gain_i)
+        else:
+            result  = self.find_op1db_model(f, p_tx, gain_i, p_tx_nominal)
+            op1dB_i = result['op1db']
+            if result['converged']:
+                self.history.append((f, result['p_in']))
+                self.smoothness = result['smoothness']
+        results['op1db'][i] = op1dB_i
+        # # Slow scan increase power by 0.1 dB Gheck the gain drop until it is 1 dB
+        # for p_tx in np.arange(p_tx_nominal - 3, p_tx_nominal + 5, 0.1):
+        #     self.scpi_sg.write(f"POW:LEV {p_tx}")
+        #     peak_value  = self.sa_sweep_marker_max()
+        #     gain_i      = peak_value  + self.loss - p_tx
+        #     gain_diff   = gain[-1] - gain_i
+        #     # Check if the gain has dropped by 1 dB
+        #     if gain_diff >= 1:
+        #         op1dB_i = peak_value  + self.loss
+        #         op1dB = np.append(op1dB, op1dB_i )
+        #         self.lcd_op1dB.emit(op1dB_i)
+        #         break
+        # else:
+        #     op1dB_i = peak_value + self.loss
+        #     op1dB   = np.append(op1dB, op1dB_i)
+        #     self.lcd_op1dB.emit(op1dB_i)
+        #
+
+        # OIP3 and OIP5
+        # Modulation On and tx power to nominal
+        with self.scpi_sg.transaction():
+            self.scpi_sg.write(":OUTPUT:MOD:STATE ON")
+            self.scpi_sg.write(f"POW:LEV {p_tx_nominal}")
+        p_out   = results['p_out'][i]
+        carried = self.offsets if self.warm_start else None
+        if self.imd_method == 'trace':
+            found = False
+            if carried is not None:
+                result = measure_imd(self.scpi_sa, loss=self.loss, tones=f * 1e6 + carried)
+                found  = self.tones_found(p_out, result['tones'], carried[1] - carried[0])
+                if not found:
+                    self.emit('log', f"Thread: No tones at the previous offsets ({f} MHz), full search")
+            if not found:
+                try:
+                    result = measure_imd(self.scpi_sa, loss=self.loss)
+                    found  = self.tones_found(p_out, result['tones'])
+                except ValueError:
+                    # Fewer than two peaks in the trace
+                    found  = False
+            if found:
+                self.offsets = result['tones'][:, 0] - f * 1e6
+                sides  = np.concatenate([result['oip'][3], result['oip'][5]])
+                oip3_i = oip_summary(result['oip'][3], self.imd_side)
+                oip5_i = oip_summary(result['oip'][5], self.imd_side)
+                self.emit('log', f"Thread: OIP3 {sides[0]:.2f} / {sides[1]:.2f} dBm, OIP5 {sides[2]:.2f} / "
+                              f"{sides[3]:.2f} dBm (lower / upper), IM3 asymmetry {result['asymmetry'][3]:.2f} dB")
+        else:
+            found = False
+            if carried is not None:
+                # Subcarriers at the offsets found at the previous frequency: the sweep and all the markers
+                # in a single round trip
+                f_sub_l, f_sub_h = f * 1e6 + carried
+                f_oip3 = f_sub_h + (f_sub_h - f_sub_l)
+                f_oip5 = f_sub_h + (f_sub_h - f_sub_l)*2
+                p_l, p_i, p_i3, p_i5 = [p + self.loss for p in
+                                        self.sa_sweep_markers([f_sub_l, f_sub_h, f_oip3, f_oip5])]
+                found = self.tones_found(p_out, np.array([[f_sub_l, p_l], [f_sub_h, p_i]]), f_sub_h - f_sub_l)
+                if not found:
+                    self.emit('log', f"Thread: No tones at the previous offsets ({f} MHz), full search")
+            if not found:
+                tones, p_i3, p_i5 = self.imd_markers(f)
+                p_i   = tones[1, 1]
+                found = self.tones_found(p_out, tones)
+            oip3_i = p_i + (p_i - p_i3)/2
+            oip5_i = p_i + (p_i - p_i5)/4
+            sides  = np.array([np.nan, oip3_i, np.nan, oip5_i])
+
+        if not found:
+            # No two tone signal (e.g. the modulation or the waveform is off): no intercept, full search next time
+            self.emit('log', f"Thread: Two tones not found at {f} MHz")
+            self.offsets = None
+            oip3_i = oip5_i = np.nan
+            sides  = np.full(4, np.nan)
+        results['oip3'][i]  = oip3_i
+        results['oip5'][i]  = oip5_i
+        for name, value in zip(('oip3_lower', 'oip3_upper', 'oip5_lower', 'oip5_upper'), sides):
+            results[name][i] = value
+        # Drain the SG error queue once per point (the SA is checked at its *OPC? sync points)
+        self.scpi_sg.check_errors()
+
+    def imd_markers(self, f: float):
+        """
+        Full search of the two subcarriers with the markers (peak, next peak), then the IM3 and IM5 markers
+        :return: Subcarriers (2x2: frequency, power at the DUT output of the lower and upper one),
+                 power of the IM3 and the IM5 product (dBm)
+        """
+        peak_value = self.sa_sweep_marker_max()
+        with self.scpi_sa.transaction() as t:
+            # Get the frequency of subcarrier 1
+            t.query("CALCulate:MARKer:X?")
+            # Next peak twice (OIP3)
+            t.write("CALCulate:MARKer:MAXimum:NEXT")
+            # Get the frequency and the level of subcarrier 2
+            t.query("CALCulate:MARKer:X?")
+            t.query("CALCulate:MARKer:Y?")
+        freq_sig1, freq_sig2, peak_2 = [float(a) for a in t.answers]
+        tones   = np.array([[freq_sig1, peak_value], [freq_sig2, peak_2]])
+        tones   = tones[np.argsort(tones[:, 0])]
+        tones[:, 1] += self.loss
+        f_sub_l, f_sub_h = tones[:, 0]
+        self.offsets = tones[:, 0] - f * 1e6
+        # Set the marker to OIP3 (sub_h + (sub_h - sub_l)) and OIP5 (sub_h + (sub_h - sub_l)*2)
+        f_oip3 = f_sub_h + (f_sub_h - f_sub_l)
+        f_oip5 = f_sub_h + (f_sub_h - f_sub_l)*2
+        with self.scpi_sa.transaction() as t:
+            t.write(f"CALCulate:MARKer:X {f_oip3} Hz")
+            t.query("CALCulate:MARKer:Y?")
+            t.write(f"CALCulate:MARKer:X {f_oip5} Hz")
+            t.query("CALCulate:MARKer:Y?")
+        # Get the peak values
+        p_i3        = float(t.answers[0]) + self.loss
+        p_i5        = float(t.answers[1]) + self.loss
+        return tones, p_i3, p_i5
+
+    def tones_found(self, p_out: float, tones, spacing: float = None) -> bool:
+        """
+        Check of a two tone measurement: two distinct tones (spacing within 1/8 of the expected one), each at most
+        TONE_RANGE dB below the CW output power. The noise floor, the skirt or a single unmodulated carrier fail.
+        :param tones: 2x2: frequency (Hz), power (dBm) of the lower and upper tone
+        :param spacing: Expected tone spacing (Hz), default: any spacing
+        """
+        d = tones[1, 0] - tones[0, 0]
+        if not (d > 0 if spacing is None else abs(d - spacing) < spacing / 8):
+            return False
+        return bool(np.all(tones[:, 1] > p_out - TONE_RANGE))
+
+    def setup_scan(self) -> float:
+        # Set RF output on
+        self.scpi_sg.write(":OUTPUT:STATE ON")
+        with self.scpi_sa.transaction():
+            self.scpi_sa.write("sense:DETEctor AVERage")
+            # Trace Clear/write mode
+            self.scpi_sa.write("TRACe:MODE WRITe")
+            self.scpi_sa.write("INITiate:CONTinuous OFF")
+        # Nominal SG power
+        return float(self.scpi_sg.query("POW:LEV?"))
+
+    def check_errors(self):
+        self.scpi_sa.check_errors()
+        self.scpi_sg.check_errors()
+
+    def run_step(self, fn, *args):
+        # A scan step runs as a whole (e.g. a job of the SA InstrumentActor, see step)
+        return fn(*args) if self.step is None else self.step(fn, *args)
+
+    def predict_op1db_input(self, f):
+        # Input 1 dB point extrapolated (linear in frequency) from the previous frequencies
+        f1, p1 = self.history[-1]
+        if len(self.history) > 1 and self.history[-2][0] != f1:
+            f0, p0 = self.history[-2]
+            return p1 + (p1 - p0) * (f - f1) / (f1 - f0)
+        return p1
+
+    def find_op1db_model(self, f, p_ref, gain_ref, p_tx_nominal, resolution=0.1):
+        # Rapp model fit of the points measured so far, the next power at the predicted 1 dB point
+        def measure(p):
+            self.scpi_sg.write(f"POW:LEV {p}")
+            peak_value  = self.sa_sweep_marker_max()
+            self.emit('lcd_p_out', peak_value + self.loss)
+            return peak_value + self.loss
+
+        if self.warm_start and self.history:
+            # Narrow window around the prediction (widened if the 1 dB point is past its edge)
+            result  = find_op1db(measure, p_ref, gain_ref, p_start=self.predict_op1db_input(f),
+                                 p_min=p_tx_nominal - 6, p_max=p_tx_nominal + 5, resolution=resolution,
+                                 smoothness=self.smoothness, window=WARM_WINDOW)
+        else:
+            result  = find_op1db(measure, p_ref, gain_ref, p_start=p_tx_nominal, p_min=p_tx_nominal - 6,
+                                 p_max=p_tx_nominal + 5, resolution=resolution)
+        points  = np.array(result['points'])
+        self.emit('op1db_points', float(f), points[:, 0], points[:, 2])
+        self.emit('log', f"Thread: OP1dB {result['op1db']:.2f} dBm at {f} MHz from {len(points)} points "
+                      f"({', '.join(f'{p:.2f} dBm: {c:.2f} dB' for p, _, c in result['points'])})"
+                      + ("" if result['converged'] else ", not converged"))
+        return result
+
+    def find_op1db_binary_search(self, p_tx_start, p_tx_end, gain_ref, resolution=0.1):
+        low     = p_tx_start
+        high    = p_tx_end
+        op1dB_i = None
+
+        while high - low > resolution:
+            mid = (low + high) / 2
+
+            # Set the power level and measure gain
+            self.scpi_sg.write(f"POW:LEV {mid}")
+            peak_value  = self.sa_sweep_marker_max()
+            gain_i      = peak_value + self.loss - mid
+            gain_diff   = gain_ref - gain_i
+            self.emit('lcd_p_out', peak_value + self.loss)
+
+            # Check if we found the 1dB compression point
+            if gain_diff >= 1:
+                # We've exceeded 1dB compression, search lower
+                high    = mid
+                op1dB_i = peak_value + self.loss
+            else:
+                # Not yet at 1dB compression, search higher
+                low = mid
+
+        # Final measurement at the determined power level
+        if op1dB_i is None:
+            # If we didn't find a point with 1dB compression, use the highest power
+            self.scpi_sg.write(f"POW:LEV {high}")
+            peak_value  = self.sa_sweep_marker_max()
+            op1dB_i     = peak_value + self.loss
+
+        return op1dB_i
+
+    def sa_sweep_marker_max(self):
+        # Single round trip: sweep, wait, marker to peak and read the peak value
+        try:
+            with self.scpi_sa.transaction() as t:
+                # Initiate a single sweep
+                t.write("INITiate:IMMediate")
+                t.query("*OPC?")
+                # Set marker to peak
+                t.write("CALCulate:MARKer:MAXimum")
+                # Get the peak value
+                t.query("CALCulate:MARKer:Y?")
+        except pyvisa.errors.VisaIOError:
+            self.emit('log', f"Thread: OPC Failed")
+            # Read the marker once the sweep is done
+            self.scpi_sa.write("CALCulate:MARKer:MAXimum")
+            return float(self.scpi_sa.query("CALCulate:MARKer:Y?"))
+
+        peak_value = float(t.answers[-1])
+
+        return peak_value
+
+    def sa_sweep_markers(self, freqs):
+        # Single round trip: sweep, wait and read the trace at the marker frequencies (Hz)
+        try:
+            with self.scpi_sa.transaction() as t:
+                t.write("INITiate:IMMediate")
+                t.query("*OPC?")
+                for f in freqs:
+                    t.write(f"CALCulate:MARKer:X {f} Hz")
+                    t.query("CALCulate:MARKer:Y?")
+        except pyvisa.errors.VisaIOError:
+            self.emit('log', f"Thread: OPC Failed")
+            values = []
+            for f in freqs:
+                self.scpi_sa.write(f"CALCulate:MARKer:X {f} Hz")
+                values.append(float(self.scpi_sa.query("CALCulate:MARKer:Y?")))
+            return values
+
+        return [float(a) for a in t.answers[1:]]
+
+
+    def stop(self):
+        self.running = False
+
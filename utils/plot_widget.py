@@ -74,13 +74,13 @@ class PlotWidget(QWidget):
         self.plot_widget.addLegend()
 
         if not just_markers:
-            self.plot_widget.plot(x.flatten(), y.flatten(),
-                                  pen=pg.mkPen(line[0], width=line_width, style=style_dict[line[1:]]),
-                                  name=legend, symbol=symbol)
+            item = self.plot_widget.plot(x.flatten(), y.flatten(),
+                                         pen=pg.mkPen(line[0], width=line_width, style=style_dict[line[1:]]),
+                                         name=legend, symbol=symbol)
         else:
-            self.plot_widget.plot(x.flatten(), y.flatten(),
-                                  pen=None,
-                                  name=legend, symbol=symbol)
+            item = self.plot_widget.plot(x.flatten(), y.flatten(),
+                                         pen=None,
+                                         name=legend, symbol=symbol)
 
         self.plot_widget.setLabel('bottom', xlabel)
         self.plot_widget.setLabel('left', ylabel)
@@ -105,6 +105,8 @@ class PlotWidget(QWidget):
             self.plot_widget.enableAutoRange(axis='y')
 
         self.plot_widget.repaint()
+        # The curve item (item.setData updates it without a redraw of the plot)
+        return item
 
     def ginput(self, n_points=None):
         """
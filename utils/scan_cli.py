@@ -0,0 +1,215 @@
+import argparse
+import csv
+import json
+import logging
+import sys
+import time
+
+import numpy as np
+import pyvisa
+import yaml
+
+from python_rf_course.utils.SCPI_wrapper import SCPIWrapper
+from python_rf_course.utils.pa_scan      import PaScanEngine, POINT_DTYPE, load_two_tone, play_two_tone, setup_pa_bench
+from python_rf_course.utils.net_scan     import NetScanEngine
+from python_rf_course.utils.scan_journal import ScanJournal
+from python_rf_course.utils.async_scpi   import SyncSCPIClient
+
+# Headless scan runner (no Qt, no display): the PA scan of the workshop and the filter response scan of Ex5
+# from the YAML file of the GUI, each point is written to stdout or a file as soon as it is measured.
+#
+#     python -m python_rf_course.utils.scan_cli pa  pa_defaults.yaml  --out pa.csv --format csv
+#     python -m python_rf_course.utils.scan_cli net net_defaults.yaml --set ScanMode=list --sa 10.0.0.26
+#     python -m python_rf_course.utils.scan_cli net net_defaults.yaml --async-io   # concurrent SG/SA retune
+#
+# The instrument addresses are IP_SA/IP_SG of the YAML file (--sa/--sg: an IP or a VISA resource name).
+# The log goes to stderr.
+
+FORMATS = ('jsonl', 'csv')
+
+
+class ResultWriter:
+    """
+    Rows (dict) as JSON lines or CSV (header from the first row), flushed per row
+    """
+    def __init__(self, file, fmt: str = 'jsonl'):
+        self.file   = file
+        self.fmt    = fmt
+        self.writer = None
+
+    def write(self, row: dict):
+        if self.fmt == 'csv':
+            if self.writer is None:
+                self.writer = csv.DictWriter(self.file, fieldnames=list(row))
+                self.writer.writeheader()
+            self.writer.writerow(row)
+        else:
+            self.file.write(json.dumps(row) + '\n')
+        self.file.flush()
+
+
+def resource_name(address: str) -> str:
+    # An IP address (the GUI default: VXI-11) or a full VISA resource name
+    return address if '::' in address else f"TCPIP0::{address}::inst0::INSTR"
+
+def open_instrument(rm, address: str, timeout: int = 60000):
+    name    = resource_name(address)
+    kwargs  = dict(read_termination='\n', write_termination='\n') if name.upper().endswith('SOCKET') else {}
+    instr   = rm.open_resource(name, **kwargs)
+    instr.timeout = timeout
+    return instr
+
+def socket_host(address: str) -> str:
+    # Host of an IP address or a raw socket resource name (TCPIP0::10.0.0.26::5025::SOCKET)
+    return address.split('::')[1] if '::' in address else address
+
+def load_params(path: str, overrides) -> dict:
+    with open(path, "r") as f:
+        params = yaml.safe_load(f)
+    for item in overrides:
+        key, _, value = item.partition('=')
+        params[key] = yaml.safe_load(value)
+    return params
+
+
+def run_pa(params: dict, scpi_sa, scpi_sg, handler, no_arb: bool = False, ip_sg: str = None,
+           journal: ScanJournal = None) -> PaScanEngine:
+    """
+    Reset, two tone waveform and bench setup, then the PA scan (PaScanEngine events to handler)
+    :param no_arb: Play the TwoTones waveform already in the SG memory (no pyarbtools download)
+    :param ip_sg: SG address of the pyarbtools download (default: IP_SG)
+    """
+    f_scan  = np.linspace(params['Fstart'], params['Fstop'], params['Npoints'])
+    # Reset and clear all status (errors) of both instruments
+    for scpi in (scpi_sa, scpi_sg):
+        scpi.write("*RST")
+        scpi.write("*CLS")
+    if no_arb:
+        play_two_tone(scpi_sg, params)
+    else:
+        # Only needed to download the two tone waveform
+        import pyarbtools as arb
+        load_two_tone(arb.instruments.VSG(ip_sg or params['IP_SG'], timeout=5), params)
+    setup_pa_bench(scpi_sa, scpi_sg, params, params['Ptx'])
+    scpi_sa.check_errors()
+    scpi_sg.check_errors()
+
+    engine  = PaScanEngine(f_scan, scpi_sa, scpi_sg, loss=params['Loss'],
+                           op1db_method=params.get('OP1dBMethod', 'model'),
+                           warm_start=params.get('WarmStart', False),
+                           imd_method=params.get('IMDMethod', 'trace'),
+                           imd_side=params.get('IMDSide', 'worst'),
+                           journal=journal, settings=params, handler=handler)
+    engine.run()
+    return engine
+
+
+def run_net(params: dict, scpi_sa, scpi_sg, handler, concurrent: bool = False) -> NetScanEngine:
+    # Reset and the filter response scan (NetScanEngine events to handler, concurrent: see NetScanEngine)
+    f_scan  = np.linspace(params['Fstart'], params['Fstop'], params['Npoints'])
+    for scpi in (scpi_sa, scpi_sg):
+        scpi.write("*RST")
+        scpi.write("*CLS")
+    # Set the signal generator to output power (Pout)
+    scpi_sg.write(f":OUTP:STAT OFF")
+    scpi_sg.write(f":POW:LEV {params['Pout']} dBm")
+
+    engine  = NetScanEngine(f_scan, scpi_sa, scpi_sg, mode=params.get('ScanMode', 'point'),
+                            rbw=params.get('ListRBW', 1.0), concurrent=concurrent, handler=handler)
+    engine.run()
+    return engine
+
+
+def pa_row(row) -> dict:
+    # POINT_DTYPE record -> dict of floats
+    return {name: row[name].item() for name in POINT_DTYPE.names}
+
+
+def main(args, params: dict, scpi_sa, scpi_sg, writer: ResultWriter, log):
+    if args.scan == 'pa':
+        journal = None
+        resume  = args.resume if args.resume is not None else params.get('Resume', '')
+        if args.journal is not None or resume or params.get('Journal', False):
+            path    = resume or args.journal or f"PA_Scan_{time.strftime('%Y%m%d_%H%M%S')}.journal"
+            journal = ScanJournal(path, sync=params.get('JournalSync', 'flush'), resume=bool(resume))
+            log.info(f"Scan journal: {path}")
+
+        def handler(event, *args):
+            if event == 'point':
+                writer.write(dict(i=args[0], **pa_row(args[1])))
+            elif event == 'log':
+                log.info(args[0])
+
+        ip_sg = args.sg if args.sg is not None and '::' not in args.sg else None
+        run_pa(params, scpi_sa, scpi_sg, handler, no_arb=args.no_arb, ip_sg=ip_sg, journal=journal)
+    else:
+        def handler(event, *args):
+            if event == 'point':
+                i, f, power = args
+                # The filter response is relative to the SG power
+                writer.write(dict(i=i, freq=float(f), power=float(power), response=float(power) - params['Pout']))
+            elif event == 'log':
+                log.info(args[0])
+            elif event == 'progress':
+                log.debug(f"Progress {args[0]}%")
+
+        run_net(params, scpi_sa, scpi_sg, handler, concurrent=args.async_io)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Headless PA / filter response scan from a YAML plan")
+    parser.add_argument('scan', choices=('pa', 'net'), help="pa - gain, OP1dB, OIP3, OIP5; net - filter response")
+    parser.add_argument('plan', help="YAML file (pa_defaults.yaml, net_defaults.yaml)")
+    parser.add_argument('--out', default='-', help="Output file (default: stdout)")
+    parser.add_argument('--format', choices=FORMATS, default='jsonl')
+    parser.add_argument('--sa', help="SA address (IP or VISA resource name), default IP_SA")
+    parser.add_argument('--sg', help="SG address (IP or VISA resource name), default IP_SG")
+    parser.add_argument('--set', action='append', default=[], metavar='KEY=VALUE', help="Override a plan value")
+    parser.add_argument('--no-arb', action='store_true',
+                        help="pa: play the TwoTones waveform already in the SG memory (no pyarbtools download)")
+    parser.add_argument('--journal', help="pa: journal file (default: Journal/Resume of the plan)")
+    parser.add_argument('--resume', help="pa: journal of a stopped scan to resume")
+    parser.add_argument('--async-io', action='store_true',
+                        help="Raw socket (port 5025) asyncio client; net: concurrent SG/SA retune")
+    parser.add_argument('--timeout', type=int, default=60000, help="VISA timeout (ms)")
+    parser.add_argument('-v', '--verbose', action='store_true')
+    args    = parser.parse_args()
+
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO, stream=sys.stderr,
+                        format='%(asctime)s %(levelname)s %(message)s')
+    log     = logging.getLogger('scan_cli')
+    params  = load_params(args.plan, args.set)
+
+    rm      = pyvisa.ResourceManager('@py')
+    ip_sa   = args.sa if args.sa is not None else params['IP_SA']
+    ip_sg   = args.sg if args.sg is not None else params['IP_SG']
+    try:
+        if args.async_io:
+            # Both instruments on the shared event loop (see async_scpi)
+            sa  = SyncSCPIClient(socket_host(ip_sa), timeout=args.timeout / 1000, name='SA', log=log)
+            sg  = SyncSCPIClient(socket_host(ip_sg), timeout=args.timeout / 1000, name='SG', log=log)
+        else:
+            sa  = open_instrument(rm, ip_sa, args.timeout)
+            sg  = open_instrument(rm, ip_sg, args.timeout)
+    except (pyvisa.errors.VisaIOError, OSError) as e:
+        log.error(f"Failed to connect to the instruments: {e}")
+        sys.exit(1)
+    scpi_sa = SCPIWrapper(instr=sa, log=log, name='SA', error_check='sync', cache=True)
+    scpi_sg = SCPIWrapper(instr=sg, log=log, name='SG', error_check='sync', cache=True)
+    log.info(f"Connected to SA: {scpi_sa.query('*IDN?').strip()} | SG: {scpi_sg.query('*IDN?').strip()}")
+
+    out     = sys.stdout if args.out == '-' else open(args.out, 'w', newline='')
+    status  = 0
+    try:
+        main(args, params, scpi_sa, scpi_sg, ResultWriter(out, args.format), log)
+    except KeyboardInterrupt:
+        # The measured points are written (and in the journal of a PA scan)
+        log.warning("Scan stopped")
+        status = 130
+    finally:
+        if out is not sys.stdout:
+            out.close()
+        sa.close()
+        sg.close()
+        rm.close()
+    sys.exit(status)
@@ -0,0 +1,149 @@
+import argparse
+import json
+import os
+import time
+
+import numpy as np
+
+# Append-only journal of a scan: one JSON line per record, each completed point is written (and synced,
+# see SYNC_POLICIES) as soon as it is measured, so a crash or a stop loses at most the point in progress
+# and the scan can be resumed from the journal.
+#
+#     journal = ScanJournal('pa_scan.journal', sync='flush', resume=True)
+#     journal.begin(plan=dict(freq=list(f_scan)), instruments={'SA': idn_sa}, settings=dict(loss=32.5),
+#                   match=('loss',))     # a resumed journal must have the same plan and loss
+#     for i, f in enumerate(f_scan):
+#         if i in journal.completed:
+#             continue
+#         ...
+#         journal.append(i, row)                  # dict or numpy structured record
+#     journal.close()
+#
+# Records (type field):
+#     plan    First line: version, created, plan (the scan points), instruments (IDN), settings
+#     resume  The scan was resumed (time, number of completed points)
+#     point   i (index in the plan), time, row (field: value, NaN allowed)
+#     end     time, completed, stopped
+
+VERSION         = 1
+# none  - buffered by Python (lost if the process crashes)
+# flush - each point is passed to the OS (survives a crash of the process)
+# fsync - each point is on the disk (survives a power loss, slower)
+SYNC_POLICIES   = ('none', 'flush', 'fsync')
+
+
+class ScanJournal:
+    """
+    Scan journal file (JSON lines)
+    :param sync: See SYNC_POLICIES
+    :param resume: Load the completed points of an existing journal (a new journal is created if the file
+                   does not exist), otherwise the file is overwritten
+    """
+    def __init__(self, path: str, sync: str = 'flush', resume: bool = False):
+        if sync not in SYNC_POLICIES:
+            raise ValueError(f"Error: Unknown journal sync policy {sync}")
+        self.path       = path
+        self.sync       = sync
+        self.header     = None
+        self.completed  = {}    # Index in the plan -> row (dict)
+        self.ended      = None  # End record of the last run of a resumed journal (None: not ended, e.g. a crash)
+        self.file       = None
+        if resume and os.path.exists(path):
+            self._load()
+        self.file       = open(path, 'ab' if self.header is not None else 'wb')
+
+    def _load(self):
+        # Read the records, a torn last line (crash during a write) is cut from the file
+        good = 0
+        with open(self.path, 'rb') as file:
+            for line in file:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    break
+                if not line.endswith(b'\n'):
+                    break
+                good += len(line)
+                if record['type'] == 'plan':
+                    self.header = record
+                elif record['type'] == 'point':
+                    self.completed[record['i']] = record['row']
+                elif record['type'] in ('resume', 'end'):
+                    self.ended = record if record['type'] == 'end' else None
+        # An empty file (a scan that failed before its plan record) is a new journal
+        if self.header is None and os.path.getsize(self.path) > 0:
+            raise ValueError(f"Error: {self.path} is not a scan journal")
+        if good < os.path.getsize(self.path):
+            with open(self.path, 'r+b') as file:
+                file.truncate(good)
+
+    def _write(self, record: dict, sync: str = None):
+        self.file.write((json.dumps(record) + '\n').encode('utf-8'))
+        sync = self.sync if sync is None else sync
+        if sync != 'none':
+            self.file.flush()
+        if sync == 'fsync':
+            os.fsync(self.file.fileno())
+
+    def begin(self, plan: dict, instruments: dict = None, settings: dict = None, match=()):
+        """
+        Write the plan record of a new journal, or check that a resumed journal has the same plan and settings.
+        :param plan: Scan points (e.g. freq list), compared on resume
+        :param instruments: Instrument name -> IDN string
+        :param settings: Scan settings (loss, power, methods, ...)
+        :param match: Keys of the settings compared on resume (the ones that change the results)
+        """
+        plan     = json.loads(json.dumps(plan))
+        settings = json.loads(json.dumps(settings or {}))
+        if self.header is not None:
+            if self.header['plan'] != plan:
+                raise ValueError(f"Error: The scan plan differs from the plan of {self.path}")
+            recorded = self.header.get('settings', {})
+            differ   = [f"{key} {settings.get(key)!r} (journal {recorded.get(key)!r})" for key in match
+                        if settings.get(key) != recorded.get(key)]
+            if differ:
+                raise ValueError(f"Error: The scan settings differ from the settings of {self.path}: "
+                                 f"{', '.join(differ)}")
+            self._write(dict(type='resume', time=time.time(), completed=len(self.completed)), 'fsync')
+            return
+        self.header = dict(type='plan', version=VERSION, created=time.time(), plan=plan,
+                           instruments=instruments or {}, settings=settings)
+        self._write(self.header, 'fsync')
+
+    def append(self, i: int, row):
+        # Completed point i of the plan
+        if isinstance(row, np.void):
+            row = {name: row[name].item() for name in row.dtype.names}
+        self._write(dict(type='point', i=int(i), time=time.time(), row=row))
+        self.completed[int(i)] = row
+
+    def close(self, stopped: bool = False):
+        if self.file is None:
+            return
+        if self.header is not None:
+            self._write(dict(type='end', time=time.time(), completed=len(self.completed), stopped=stopped),
+                        'fsync')
+        self.file.close()
+        self.file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close(stopped=exc_type is not None)
+        return False
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Summary of a scan journal")
+    parser.add_argument('path')
+    journal = ScanJournal(parser.parse_args().path, resume=True)
+    journal.file.close()
+    header  = journal.header
+    n_plan  = len(next(iter(header['plan'].values()), []))
+    print(f"Created {time.ctime(header['created'])}, instruments: {header['instruments']}")
+    print(f"Settings: {header['settings']}")
+    print(f"Completed {len(journal.completed)} of {n_plan} points")
+    missing = [i for i in range(n_plan) if i not in journal.completed]
+    if missing:
+        print(f"Missing: {missing[:20]}{' ...' if len(missing) > 20 else ''}")
@@ -0,0 +1,186 @@
+import argparse
+import json
+import time
+
+import numpy as np
+
+# On-disk storage of a stitched spectrum (segments of equal length, written in any order).
+# The arrays are np.memmap views of the file, so the RAM use does not depend on the scan size
+# and a file can be reopened for analysis without loading it.
+#
+#     store = ScanStore.create('survey.scan', n_segments, n_points, start=f0, step=df, rbw=0.001)
+#     store.power[i * n_points:(i + 1) * n_points] = trace   # or read_trace(out=...)
+#     store.commit(i)
+#     freq, power = store.decimated(4096)                     # peak preserving view for the plot
+#
+#     store = ScanStore('survey.scan')                        # read-only
+#     freq, power = store.segment(12)
+#
+# File layout:
+#     header   HEADER_SIZE bytes: MAGIC + JSON (n_segments, n_points, overview, start, step, unit, user metadata)
+#     segments n_segments x SEGMENT_DTYPE: start frequency, step and flags of each segment
+#     overview n_segments x overview float32: peak of each segment in 'overview' bins (fast wide views)
+#     power    n_segments x n_points float32 (dBm)
+
+MAGIC           = b'RFSCAN1\n'
+HEADER_SIZE     = 4096
+SEGMENT_DTYPE   = np.dtype([('start', '<f8'), ('step', '<f8'), ('flags', '<u4'), ('reserved', '<u4')])
+
+# Segment flags
+WRITTEN         = 1
+COARSE          = 2 # Filled from a coarse (low resolution) sweep
+
+
+class ScanStore:
+    """
+    Stitched spectrum in a memory mapped file
+    :param mode: 'r' - read only, 'r+' - read/write
+    """
+    def __init__(self, path: str, mode: str = 'r'):
+        self.path       = path
+        self.mode       = mode
+        with open(path, 'rb') as file:
+            head = file.read(HEADER_SIZE)
+        if not head.startswith(MAGIC):
+            raise ValueError(f"Error: {path} is not a scan store file")
+        self.header     = json.loads(head[len(MAGIC):].rstrip(b' ').decode('utf-8'))
+        self.n_segments = self.header['n_segments']
+        self.n_points   = self.header['n_points']
+        self.n_overview = self.header['overview']
+
+        offset          = HEADER_SIZE
+        self.segments   = np.memmap(path, dtype=SEGMENT_DTYPE, mode=mode, offset=offset,
+                                    shape=(self.n_segments,))
+        offset         += self.segments.nbytes
+        self.overview   = np.memmap(path, dtype='<f4', mode=mode, offset=offset,
+                                    shape=(self.n_segments, self.n_overview))
+        offset         += self.overview.nbytes
+        # Flat array (the scan writes each segment at its offset)
+        self.power      = np.memmap(path, dtype='<f4', mode=mode, offset=offset,
+                                    shape=(self.n_segments * self.n_points,))
+        # Overview bin edges within a segment
+        self.edges      = np.linspace(0, self.n_points, self.n_overview + 1).astype(int)
+
+    @classmethod
+    def create(cls, path: str, n_segments: int, n_points: int, start: float = 0.0, step: float = 1.0,
+               overview: int = 16, unit: str = 'MHz', **meta):
+        """
+        Create a store file (the file is sparse until the segments are written).
+        The segments are set contiguous: segment i starts at start + i * (n_points - 1) * step,
+        set_axis() changes the axis of a segment.
+        :param meta: Metadata saved in the header (RBW, detector, ...)
+        """
+        overview    = max(1, min(overview, n_points))
+        header      = dict(version=1, n_segments=n_segments, n_points=n_points, overview=overview,
+                           start=start, step=step, unit=unit, created=time.time(), **meta)
+        text        = MAGIC + json.dumps(header).encode('utf-8')
+        if len(text) > HEADER_SIZE:
+            raise ValueError("Error: Scan store metadata is too long")
+        size        = HEADER_SIZE + n_segments * (SEGMENT_DTYPE.itemsize + 4 * overview + 4 * n_points)
+        with open(path, 'wb') as file:
+            file.write(text.ljust(HEADER_SIZE, b' '))
+            file.truncate(size)
+        store = cls(path, 'r+')
+        store.segments['start'] = start + np.arange(n_segments) * (n_points - 1) * step
+        store.segments['step']  = step
+        return store
+
+    @property
+    def written(self) -> np.ndarray:
+        return (self.segments['flags'] & WRITTEN) != 0
+
+    def set_axis(self, i: int, start: float, step: float):
+        self.segments['start'][i]   = start
+        self.segments['step'][i]    = step
+
+    def commit(self, i: int, coarse: bool = False):
+        # Segment i is in the power array: update its overview and flags
+        power = self.power[i * self.n_points:(i + 1) * self.n_points]
+        self.overview[i]            = np.maximum.reduceat(power, self.edges[:-1])
+        self.segments['flags'][i]   = WRITTEN | (COARSE if coarse else 0)
+
+    def segment_freq(self, i: int) -> np.ndarray:
+        return self.segments['start'][i] + np.arange(self.n_points) * self.segments['step'][i]
+
+    def segment(self, i: int):
+        """
+        :return: Frequency and power (memmap view) of segment i
+        """
+        return self.segment_freq(i), self.power[i * self.n_points:(i + 1) * self.n_points]
+
+    def decimated(self, max_points: int = 4096, f_min: float = None, f_max: float = None):
+        """
+        Peak preserving view of the written segments: the maximum of each block of points, at its frequency.
+        Wide views are built from the overview (the power array is not read).
+        :return: Frequency and power arrays (at most about max_points)
+        """
+        seg     = self.segments
+        start   = seg['start']
+        stop    = start + (self.n_points - 1) * seg['step']
+        select  = self.written
+        if f_min is not None:
+            select &= stop >= f_min
+        if f_max is not None:
+            select &= start <= f_max
+        index   = np.flatnonzero(select)
+        if len(index) == 0:
+            return np.array([]), np.array([], dtype=np.float32)
+
+        if len(index) * self.n_overview >= max_points:
+            # Overview bins (frequency of the bin centre)
+            power   = np.asarray(self.overview[index])
+            centre  = (self.edges[:-1] + self.edges[1:] - 1) / 2
+        else:
+            # Narrow view: the points of the selected segments
+            rows    = self.power.reshape(self.n_segments, self.n_points)
+            power   = np.asarray(rows[index])
+            centre  = np.arange(self.n_points)
+        freq    = start[index, None] + centre[None, :] * seg['step'][index, None]
+        freq    = freq.ravel()
+        power   = power.ravel()
+        if f_min is not None or f_max is not None:
+            keep    = (freq >= (f_min if f_min is not None else -np.inf)) & \
+                      (freq <= (f_max if f_max is not None else np.inf))
+            freq    = freq[keep]
+            power   = power[keep]
+
+        # Maximum of each block of k points (the last block is padded)
+        k       = -(-len(power) // max_points)
+        if k > 1:
+            blocks  = np.full(-(-len(power) // k) * k, -np.inf, dtype=power.dtype)
+            blocks[:len(power)] = power
+            blocks  = blocks.reshape(-1, k)
+            pick    = np.arange(len(blocks)) * k + np.argmax(blocks, axis=1)
+            freq    = freq[pick]
+            power   = power[pick]
+        return freq, power
+
+    def flush(self):
+        if self.mode != 'r':
+            for a in (self.segments, self.overview, self.power):
+                a.flush()
+
+    def close(self):
+        self.flush()
+        # Release the maps (the file is closed when the arrays are collected)
+        self.segments = self.overview = self.power = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Summary of a scan store file")
+    parser.add_argument('path')
+    store   = ScanStore(parser.parse_args().path)
+    written = store.written
+    print(json.dumps(store.header, indent=1))
+    print(f"Segments written: {written.sum()} of {store.n_segments}, "
+          f"coarse: {((store.segments['flags'] & COARSE) != 0).sum()}")
+    if written.any():
+        freq, power = store.decimated(1)
+        print(f"Peak: {power[0]:.2f} dBm at {freq[0]:.6f} {store.header['unit']}")
@@ -0,0 +1,202 @@
+import math
+import re
+
+# Host side shadow of the instrument settings (keyed by normalized SCPI header).
+#
+# A header is normalized to the SCPI short form of its nodes (FREQuency -> FREQ, RESolution -> RES),
+# numeric suffix 1 removed (TRACe1 -> TRAC), optional nodes removed (SENSe, SOURce, [:LEVel], [:STATe], ...)
+# so that "sense:FREQuency:CENTer", ":SENS:FREQ:CENT" and "freq:cent" share the same cache entry.
+
+# Settings that are kept in the cache (normalized headers)
+CACHEABLE_HEADERS = {
+    'FREQ:CENT', 'FREQ:SPAN', 'FREQ:STAR', 'FREQ:STOP',
+    'BAND:RES', 'BAND:VID', 'SWE:POIN', 'SWE:TIME',
+    'DISP:WIND:TRAC:Y:RLEV', 'DISP:WIND:TRAC:Y:PDIV',
+    'DET', 'DET:TRAC', 'TRAC:TYPE', 'TRAC:MODE', 'INIT:CONT',
+    'FREQ', 'POW', 'OUTP', 'OUTP:MOD',
+}
+
+# Settings whose write also restarts a measurement (TRAC:TYPE MAXH restarts the hold, INIT:CONT ON re-arms
+# the sweep): the write is always sent, the cached value only answers the queries
+RESTART_HEADERS = {'TRAC:TYPE', 'TRAC:MODE', 'INIT:CONT'}
+
+# Trace settings of the other traces (TRAC2:TYPE, TRAC3:MODE, ...) are cached per trace
+_trace_setting_re = re.compile(r'^TRAC\d+:(TYPE|MODE)$')
+
+# Settings changed by the instrument when another setting is written (auto coupling)
+COUPLINGS = {
+    'FREQ:CENT': ('FREQ:STAR', 'FREQ:STOP'),
+    'FREQ:SPAN': ('FREQ:STAR', 'FREQ:STOP', 'BAND:RES', 'BAND:VID', 'SWE:TIME'),
+    'FREQ:STAR': ('FREQ:CENT', 'FREQ:SPAN', 'BAND:RES', 'BAND:VID', 'SWE:TIME'),
+    'FREQ:STOP': ('FREQ:CENT', 'FREQ:SPAN', 'BAND:RES', 'BAND:VID', 'SWE:TIME'),
+    'BAND:RES' : ('BAND:VID', 'SWE:TIME'),
+    'BAND:VID' : ('SWE:TIME',),
+    'SWE:POIN' : ('SWE:TIME',),
+}
+
+# Commands known not to change any of the cached settings (header prefixes).
+# Any other command (*RST, *RCL, FREQ:SPAN:FULL, BAND:RES:AUTO ON, ...) invalidates the whole cache.
+SAFE_HEADERS = ('*CLS', '*OPC', '*WAI', '*SAV', '*IDN', '*ESE', '*SRE', '*STB', '*ESR',
+                'SYST:ERR', 'INIT', 'ABOR', 'CALC:MARK', 'TRAC:DATA', 'TRAC:COPY', 'FORM')
+
+OPTIONAL_ROOT_NODES = ('SENS', 'SOUR')
+OPTIONAL_NODES      = ('SCAL', 'IMM', 'AMPL', 'STAT', 'CW', 'FIX')
+NODE_ALIASES        = {'BWID': 'BAND'}
+
+UNITS = {'HZ': 1.0, 'KHZ': 1e3, 'MHZ': 1e6, 'GHZ': 1e9,
+         'S': 1.0, 'MS': 1e-3, 'US': 1e-6, 'NS': 1e-9,
+         'DBM': 1.0, 'DB': 1.0, 'V': 1.0, 'MV': 1e-3}
+
+_node_re   = re.compile(r'^([A-Z*]+?)(\d*)$')
+_number_re = re.compile(r'^([-+]?(?:\d+\.?\d*|\.\d+)(?:[E][-+]?\d+)?)\s*([A-Z]*)$')
+
+def short_form(mnemonic: str) -> str:
+    # SCPI rule: the short form is the first four characters, or three if the fourth is a vowel
+    mnemonic = mnemonic.upper()
+    if len(mnemonic) <= 4:
+        return mnemonic
+    return mnemonic[:3] if mnemonic[3] in 'AEIOU' else mnemonic[:4]
+
+def normalize_header(header: str) -> str:
+    header  = header.strip().upper().lstrip(':').rstrip('?')
+    if header.startswith('*'):
+        return header
+    nodes   = []
+    for node in header.split(':'):
+        m = _node_re.match(node)
+        if m is None:
+            nodes.append(node)
+            continue
+        name, suffix = m.groups()
+        name = short_form(name)
+        name = NODE_ALIASES.get(name, name)
+        nodes.append(name + ('' if suffix in ('', '1') else suffix))
+
+    if nodes and nodes[0] in OPTIONAL_ROOT_NODES and len(nodes) > 1:
+        nodes = nodes[1:]
+    nodes = [n for i, n in enumerate(nodes) if i == 0 or n not in OPTIONAL_NODES]
+    # POWer[:LEVel]
+    if len(nodes) > 1 and nodes[0] == 'POW' and nodes[1] == 'LEV':
+        del nodes[1]
+    return ':'.join(nodes)
+
+def cacheable(key: str) -> bool:
+    # True if the normalized header is a setting kept in the cache
+    return key in CACHEABLE_HEADERS or _trace_setting_re.match(key) is not None
+
+def restarts(key: str) -> bool:
+    # True if a write of the setting is sent even when the value is current (see RESTART_HEADERS)
+    return key in RESTART_HEADERS or _trace_setting_re.match(key) is not None
+
+def parse_value(arg: str):
+    # Numbers (with unit suffix) are converted to float in base units, ON/OFF to 1/0,
+    # character data to its short form. Anything else is kept as an upper case string.
+    arg = arg.strip().upper()
+    m   = _number_re.match(arg)
+    if m is not None:
+        unit = m.group(2)
+        if unit == '':
+            return float(m.group(1))
+        if unit in UNITS:
+            return float(m.group(1)) * UNITS[unit]
+    if arg == 'ON':
+        return 1.0
+    if arg == 'OFF':
+        return 0.0
+    if re.match(r'^[A-Z]+\d*$', arg):
+        return short_form(arg)
+    return arg
+
+def format_value(value) -> str:
+    if isinstance(value, float):
+        return str(int(value)) if value.is_integer() and abs(value) < 1e15 else repr(value)
+    return value
+
+def same_value(a, b) -> bool:
+    if isinstance(a, float) and isinstance(b, float):
+        return math.isclose(a, b, rel_tol=1e-12, abs_tol=1e-12)
+    return a == b
+
+def split_command(cmd: str):
+    cmd     = cmd.strip()
+    parts   = cmd.split(None, 1)
+    header  = parts[0] if parts else ''
+    arg     = parts[1] if len(parts) > 1 else None
+    return header, arg
+
+
+class StateCache:
+    def __init__(self):
+        self.values     = {}    # normalized header -> value
+        self.hits       = 0     # Writes suppressed and queries answered from the cache
+
+    def key(self, cmd: str):
+        header, _ = split_command(cmd)
+        key       = normalize_header(header)
+        return key if cacheable(key) else None
+
+    def is_current(self, cmd: str) -> bool:
+        # True if the write would not change the instrument setting
+        header, arg = split_command(cmd)
+        key         = self.key(cmd)
+        if key is None or arg is None or header.endswith('?') or key not in self.values or restarts(key):
+            return False
+        current = same_value(self.values[key], parse_value(arg))
+        self.hits += current
+        return current
+
+    def changed(self, commands) -> list:
+        """
+        Commands of a batch without the writes that would not change a setting. Each write is compared
+        with the value left by the commands before it (e.g. FREQ:SPAN 2 MHz;FREQ:SPAN 1 MHz with a span of
+        1 MHz in the cache restores the span).
+        """
+        shadow          = StateCache()
+        shadow.values   = dict(self.values)
+        kept            = []
+        for cmd in commands:
+            if split_command(cmd)[0].endswith('?') or not shadow.is_current(cmd):
+                kept.append(cmd)
+                shadow.written(cmd)
+        self.hits      += shadow.hits
+        return kept
+
+    def answer(self, cmd: str):
+        # The cached answer of a query (None if the query has to be sent)
+        header, _ = split_command(cmd)
+        key       = self.key(cmd)
+        if key is None or not header.endswith('?') or key not in self.values:
+            return None
+        self.hits += 1
+        return format_value(self.values[key])
+
+    def written(self, cmd: str):
+        header, arg = split_command(cmd)
+        if header.endswith('?'):
+            return
+        key         = self.key(cmd)
+        if key is not None and arg is not None:
+            self._changed(key, parse_value(arg))
+        elif not normalize_header(header).startswith(SAFE_HEADERS):
+            # Unknown side effects
+            self.clear()
+
+    def answered(self, cmd: str, ans: str):
+        key = self.key(cmd)
+        if key is not None and split_command(cmd)[0].endswith('?'):
+            self.values[key] = parse_value(ans)
+
+    def _changed(self, key, value):
+        self.values[key] = value
+        for k in COUPLINGS.get(key, ()):
+            self.values.pop(k, None)
+
+    def forget(self, cmd: str):
+        key = self.key(cmd)
+        if key is None:
+            self.clear()
+            return
+        self.values.pop(key, None)
+
+    def clear(self):
+        self.values.clear()
@@ -0,0 +1,266 @@
+import argparse
+import base64
+import gzip
+import json
+import logging
+import threading
+import time
+
+import numpy as np
+import pyvisa
+
+# Record and replay of SCPI sessions (pyvisa resource API).
+#
+# Record a lab run (every write, query and binary block with its timing):
+#     recorder = SessionRecorder('pa_scan.scpi.gz')
+#     sa       = recorder.wrap(rm.open_resource(f"TCPIP0::{ip_sa}::inst0::INSTR"), 'SA')
+#     ...
+#     recorder.close()
+#
+# Replay it without the instruments (as fast as possible or at the recorded instrument pacing):
+#     replay   = SessionReplay('pa_scan.scpi.gz', pacing='fast')
+#     sa       = replay.resource('SA')
+#     ...
+#     replay.check()  # Raises ReplayDivergence if the command stream changed
+#
+# File: gzip JSON lines, a header line and one event per call:
+#     {"res": "SA", "op": "query", "cmd": "*OPC?", "t": 1.234, "dt": 0.051, "ans": "1"}
+# Arrays (query_binary_values / query_ascii_values) are kept as base64 bytes with the numpy dtype.
+
+FORMAT_VERSION = 1
+
+
+class ReplayDivergence(Exception):
+    pass
+
+
+def _encode_array(data) -> dict:
+    data = np.asarray(data)
+    return {'dtype': data.dtype.str, 'data': base64.b64encode(data.tobytes()).decode('ascii')}
+
+def _decode_array(event: dict) -> np.ndarray:
+    return np.frombuffer(base64.b64decode(event['data']), dtype=np.dtype(event['dtype']))
+
+def _container(data: np.ndarray, container):
+    return data if container in (np.array, np.ndarray) else container(data)
+
+
+class SessionRecorder:
+    """
+    Shared event file of the recorded resources
+    """
+    def __init__(self, path: str):
+        self.path   = path
+        self.file   = gzip.open(path, 'wt', encoding='utf-8')
+        self.lock   = threading.Lock()
+        self.t0     = time.perf_counter()
+        self.file.write(json.dumps({'version': FORMAT_VERSION, 'start': time.time()}) + '\n')
+
+    def wrap(self, instr, name: str):
+        return RecordingResource(instr, name, self)
+
+    def record(self, event: dict):
+        with self.lock:
+            if self.file is not None:
+                self.file.write(json.dumps(event, separators=(',', ':')) + '\n')
+
+    def close(self):
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
+
+class RecordingResource:
+    """
+    pyvisa resource wrapper that records every call (see SessionRecorder).
+    Other attributes (timeout, read_termination, ...) are passed to the resource.
+    """
+    def __init__(self, instr, name: str, recorder: SessionRecorder):
+        self.__dict__['instr']      = instr
+        self.__dict__['name']       = name
+        self.__dict__['recorder']   = recorder
+
+    def __getattr__(self, attr):
+        return getattr(self.instr, attr)
+
+    def __setattr__(self, attr, value):
+        setattr(self.instr, attr, value)
+
+    def _call(self, op: str, cmd, fn, encode = None):
+        t       = time.perf_counter()
+        event   = {'res': self.name, 'op': op, 'cmd': cmd, 't': round(t - self.recorder.t0, 6)}
+        try:
+            ans = fn()
+        except (pyvisa.errors.VisaIOError, ValueError) as e:
+            event['error'] = type(e).__name__
+            event['code']  = getattr(e, 'error_code', None)
+            event['msg']   = str(e)
+            raise
+        else:
+            if encode is not None:
+                event.update(encode(ans))
+            elif ans is not None:
+                event['ans'] = ans
+            return ans
+        finally:
+            event['dt'] = round(time.perf_counter() - t, 6)
+            self.recorder.record(event)
+
+    def write(self, cmd: str, *args, **kwargs):
+        return self._call('write', cmd, lambda: self.instr.write(cmd, *args, **kwargs), lambda n: {})
+
+    def query(self, cmd: str, *args, **kwargs):
+        return self._call('query', cmd, lambda: self.instr.query(cmd, *args, **kwargs))
+
+    def read(self, *args, **kwargs):
+        return self._call('read', None, lambda: self.instr.read(*args, **kwargs))
+
+    def query_ascii_values(self, cmd: str, *args, container = np.array, **kwargs):
+        data = self._call('ascii', cmd, lambda: self.instr.query_ascii_values(cmd, *args, container=np.array,
+                                                                               **kwargs), _encode_array)
+        return _container(data, container)
+
+    def query_binary_values(self, cmd: str, *args, container = np.array, **kwargs):
+        data = self._call('binary', cmd, lambda: self.instr.query_binary_values(cmd, *args, container=np.array,
+                                                                                 **kwargs), _encode_array)
+        return _container(data, container)
+
+    def close(self):
+        self.instr.close()
+
+
+class SessionReplay:
+    """
+    Recorded session, served back by ReplayResource objects (one per recorded resource).
+    :param pacing: 'fast' - answer at once, 'real' - take the recorded instrument time of each call
+    :param strict: Raise ReplayDivergence at the first command that differs from the recording
+    """
+    def __init__(self, path: str, pacing: str = 'fast', strict: bool = True, log = None):
+        if pacing not in ('fast', 'real'):
+            raise ValueError(f"Error: Unknown pacing {pacing}")
+        self.path       = path
+        self.pacing     = pacing
+        self.strict     = strict
+        self.log        = log if log is not None else logging.getLogger(__name__)
+        self.divergences= []    # (resource, index, expected event, (op, cmd))
+        self.streams    = {}    # Resource name -> list of events
+        with gzip.open(path, 'rt', encoding='utf-8') as file:
+            self.header = json.loads(file.readline())
+            for line in file:
+                event = json.loads(line)
+                self.streams.setdefault(event['res'], []).append(event)
+        self.resources  = {}
+
+    def resource(self, name: str):
+        if name not in self.resources:
+            self.resources[name] = ReplayResource(self, name, self.streams.get(name, []))
+        return self.resources[name]
+
+    def diverged(self, name: str, index: int, expected, op: str, cmd):
+        self.divergences.append((name, index, expected, (op, cmd)))
+        exp = f"{expected['op']} {expected['cmd']!r}" if expected is not None else 'end of recording'
+        msg = f"{name}: Replay diverged at call {index}: expected {exp}, got {op} {cmd!r}"
+        if self.strict:
+            raise ReplayDivergence(msg)
+        self.log.error(msg)
+
+    def report(self) -> dict:
+        """
+        :return: Per resource recorded and replayed calls, and the divergences
+        """
+        return {'resources': {name: {'recorded': len(events),
+                                     'replayed': self.resources[name].index if name in self.resources else 0}
+                              for name, events in self.streams.items()},
+                'divergences': self.divergences}
+
+    def check(self):
+        # Raise if a call diverged or recorded calls were not replayed
+        report = self.report()
+        missing = {name: r['recorded'] - r['replayed'] for name, r in report['resources'].items()
+                   if r['replayed'] < r['recorded']}
+        if self.divergences or missing:
+            raise ReplayDivergence(f"Replay of {self.path}: {len(self.divergences)} divergences, "
+                                   f"calls not replayed: {missing}")
+        return report
+
+
+class ReplayResource:
+    """
+    pyvisa resource API served from a recording
+    """
+    def __init__(self, replay: SessionReplay, name: str, events):
+        self.replay     = replay
+        self.name       = name
+        self.events     = events
+        self.index      = 0
+        self.timeout    = 5000
+        self.lock       = threading.Lock()
+
+    def _next(self, op: str, cmd):
+        t = time.perf_counter()
+        with self.lock:
+            index   = self.index
+            event   = self.events[index] if index < len(self.events) else None
+            if event is None or event['op'] != op or event['cmd'] != cmd:
+                self.replay.diverged(self.name, index, event, op, cmd)
+                if event is None:
+                    raise ReplayDivergence(f"{self.name}: Replay has no more recorded calls")
+            self.index += 1
+        if self.replay.pacing == 'real':
+            delay = event['dt'] - (time.perf_counter() - t)
+            if delay > 0:
+                time.sleep(delay)
+        if 'error' in event:
+            if event['error'] == 'VisaIOError' and event['code'] is not None:
+                raise pyvisa.errors.VisaIOError(event['code'])
+            raise ValueError(event['msg'])
+        return event
+
+    def write(self, cmd: str, *args, **kwargs):
+        self._next('write', cmd)
+
+    def query(self, cmd: str, *args, **kwargs) -> str:
+        return self._next('query', cmd)['ans']
+
+    def read(self, *args, **kwargs) -> str:
+        return self._next('read', None)['ans']
+
+    def query_ascii_values(self, cmd: str, *args, container = np.array, **kwargs):
+        return _container(_decode_array(self._next('ascii', cmd)), container)
+
+    def query_binary_values(self, cmd: str, *args, container = np.array, **kwargs):
+        return _container(_decode_array(self._next('binary', cmd)), container)
+
+    def close(self):
+        pass
+
+
+def summary(path: str) -> dict:
+    """
+    Calls and instrument time (s) of a recording by resource and operation
+    """
+    result = {}
+    with gzip.open(path, 'rt', encoding='utf-8') as file:
+        file.readline()
+        for line in file:
+            event   = json.loads(line)
+            stats   = result.setdefault(event['res'], {}).setdefault(event['op'], {'calls': 0, 'time': 0.0})
+            stats['calls'] += 1
+            stats['time']  += event['dt']
+    return result
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Summary of a recorded SCPI session")
+    parser.add_argument('path')
+    for res, ops in summary(parser.parse_args().path).items():
+        for op, stats in ops.items():
+            print(f"{res:8s} {op:8s} {stats['calls']:8d} calls {stats['time']:10.3f} s")
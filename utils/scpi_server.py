@@ -0,0 +1,357 @@
+import logging
+import select
+import socketserver
+import struct
+import threading
+import time
+
+# Network front ends of a simulated instrument (see scpi_simulator):
+# - Raw socket (port 5025), newline terminated messages ("TCPIP0::<ip>::5025::SOCKET", pyarbtools)
+# - VXI-11 (ONC RPC core channel and portmapper on port 111), the "TCPIP0::<ip>::inst0::INSTR" resources.
+#
+# The instrument object has a process(message: bytes) method that returns (response or None, ready time).
+# The response is not sent before the ready time (time.monotonic), e.g. *OPC? answers at the end of the sweep.
+
+def scan_message(data: bytes, start: int, stops: bytes) -> int:
+    """
+    Find the first stop character outside quoted strings and definite length blocks (#<n><length><data>).
+    :return: Index of the stop character, -1 if not found (or the message is incomplete)
+    """
+    i = start
+    n = len(data)
+    while i < n:
+        c = data[i]
+        if c in b'"\'':
+            j = data.find(data[i:i + 1], i + 1)
+            if j < 0:
+                return -1
+            i = j + 1
+            continue
+        if c == 0x23 and i + 1 < n and 0x31 <= data[i + 1] <= 0x39:
+            n_digits = data[i + 1] - 0x30
+            if i + 2 + n_digits > n:
+                return -1
+            i += 2 + n_digits + int(data[i + 2:i + 2 + n_digits])
+            continue
+        if c in stops:
+            return i
+        i += 1
+    return -1
+
+def wait_until(t: float):
+    delay = t - time.monotonic()
+    if delay > 0:
+        time.sleep(delay)
+
+
+class _Server(socketserver.ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads      = True
+
+
+class RawConnection:
+    """
+    Input of a raw socket client: read and processed under a lock, by the serving thread or by drain()
+    (the messages are executed in order whichever thread reads them)
+    """
+    def __init__(self, sock, instrument):
+        self.sock       = sock
+        self.instrument = instrument
+        self.lock       = threading.Lock()
+        self.buf        = b''
+        self.closed     = False
+
+    def pump(self) -> bool:
+        """
+        Read the bytes already received (no wait) and execute the complete messages.
+        :return: False when the client closed the connection
+        """
+        with self.lock:
+            while not self.closed and select.select([self.sock], [], [], 0)[0]:
+                data = self.sock.recv(65536)
+                if not data:
+                    self.closed = True
+                    break
+                self.buf += data
+                while True:
+                    end = scan_message(self.buf, 0, b'\n')
+                    if end < 0:
+                        break
+                    message, self.buf = self.buf[:end], self.buf[end + 1:]
+                    response, ready = self.instrument.process(message)
+                    if response is not None:
+                        wait_until(ready)
+                        self.sock.sendall(response + b'\n')
+            return not self.closed
+
+
+class RawSocketServer:
+    """
+    SCPI over a raw TCP socket (one message per line)
+    """
+    def __init__(self, instrument, host: str, port: int = 5025, log = None):
+        self.instrument = instrument
+        self.log        = log if log is not None else logging.getLogger(__name__)
+        self.connections= set()
+        server          = self
+
+        class Handler(socketserver.BaseRequestHandler):
+            def handle(self):
+                server.serve_connection(self.request)
+
+        self.server     = _Server((host, port), Handler)
+        self.address    = self.server.server_address
+
+    def serve_connection(self, sock):
+        connection = RawConnection(sock, self.instrument)
+        self.connections.add(connection)
+        try:
+            while True:
+                select.select([sock], [], [])
+                if not connection.pump():
+                    return
+        finally:
+            self.connections.discard(connection)
+
+    def drain(self):
+        """
+        Execute the messages already received on all the connections. A raw socket write returns before the
+        instrument reads it: Bench calls drain() on the generator before the analyzer measures.
+        """
+        for connection in list(self.connections):
+            connection.pump()
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.log.info(f"{self.instrument.name}: Raw socket on {self.address[0]}:{self.address[1]}")
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+# ONC RPC / VXI-11 constants
+PMAP_PROG       = 100000
+PMAP_VERS       = 2
+PMAP_PORT       = 111
+PMAP_GETPORT    = 3
+DEVICE_CORE_PROG= 0x0607AF
+DEVICE_CORE_VERS= 1
+CREATE_LINK     = 10
+DEVICE_WRITE    = 11
+DEVICE_READ     = 12
+DEVICE_READSTB  = 13
+DEVICE_CLEAR    = 15
+DESTROY_LINK    = 23
+OP_FLAG_END     = 0x08
+RX_REQCNT       = 0x01
+RX_END          = 0x04
+ERR_NONE        = 0
+ERR_INVALID_LINK= 4
+ERR_IO_TIMEOUT  = 15
+MAX_RECV_SIZE   = 0x100000
+
+
+class XdrReader:
+    def __init__(self, data: bytes):
+        self.data   = data
+        self.pos    = 0
+
+    def uint(self) -> int:
+        value = struct.unpack_from('>I', self.data, self.pos)[0]
+        self.pos += 4
+        return value
+
+    def opaque(self) -> bytes:
+        n       = self.uint()
+        value   = self.data[self.pos:self.pos + n]
+        self.pos += (n + 3) & ~3
+        return value
+
+def xdr_uint(*values) -> bytes:
+    return struct.pack(f'>{len(values)}I', *values)
+
+def xdr_opaque(data: bytes) -> bytes:
+    return xdr_uint(len(data)) + data + b'\0' * (-len(data) % 4)
+
+
+class RpcServer:
+    """
+    Minimal ONC RPC server over TCP (record marking), one program and version.
+    handle(proc, args: XdrReader, connection) returns the XDR encoded results.
+    """
+    def __init__(self, host: str, port: int, prog: int, vers: int, log = None):
+        self.prog       = prog
+        self.vers       = vers
+        self.log        = log if log is not None else logging.getLogger(__name__)
+        server          = self
+
+        class Handler(socketserver.BaseRequestHandler):
+            def handle(self):
+                server.serve_connection(self.request)
+
+        self.server     = _Server((host, port), Handler)
+        self.address    = self.server.server_address
+
+    @staticmethod
+    def _recv_exact(sock, n: int) -> bytes:
+        data = b''
+        while len(data) < n:
+            chunk = sock.recv(n - len(data))
+            if not chunk:
+                raise ConnectionError("Connection closed")
+            data += chunk
+        return data
+
+    def _recv_record(self, sock) -> bytes:
+        record = b''
+        while True:
+            header = struct.unpack('>I', self._recv_exact(sock, 4))[0]
+            record += self._recv_exact(sock, header & 0x7FFFFFFF)
+            if header & 0x80000000:
+                return record
+
+    def serve_connection(self, sock):
+        connection = {}
+        try:
+            while True:
+                call = XdrReader(self._recv_record(sock))
+                xid, msg_type, _, prog, vers, proc = (call.uint() for _ in range(6))
+                call.uint(); call.opaque()  # Credentials
+                call.uint(); call.opaque()  # Verifier
+                # Accepted reply with a null verifier
+                reply = xdr_uint(xid, 1, 0, 0, 0)
+                if prog != self.prog:
+                    reply += xdr_uint(1)                        # PROG_UNAVAIL
+                elif vers != self.vers:
+                    reply += xdr_uint(2, self.vers, self.vers)  # PROG_MISMATCH
+                else:
+                    results = self.handle(proc, call, connection)
+                    reply += xdr_uint(3) if results is None else xdr_uint(0) + results # PROC_UNAVAIL / SUCCESS
+                sock.sendall(xdr_uint(0x80000000 | len(reply)) + reply)
+        except ConnectionError:
+            pass
+        finally:
+            self.closed(connection)
+
+    def handle(self, proc: int, args: XdrReader, connection: dict):
+        return b'' if proc == 0 else None
+
+    def closed(self, connection: dict):
+        pass
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class PortMapper(RpcServer):
+    """
+    Portmapper (GETPORT only) of a single host address: maps the VXI-11 core program to its port
+    """
+    def __init__(self, host: str, ports: dict, port: int = PMAP_PORT, log = None):
+        super().__init__(host, port, PMAP_PROG, PMAP_VERS, log)
+        self.ports = ports # prog -> TCP port
+
+    def handle(self, proc, args, connection):
+        if proc == PMAP_GETPORT:
+            prog = args.uint()
+            return xdr_uint(self.ports.get(prog, 0))
+        return super().handle(proc, args, connection)
+
+
+class Vxi11Server(RpcServer):
+    """
+    VXI-11 core channel of a simulated instrument (links, device write/read/clear)
+    """
+    def __init__(self, instrument, host: str, port: int = 0, log = None):
+        super().__init__(host, port, DEVICE_CORE_PROG, DEVICE_CORE_VERS, log)
+        self.instrument = instrument
+        self.links      = {}  # link id -> {'input': bytes, 'output': bytes, 'ready': time}
+        self.next_link  = 1
+        self.link_lock  = threading.Lock()
+
+    def handle(self, proc, args, connection):
+        if proc == CREATE_LINK:
+            args.uint(); args.uint(); args.uint()  # client id, lock device, lock timeout
+            device = args.opaque().decode(errors='replace')
+            with self.link_lock:
+                lid = self.next_link
+                self.next_link += 1
+                self.links[lid] = {'input': b'', 'output': b'', 'ready': 0.0}
+            connection.setdefault('links', []).append(lid)
+            self.log.debug(f"{self.instrument.name}: Link {lid} to {device}")
+            return xdr_uint(ERR_NONE, lid, 0, MAX_RECV_SIZE)
+
+        if proc in (DEVICE_WRITE, DEVICE_READ, DEVICE_READSTB, DEVICE_CLEAR, DESTROY_LINK):
+            link = self.links.get(args.uint())
+            if link is None:
+                if proc == DEVICE_READ:
+                    return xdr_uint(ERR_INVALID_LINK, 0) + xdr_opaque(b'')
+                if proc in (DEVICE_WRITE, DEVICE_READSTB):
+                    return xdr_uint(ERR_INVALID_LINK, 0)
+                return xdr_uint(ERR_INVALID_LINK)
+            if proc == DEVICE_WRITE:
+                return self.device_write(link, args)
+            if proc == DEVICE_READ:
+                return self.device_read(link, args)
+            if proc == DEVICE_READSTB:
+                return xdr_uint(ERR_NONE, 0x10 if link['output'] else 0) # MAV bit
+            if proc == DEVICE_CLEAR:
+                link.update(input=b'', output=b'')
+                return xdr_uint(ERR_NONE)
+            with self.link_lock:
+                self.links = {k: v for k, v in self.links.items() if v is not link}
+            return xdr_uint(ERR_NONE)
+
+        if proc in range(14, 27):
+            # trigger, remote, local, lock, unlock, srq, docmd, interrupt channel: accepted
+            return xdr_uint(ERR_NONE)
+        return super().handle(proc, args, connection)
+
+    def device_write(self, link, args):
+        args.uint(); args.uint()                # io timeout, lock timeout
+        flags   = args.uint()
+        data    = args.opaque()
+        link['input'] += data
+        if flags & OP_FLAG_END:
+            message, link['input'] = link['input'], b''
+            if link['output']:
+                # A new message discards an unread response (IEEE 488.2 query interrupted)
+                link['output'] = b''
+                self.instrument.error(-410, "Query INTERRUPTED")
+            response, ready = self.instrument.process(message.rstrip(b'\r\n'))
+            if response is not None:
+                link['output']  = response + b'\n'
+                link['ready']   = ready
+        return xdr_uint(ERR_NONE, len(data))
+
+    def device_read(self, link, args):
+        request_size = args.uint()
+        io_timeout   = args.uint() / 1000
+        if not link['output']:
+            # Nothing to read (query missing): the client times out
+            time.sleep(io_timeout)
+            return xdr_uint(ERR_IO_TIMEOUT, 0) + xdr_opaque(b'')
+        delay = link['ready'] - time.monotonic()
+        if delay > io_timeout:
+            time.sleep(io_timeout)
+            return xdr_uint(ERR_IO_TIMEOUT, 0) + xdr_opaque(b'')
+        wait_until(link['ready'])
+        data, link['output'] = link['output'][:request_size], link['output'][request_size:]
+        return xdr_uint(ERR_NONE, RX_REQCNT if link['output'] else RX_END) + xdr_opaque(data)
+
+    def closed(self, connection):
+        with self.link_lock:
+            for lid in connection.get('links', []):
+                self.links.pop(lid, None)
+
+    def start(self):
+        super().start()
+        self.log.info(f"{self.instrument.name}: VXI-11 on {self.address[0]}:{self.address[1]}")
+        return self
@@ -0,0 +1,900 @@
+import argparse
+import copy
+import logging
+import math
+import re
+import threading
+import time
+
+import numpy as np
+import yaml
+
+from python_rf_course.utils.scpi_cache import normalize_header, parse_value
+from python_rf_course.utils.pa_model   import RappPA, BandpassFilter, Thru, PA_DATABASE
+from python_rf_course.utils.scpi_server import (scan_message, wait_until, RawSocketServer, Vxi11Server,
+                                                PortMapper, DEVICE_CORE_PROG)
+
+# Local simulator of the lab instruments (spectrum analyzer, signal generator and the device under test)
+# for running the apps and benchmarks without hardware:
+#
+#     python -m python_rf_course.utils.scpi_simulator --sa 127.0.0.2 --sg 127.0.0.3 --dut pa --sn SN1234
+#
+# then set IP_SA/IP_SG (YAML defaults or the GUI) to 127.0.0.2/127.0.0.3.
+# Each instrument listens on its own address: raw socket on 5025 and VXI-11 (TCPIP0::<ip>::inst0::INSTR).
+# VXI-11 needs the portmapper on port 111 (root or CAP_NET_BIND_SERVICE on Linux).
+#
+# Only the command subset used by the course is simulated. The sweep time follows span/RBW^2,
+# and *OPC?/*WAI complete at the end of the sweep (scaled by time_scale, 0 for no wait).
+# The analyzer measures the generator state after the SG messages already received, on both transports,
+# so a scan from a single client is deterministic (for a fixed seed).
+
+class SCPIError(Exception):
+    def __init__(self, code: int, message: str):
+        super().__init__(message)
+        self.code       = code
+        self.message    = message
+
+def fmt_real(value: float) -> str:
+    return f"{value:+.11E}"
+
+def fmt_int(value) -> str:
+    return f"{int(value):+d}"
+
+def fmt_bool(value) -> str:
+    return '1' if value else '0'
+
+def block(data: bytes) -> bytes:
+    # IEEE 488.2 definite length block
+    length = str(len(data))
+    return f"#{len(length)}{length}".encode() + data
+
+_suffix_re = re.compile(r'^(.*?[A-Z])(\d+)$')
+_trace_re  = re.compile(r'TRACE?(\d)', re.IGNORECASE)
+
+
+class SimulatedInstrument:
+    """
+    Parser and common commands (IEEE 488.2 and SYST:ERR?) of a simulated instrument.
+    Subclasses fill self.handlers: normalized header -> handler(arg, query, n), n is the numeric suffix.
+    """
+    idn = 'Simulator,SIM,0,1.0'
+
+    def __init__(self, name: str, latency: float = 0.0, log = None):
+        self.name       = name
+        self.latency    = latency   # Seconds per message (LAN and parser)
+        self.log        = log if log is not None else logging.getLogger(__name__)
+        self.lock       = threading.RLock()
+        self.errors     = []        # Error queue (code, message)
+        self.saved      = {}        # *SAV registers
+        self.busy_until = 0.0       # Next message is not processed before (*WAI, *OPC?)
+        self.ready      = 0.0       # Time at which the response of the current message is ready
+        self.unit       = ''        # Command being executed (for the error messages)
+        self.handlers   = {
+            '*IDN': self.h_idn,     '*RST': self.h_rst,     '*CLS': self.h_cls,
+            '*OPC': self.h_opc,     '*WAI': self.h_wai,     '*SAV': self.h_sav,
+            '*RCL': self.h_rcl,     '*ESR': self.h_zero,    '*STB': self.h_zero,
+            '*ESE': self.h_zero,    '*SRE': self.h_zero,    '*TST': self.h_zero,
+            'SYST:ERR': self.h_err, 'SYST:ERR:NEXT': self.h_err,
+        }
+        self.state      = {}
+        self.reset()
+
+    def reset(self):
+        pass
+
+    def error(self, code: int, message: str):
+        with self.lock:
+            if len(self.errors) < 20:
+                self.errors.append((code, message))
+            else:
+                self.errors[-1] = (-350, "Queue overflow")
+
+    def operation_end(self) -> float:
+        # Time at which the pending operations complete (the sweep for the analyzer)
+        return time.monotonic()
+
+    def process(self, message: bytes):
+        """
+        Execute a program message (semicolon separated units).
+        :return: (response bytes or None, time at which the response is ready)
+        """
+        with self.lock:
+            wait_until(self.busy_until)
+            if self.latency:
+                time.sleep(self.latency)
+            self.ready  = 0.0
+            answers     = []
+            path        = []
+            start       = 0
+            while start <= len(message):
+                end     = scan_message(message, start, b';')
+                if end < 0:
+                    end = len(message)
+                unit    = message[start:end].decode('latin-1').strip()
+                start   = end + 1
+                self.unit = unit
+                if not unit:
+                    continue
+                parts   = unit.split(None, 1)
+                header  = parts[0]
+                arg     = parts[1] if len(parts) > 1 else None
+                # A header without a leading colon is relative to the path of the previous one
+                if not header.startswith((':', '*')) and path:
+                    header = ':' + ':'.join(path + [header])
+                if not header.startswith('*'):
+                    path = header.lstrip(':').split(':')[:-1]
+                try:
+                    ans = self.execute(header, arg)
+                except SCPIError as e:
+                    self.error(e.code, f"{e.message};{unit}")
+                    continue
+                if ans is not None:
+                    answers.append(ans if isinstance(ans, bytes) else ans.encode('latin-1'))
+            return (b';'.join(answers) if answers else None), self.ready
+
+    def execute(self, header: str, arg):
+        query   = header.endswith('?')
+        nodes   = []
+        n       = 1
+        for node in normalize_header(header).split(':'):
+            m = _suffix_re.match(node)
+            if m is not None and not node.startswith('*'):
+                node, n = m.group(1), int(m.group(2))
+            nodes.append(node)
+        handler = self.handlers.get(':'.join(nodes))
+        if handler is None:
+            return self.unknown(normalize_header(header), arg, query)
+        return handler(arg, query, n)
+
+    def unknown(self, key: str, arg, query: bool):
+        raise SCPIError(-113, "Undefined header")
+
+    # Argument helpers
+    @staticmethod
+    def number(arg) -> float:
+        if arg is None:
+            raise SCPIError(-109, "Missing parameter")
+        value = parse_value(arg)
+        if not isinstance(value, float):
+            raise SCPIError(-104, "Data type error")
+        return value
+
+    def bool(self, arg) -> bool:
+        return self.number(arg) != 0
+
+    @staticmethod
+    def choice(arg, choices) -> str:
+        if arg is None:
+            raise SCPIError(-109, "Missing parameter")
+        value = parse_value(arg)
+        if value not in choices:
+            raise SCPIError(-224, "Illegal parameter value")
+        return value
+
+    def clip(self, value: float, low: float, high: float) -> float:
+        if not low <= value <= high:
+            self.error(-222, f"Data out of range;{self.unit}")
+        return min(max(value, low), high)
+
+    def setting(self, key: str, arg, query: bool, parse, fmt):
+        # Generic setting (set and query)
+        if query:
+            return fmt(self.state[key])
+        self.state[key] = parse(arg)
+
+    # Common commands
+    def h_idn(self, arg, query, n):
+        return self.idn
+
+    def h_rst(self, arg, query, n):
+        self.reset()
+
+    def h_cls(self, arg, query, n):
+        self.errors.clear()
+
+    def h_opc(self, arg, query, n):
+        if query:
+            self.ready      = self.operation_end()
+            self.busy_until = max(self.busy_until, self.ready)
+            return '1'
+
+    def h_wai(self, arg, query, n):
+        self.busy_until = max(self.busy_until, self.operation_end())
+
+    def h_sav(self, arg, query, n):
+        self.saved[int(self.number(arg))] = copy.deepcopy(self.state)
+
+    def h_rcl(self, arg, query, n):
+        register = int(self.number(arg))
+        if register not in self.saved:
+            raise SCPIError(-256, "File name not found")
+        self.state = copy.deepcopy(self.saved[register])
+
+    def h_zero(self, arg, query, n):
+        return '+0' if query else None
+
+    def h_err(self, arg, query, n):
+        if not self.errors:
+            return '+0,"No error"'
+        code, message = self.errors.pop(0)
+        return f'{code:+d},"{message}"'
+
+
+# Detector noise (standard deviation of the trace noise in dB)
+NOISE_STD = {'AVER': 0.5, 'RMS': 0.5, 'NORM': 1.5, 'POS': 1.5, 'NEG': 1.5, 'SAMP': 5.6}
+TRACE_TYPES = ('WRIT', 'AVER', 'MAXH', 'MINH', 'VIEW', 'BLAN')
+DETECTORS   = ('NORM', 'AVER', 'POS', 'SAMP', 'NEG', 'RMS')
+
+
+# Continuous sweeps simulated at a trace read (the older ones are dropped)
+MAX_CATCH_UP = 10000
+
+
+class SpectrumAnalyzerSim(SimulatedInstrument):
+    """
+    Swept spectrum analyzer. The input spectrum is given by source(): list of (frequency Hz, power dBm).
+    A time varying input is given by segments(t0, t1): list of (on time, off time, tones) between t0 and t1,
+    each trace point then sees the tones that are on when the sweep passes it.
+    """
+    idn = 'Keysight Technologies,N9020A,SIM00001,A.99.99'
+
+    def __init__(self, source = None, segments = None, f_max = 26.5e9, danl = -155.0, sweep_k = 2.5,
+                 min_sweep_time = 1e-3, time_scale = 1.0, seed = None, **kwargs):
+        self.source     = source if source is not None else list
+        self.segments   = segments
+        self.f_max      = f_max     # Hz
+        self.danl       = danl      # Displayed average noise level (dBm/Hz)
+        self.sweep_k    = sweep_k   # Sweep time = k * span / RBW^2
+        self.min_sweep_time = min_sweep_time
+        self.time_scale = time_scale
+        self.rng        = np.random.default_rng(seed)
+        super().__init__(**kwargs)
+        setting = self.setting
+        self.handlers.update({
+            'FREQ:CENT': self.h_center,         'FREQ:SPAN': self.h_span,
+            'FREQ:STAR': self.h_start,          'FREQ:STOP': self.h_stop,
+            'FREQ:SPAN:FULL': self.h_full_span,
+            'BAND:RES': self.h_rbw,             'BAND:RES:AUTO': self.h_rbw_auto,
+            'BAND:VID': self.h_vbw,             'BAND:VID:AUTO': self.h_vbw_auto,
+            'SWE:POIN': self.h_points,          'SWE:TIME': self.h_sweep_time,
+            'SWE:TIME:AUTO': lambda a, q, n: setting('sweep_time_auto', a, q, self.bool, fmt_bool),
+            'DET': lambda a, q, n: self.h_detector(a, q, 0), 'DET:TRAC': self.h_detector,
+            'TRAC:TYPE': self.h_trace_type,     'TRAC:MODE': self.h_trace_type,
+            'TRAC': self.h_trace_data,          'TRAC:DATA': self.h_trace_data,
+            'TRAC:COPY': self.h_trace_copy,     'TRAC:SEL': lambda a, q, n: None,
+            'AVER:COUN': lambda a, q, n: setting('average_count', a, q, lambda v: int(self.number(v)), fmt_int),
+            'INIT': self.h_init,                'INIT:CONT': self.h_init_cont,
+            'INIT:REST': self.h_restart,        'ABOR': self.h_abort,
+            'FORM': self.h_format,              'FORM:DATA': self.h_format,
+            'FORM:TRAC:DATA': self.h_format,
+            'FORM:BORD': lambda a, q, n: setting('border', a, q, lambda v: self.choice(v, ('NORM', 'SWAP')), str),
+            'DISP:WIND:TRAC:Y:RLEV': lambda a, q, n: setting('rlev', a, q, self.number, fmt_real),
+            'DISP:WIND:TRAC:Y:PDIV': lambda a, q, n: setting('pdiv', a, q, self.number, fmt_real),
+            'CALC:MARK': self.h_marker_state,   'CALC:MARK:MODE': self.h_marker_state,
+            'CALC:MARK:AOFF': self.h_marker_off,
+            'CALC:MARK:MAX': self.h_marker_max, 'CALC:MARK:MAX:NEXT': self.h_marker_next,
+            'CALC:MARK:X': self.h_marker_x,     'CALC:MARK:Y': self.h_marker_y,
+            'STAT:OPER:ENAB': lambda a, q, n: setting('oper_enable', a, q, lambda v: int(self.number(v)), fmt_int),
+            'STAT:OPER:EVEN': self.h_oper_event,
+        })
+
+    def reset(self):
+        self.state      = {
+            'center': self.f_max / 2, 'span': self.f_max, 'rbw': 3e6, 'rbw_auto': True,
+            'vbw': 3e6, 'vbw_auto': True, 'points': 1001, 'sweep_time': 0.0, 'sweep_time_auto': True,
+            'continuous': True, 'detector': {t: 'NORM' for t in range(1, 7)},
+            'trace_type': {t: 'WRIT' if t == 1 else 'BLAN' for t in range(1, 7)}, 'average_count': 100,
+            'format': 'ASC', 'border': 'NORM', 'rlev': 0.0, 'pdiv': 10.0,
+            'markers': {}, 'oper_enable': 0,
+        }
+        self.traces     = {}    # Trace number -> float32 data
+        self.averages   = {}    # Trace number -> number of averaged sweeps
+        self.sweep      = None  # Running sweep: (data, end time)
+        self.oper_event = 0
+        self.cont_time  = time.monotonic()  # Start of the next continuous sweep
+
+    # Coupled settings
+    @property
+    def start(self) -> float:
+        return self.state['center'] - self.state['span'] / 2
+
+    @property
+    def stop(self) -> float:
+        return self.state['center'] + self.state['span'] / 2
+
+    @property
+    def rbw(self) -> float:
+        if not self.state['rbw_auto']:
+            return self.state['rbw']
+        if self.state['span'] == 0:
+            return self.state['rbw']
+        # Span/RBW ratio of about 100 on a 1-3-10 sequence
+        target  = self.state['span'] / 106
+        decade  = 10 ** math.floor(math.log10(target))
+        options = [decade, 3 * decade, 10 * decade]
+        rbw     = min(options, key=lambda x: abs(math.log(x / target)))
+        return min(max(rbw, 1.0), 8e6)
+
+    @property
+    def vbw(self) -> float:
+        return self.rbw if self.state['vbw_auto'] else self.state['vbw']
+
+    @property
+    def sweep_time(self) -> float:
+        if not self.state['sweep_time_auto']:
+            return self.state['sweep_time']
+        t = self.sweep_k * self.state['span'] / self.rbw ** 2 * max(1.0, self.rbw / self.vbw)
+        return max(t, self.min_sweep_time)
+
+    def axis(self) -> np.ndarray:
+        return np.linspace(self.start, self.stop, self.state['points'])
+
+    # Sweep
+    def measure(self, t0: float = None) -> np.ndarray:
+        """
+        :param t0: Start time of the sweep (default: now)
+        """
+        f       = self.axis()
+        n       = len(f)
+        rbw     = self.rbw
+        step    = (self.stop - self.start) / (n - 1) if n > 1 else 0.0
+        det     = self.state['detector'][1]
+        noise   = self.danl + 10 * math.log10(rbw) + NOISE_STD[det] * self.rng.standard_normal(n)
+        power   = 10 ** (noise / 10)
+        if self.segments is None:
+            segments = [(-math.inf, math.inf, self.source())]
+        else:
+            t0          = time.monotonic() if t0 is None else t0
+            duration    = self.sweep_time * self.time_scale
+            segments    = self.segments(t0, t0 + duration)
+            # Time at which the sweep passes each trace point (+-half a point for the detector bucket)
+            t_point     = t0 + duration * np.arange(n) / max(n - 1, 1)
+            t_half      = duration / max(n - 1, 1) / 2
+        for t_on, t_off, tones in segments:
+            for f_tone, p_tone in tones:
+                lo = np.searchsorted(f, f_tone - 10 * rbw - step)
+                hi = np.searchsorted(f, f_tone + 10 * rbw + step)
+                if lo >= hi:
+                    continue
+                d = np.abs(f[lo:hi] - f_tone)
+                if det != 'SAMP':
+                    # Peak of the response within the bucket of each trace point
+                    d = np.maximum(d - step / 2, 0.0)
+                # Gaussian RBW filter (-3 dB at +-RBW/2)
+                response = 10 ** ((p_tone - 12.04 * (d / rbw) ** 2) / 10)
+                if t_on > -math.inf or t_off < math.inf:
+                    t = t_point[lo:hi]
+                    response[(t + t_half < t_on) | (t - t_half > t_off)] = 0.0
+                power[lo:hi] += response
+        return (10 * np.log10(power)).astype(np.float32)
+
+    def start_sweep(self):
+        self.sweep = (self.measure(), time.monotonic() + self.sweep_time * self.time_scale)
+
+    def run_continuous(self) -> bool:
+        """
+        Simulate the continuous sweeps completed since the last call (time varying input only).
+        :return: True if a sweep completed
+        """
+        if self.segments is None or not self.state['continuous']:
+            return False
+        period  = max(self.sweep_time * self.time_scale, self.min_sweep_time)
+        count   = int((time.monotonic() - self.cont_time) // period)
+        if count <= 0:
+            return False
+        # Write mode traces keep only the last sweep
+        holds   = any(mode in ('MAXH', 'MINH', 'AVER') for mode in self.state['trace_type'].values())
+        for k in range(max(0, count - (MAX_CATCH_UP if holds else 1)), count):
+            self.sweep = (self.measure(self.cont_time + k * period), 0.0)
+            self.complete_sweep(force=True)
+        self.cont_time += count * period
+        return True
+
+    def complete_sweep(self, force: bool = False):
+        if self.sweep is None or (not force and time.monotonic() < self.sweep[1]):
+            return
+        data, _     = self.sweep
+        self.sweep  = None
+        for t, mode in self.state['trace_type'].items():
+            old = self.traces.get(t)
+            if old is None or len(old) != len(data) or mode == 'WRIT':
+                self.traces[t]   = data.copy()
+                self.averages[t] = 1
+            elif mode == 'MAXH':
+                np.maximum(old, data, out=old)
+            elif mode == 'MINH':
+                np.minimum(old, data, out=old)
+            elif mode == 'AVER':
+                k = self.averages[t] = min(self.averages[t] + 1, self.state['average_count'])
+                old += (data - old) / k
+        self.oper_event |= 16
+
+    def operation_end(self) -> float:
+        if self.sweep is None:
+            return time.monotonic()
+        end = self.sweep[1]
+        self.complete_sweep(force=True)
+        return end
+
+    def trace(self, t: int) -> np.ndarray:
+        if self.state['continuous']:
+            # A static input is swept at the read
+            if not self.run_continuous() and (self.segments is None or t not in self.traces):
+                self.start_sweep()
+                self.complete_sweep(force=True)
+        else:
+            self.complete_sweep()
+        if t not in self.traces or len(self.traces[t]) != self.state['points']:
+            # Settings changed since the last sweep
+            self.start_sweep()
+            self.complete_sweep(force=True)
+        return self.traces[t]
+
+    # Frequency
+    def h_center(self, arg, query, n):
+        if query:
+            return fmt_real(self.state['center'])
+        self.state['center'] = self.clip(self.number(arg), 0.0, self.f_max)
+
+    def h_span(self, arg, query, n):
+        if query:
+            return fmt_real(self.state['span'])
+        self.state['span'] = self.clip(self.number(arg), 0.0, self.f_max)
+
+    def h_full_span(self, arg, query, n):
+        self.state['center'] = self.f_max / 2
+        self.state['span']   = self.f_max
+
+    def _set_start_stop(self, start: float, stop: float):
+        if stop < start:
+            raise SCPIError(-221, "Settings conflict")
+        self.state['center'] = (start + stop) / 2
+        self.state['span']   = stop - start
+
+    def h_start(self, arg, query, n):
+        if query:
+            return fmt_real(self.start)
+        self._set_start_stop(self.clip(self.number(arg), 0.0, self.f_max), self.stop)
+
+    def h_stop(self, arg, query, n):
+        if query:
+            return fmt_real(self.stop)
+        self._set_start_stop(self.start, self.clip(self.number(arg), 0.0, self.f_max))
+
+    # Bandwidth and sweep
+    def h_rbw(self, arg, query, n):
+        if query:
+            return fmt_real(self.rbw)
+        self.state['rbw']       = self.clip(self.number(arg), 1.0, 8e6)
+        self.state['rbw_auto']  = False
+
+    def h_rbw_auto(self, arg, query, n):
+        if query:
+            return fmt_bool(self.state['rbw_auto'])
+        if not self.bool(arg):
+            self.state['rbw'] = self.rbw
+        self.state['rbw_auto'] = self.bool(arg)
+
+    def h_vbw(self, arg, query, n):
+        if query:
+            return fmt_real(self.vbw)
+        self.state['vbw']       = self.clip(self.number(arg), 1.0, 50e6)
+        self.state['vbw_auto']  = False
+
+    def h_vbw_auto(self, arg, query, n):
+        if query:
+            return fmt_bool(self.state['vbw_auto'])
+        if not self.bool(arg):
+            self.state['vbw'] = self.vbw
+        self.state['vbw_auto'] = self.bool(arg)
+
+    def h_points(self, arg, query, n):
+        if query:
+            return fmt_int(self.state['points'])
+        self.state['points'] = int(self.clip(round(self.number(arg)), 1, 40001))
+
+    def h_sweep_time(self, arg, query, n):
+        if query:
+            return fmt_real(self.sweep_time)
+        self.state['sweep_time']        = self.clip(self.number(arg), 1e-6, 4000.0)
+        self.state['sweep_time_auto']   = False
+
+    def h_detector(self, arg, query, n):
+        # n = 0: all traces
+        if query:
+            return self.state['detector'][max(n, 1)]
+        det = self.choice(arg, DETECTORS)
+        for t in (list(self.state['detector']) if n == 0 else [n]):
+            self.state['detector'][t] = det
+
+    def h_trace_type(self, arg, query, n):
+        if query:
+            return self.state['trace_type'][n]
+        self.run_continuous()
+        self.state['trace_type'][n] = self.choice(arg, TRACE_TYPES)
+        # A new hold/average starts from the next sweep
+        self.traces.pop(n, None)
+
+    # Sweep control
+    def h_init(self, arg, query, n):
+        self.start_sweep()
+        self.oper_event &= ~16
+
+    def h_init_cont(self, arg, query, n):
+        if query:
+            return fmt_bool(self.state['continuous'])
+        self.run_continuous()
+        if self.bool(arg) and not self.state['continuous']:
+            self.cont_time = time.monotonic()
+        self.state['continuous'] = self.bool(arg)
+
+    def h_restart(self, arg, query, n):
+        self.traces.clear()
+        self.start_sweep()
+
+    def h_abort(self, arg, query, n):
+        self.sweep = None
+
+    def h_oper_event(self, arg, query, n):
+        self.complete_sweep()
+        event, self.oper_event = self.oper_event, 0
+        return fmt_int(event)
+
+    # Trace data
+    def h_format(self, arg, query, n):
+        if query:
+            return self.state['format']
+        value = parse_value(arg).replace(' ', '')
+        if value in ('ASC', 'ASCII'):
+            self.state['format'] = 'ASC'
+        elif value in ('REAL', 'REAL,32', 'REAL,64'):
+            self.state['format'] = 'REAL,64' if value == 'REAL,64' else 'REAL,32'
+        else:
+            raise SCPIError(-224, "Illegal parameter value")
+
+    def h_trace_data(self, arg, query, n):
+        if not query:
+            raise SCPIError(-113, "Undefined header")
+        m       = _trace_re.search(arg) if arg is not None else None
+        data    = self.trace(int(m.group(1)) if m else n)
+        fmt     = self.state['format']
+        if fmt == 'ASC':
+            return ','.join(f"{v:.3f}" for v in data.tolist())
+        dtype   = ('<' if self.state['border'] == 'SWAP' else '>') + ('f4' if fmt == 'REAL,32' else 'f8')
+        return block(data.astype(dtype).tobytes())
+
+    def h_trace_copy(self, arg, query, n):
+        traces = _trace_re.findall(arg or '')
+        if len(traces) != 2:
+            raise SCPIError(-109, "Missing parameter")
+        src, dst = int(traces[0]), int(traces[1])
+        self.traces[dst] = self.trace(src).copy()
+
+    # Markers (on trace 1)
+    def _marker_index(self, freq: float) -> int:
+        n = self.state['points']
+        if n == 1 or self.stop == self.start:
+            return 0
+        return int(np.clip(round((freq - self.start) / (self.stop - self.start) * (n - 1)), 0, n - 1))
+
+    def h_marker_state(self, arg, query, n):
+        markers = self.state['markers']
+        if query:
+            return fmt_bool(n in markers)
+        if arg is not None and parse_value(arg) in (0.0, 'OFF'):
+            markers.pop(n, None)
+        elif n not in markers:
+            markers[n] = self.state['center']
+
+    def h_marker_off(self, arg, query, n):
+        self.state['markers'].clear()
+
+    def h_marker_max(self, arg, query, n):
+        data = self.trace(1)
+        self.state['markers'][n] = self.axis()[int(np.argmax(data))]
+
+    def h_marker_next(self, arg, query, n):
+        # Next lower peak (6 dB above the median noise) more than one RBW away from the marker
+        data    = self.trace(1)
+        f       = self.axis()
+        marker  = self.state['markers'].get(n)
+        if marker is None:
+            self.h_marker_max(arg, query, n)
+            return
+        level   = data[self._marker_index(marker)]
+        inner   = data[1:-1]
+        peaks   = np.flatnonzero((inner >= data[:-2]) & (inner > data[2:]) &
+                                 (inner > np.median(data) + 6) & (inner <= level)) + 1
+        peaks   = peaks[np.abs(f[peaks] - marker) > self.rbw]
+        if len(peaks) == 0:
+            raise SCPIError(780, "No peak found")
+        self.state['markers'][n] = f[peaks[np.argmax(data[peaks])]]
+
+    def h_marker_x(self, arg, query, n):
+        markers = self.state['markers']
+        if query:
+            if n not in markers:
+                raise SCPIError(-221, "Settings conflict")
+            return fmt_real(self.axis()[self._marker_index(markers[n])])
+        markers[n] = self.axis()[self._marker_index(self.number(arg))]
+
+    def h_marker_y(self, arg, query, n):
+        marker = self.state['markers'].get(n)
+        if marker is None:
+            raise SCPIError(-221, "Settings conflict")
+        return fmt_real(float(self.trace(1)[self._marker_index(marker)]))
+
+
+def arb_tones(data: bytes, fs: float, max_tones: int = 16):
+    """
+    Tones of an arb waveform (interleaved int16 I/Q), byte order detected from the spectrum.
+    :return: List of (offset Hz, power relative to the total dB)
+    """
+    best = None
+    for dtype in ('>i2', '<i2'):
+        iq      = np.frombuffer(data[:len(data) // 4 * 4], dtype=dtype).astype(np.float64)
+        x       = iq[0::2] + 1j * iq[1::2]
+        p       = np.abs(np.fft.fft(x)) ** 2
+        total   = p.sum()
+        if len(p) == 0 or total == 0:
+            continue
+        concentration = np.sort(p)[-max_tones:].sum() / total
+        if best is None or concentration > best[0]:
+            best = (concentration, p, total)
+    if best is None:
+        return []
+    _, p, total = best
+    bins    = np.flatnonzero(p > p.max() * 1e-3)
+    bins    = bins[np.argsort(p[bins])[::-1][:max_tones]]
+    freqs   = np.fft.fftfreq(len(p), 1 / fs)
+    return [(float(freqs[k]), 10 * math.log10(p[k] / total)) for k in bins]
+
+
+class SignalGeneratorSim(SimulatedInstrument):
+    """
+    Vector signal generator: CW or arb (multi tone) output.
+    Commands that are not simulated (pyarbtools configuration, ALC, ...) are accepted and stored.
+    """
+    idn = 'Agilent Technologies, N5182B, SIM00002, B.01.86'
+
+    def __init__(self, **kwargs):
+        self.waveforms  = {}    # Name -> (int16 I/Q bytes, {sample rate: tones})
+        super().__init__(**kwargs)
+        setting = self.setting
+        self.handlers.update({
+            'FREQ': lambda a, q, n: setting('freq', a, q, lambda v: self.clip(self.number(v), 9e3, 6e9), fmt_real),
+            'POW': lambda a, q, n: setting('power', a, q, lambda v: self.clip(self.number(v), -144.0, 20.0),
+                                           fmt_real),
+            'OUTP': lambda a, q, n: setting('output', a, q, self.bool, fmt_bool),
+            'OUTP:MOD': lambda a, q, n: setting('modulation', a, q, self.bool, fmt_bool),
+            'RAD:ARB': lambda a, q, n: setting('arb', a, q, self.bool, fmt_bool),
+            'RAD:ARB:SCL:RATE': lambda a, q, n: setting('sample_rate', a, q, self.number, fmt_real),
+            'RAD:ARB:WAV': self.h_waveform,
+            'MMEM:DATA': self.h_download,
+            'ROSC:SOUR': lambda a, q, n: 'INT' if q else None,
+            # Frequency list/step sweep (single sweep, started by INIT)
+            'FREQ:CW': lambda a, q, n: setting('freq', a, q, lambda v: self.clip(self.number(v), 9e3, 6e9),
+                                               fmt_real),
+            'FREQ:MODE': lambda a, q, n: setting('freq_mode', a, q,
+                                                 lambda v: self.choice(v, ('CW', 'FIX', 'LIST')), str),
+            'FREQ:STAR': lambda a, q, n: setting('start', a, q, lambda v: self.clip(self.number(v), 9e3, 6e9),
+                                                 fmt_real),
+            'FREQ:STOP': lambda a, q, n: setting('stop', a, q, lambda v: self.clip(self.number(v), 9e3, 6e9),
+                                                 fmt_real),
+            'LIST:TYPE': lambda a, q, n: setting('list_type', a, q, lambda v: self.choice(v, ('LIST', 'STEP')), str),
+            'SWE:POIN': lambda a, q, n: setting('points', a, q, lambda v: int(self.clip(self.number(v), 2, 65535)),
+                                                fmt_int),
+            'SWE:DWEL': lambda a, q, n: setting('dwell', a, q, lambda v: self.clip(self.number(v), 1e-6, 100.0),
+                                                fmt_real),
+            'LIST:FREQ': lambda a, q, n: self.h_list('list_freq', a, q),
+            'LIST:DWEL': lambda a, q, n: self.h_list('list_dwell', a, q),
+            'INIT': self.h_init,
+        })
+
+    def reset(self):
+        self.state = {'freq': 1e9, 'power': -110.0, 'output': False, 'modulation': True, 'arb': False,
+                      'sample_rate': 100e6, 'waveform': None, 'other': {},
+                      'freq_mode': 'CW', 'list_type': 'STEP', 'start': 100e6, 'stop': 6e9, 'points': 101,
+                      'dwell': 2e-3, 'list_freq': [1e9], 'list_dwell': [2e-3], 'sweep_start': None}
+
+    def unknown(self, key, arg, query):
+        # Not simulated: store the setting and answer queries with the stored value
+        other = self.state['other']
+        if query:
+            return other.get(key, '+0')
+        other[key] = arg.strip() if arg is not None else ''
+
+    def h_waveform(self, arg, query, n):
+        if query:
+            return f'"{self.state["waveform"]}"'
+        name = arg.strip().strip('"\'')
+        if name.split(':')[-1] not in self.waveforms:
+            raise SCPIError(-256, "File name not found")
+        self.state['waveform'] = name
+
+    def h_download(self, arg, query, n):
+        # MMEM:DATA "WFM1:<name>",#<n><length><data>
+        m = re.match(r'\s*["\']([^"\']*)["\']\s*,\s*#(\d)', arg or '')
+        if m is None:
+            raise SCPIError(-109, "Missing parameter")
+        pos     = m.end()
+        length  = int(arg[pos:pos + int(m.group(2))])
+        pos    += int(m.group(2))
+        self.waveforms[m.group(1).split(':')[-1]] = (arg[pos:pos + length].encode('latin-1'), {})
+
+    def h_list(self, key, arg, query):
+        if query:
+            return ','.join(fmt_real(v) for v in self.state[key])
+        values = [self.number(v) for v in (arg or '').split(',')]
+        self.state[key] = values
+
+    def h_init(self, arg, query, n):
+        if self.state['freq_mode'] == 'LIST':
+            self.state['sweep_start'] = time.monotonic()
+
+    def sweep_points(self):
+        """
+        :return: Frequency (Hz) and dwell time (s) arrays of the list/step sweep
+        """
+        state = self.state
+        if state['list_type'] == 'STEP':
+            return (np.linspace(state['start'], state['stop'], state['points']),
+                    np.full(state['points'], state['dwell']))
+        freq    = np.asarray(state['list_freq'], dtype=np.float64)
+        dwell   = np.asarray(state['list_dwell'], dtype=np.float64)
+        return freq, np.broadcast_to(dwell if len(dwell) > 1 else dwell[:1], freq.shape)
+
+    def sweep_edges(self):
+        # Start time of each sweep point and the end of the sweep
+        freq, dwell = self.sweep_points()
+        return freq, self.state['sweep_start'] + np.concatenate(([0.0], np.cumsum(dwell)))
+
+    def operation_end(self) -> float:
+        # *OPC? completes at the end of a running sweep
+        if self.state['freq_mode'] == 'LIST' and self.state['sweep_start'] is not None:
+            return max(self.sweep_edges()[1][-1], time.monotonic())
+        return time.monotonic()
+
+    def output_tones(self, freq: float = None):
+        """
+        :param freq: Carrier frequency (default: the CW frequency or the current sweep point)
+        :return: List of (frequency Hz, power dBm) at the generator output
+        """
+        state = self.state
+        if not state['output']:
+            return []
+        if freq is None:
+            freq = state['freq']
+            if state['freq_mode'] == 'LIST' and state['sweep_start'] is not None:
+                points, edges = self.sweep_edges()
+                freq = points[int(np.clip(np.searchsorted(edges, time.monotonic(), 'right') - 1, 0,
+                                          len(points) - 1))]
+        if state['modulation'] and state['arb'] and state['waveform'] is not None:
+            data, tones = self.waveforms.get(state['waveform'].split(':')[-1], (b'', {}))
+            fs          = state['sample_rate']
+            if fs not in tones:
+                tones[fs] = arb_tones(data, fs)
+            if tones[fs]:
+                return [(freq + offset, state['power'] + rel) for offset, rel in tones[fs]]
+        return [(freq, state['power'])]
+
+    def output_segments(self, t0: float, t1: float):
+        """
+        Output between the times t0 and t1: before the sweep the first point, after it the last one.
+        :return: List of (on time, off time, tones)
+        """
+        state = self.state
+        if state['freq_mode'] != 'LIST' or state['sweep_start'] is None:
+            return [(-math.inf, math.inf, self.output_tones())]
+        points, edges = self.sweep_edges()
+        edges       = edges.copy()
+        edges[0]    = -math.inf
+        edges[-1]   = math.inf
+        first       = max(int(np.searchsorted(edges, t0, 'right')) - 1, 0)
+        last        = min(int(np.searchsorted(edges, t1, 'left')), len(points))
+        return [(edges[i], edges[i + 1], self.output_tones(points[i])) for i in range(first, last)]
+
+
+class Bench:
+    """
+    Signal generator -> device under test -> setup loss -> spectrum analyzer
+    """
+    def __init__(self, dut = None, loss: float = 0.0, sa_kwargs = None, sg_kwargs = None):
+        self.dut    = dut if dut is not None else Thru()
+        self.loss   = loss  # dB
+        self.sg     = SignalGeneratorSim(name='SG', **(sg_kwargs or {}))
+        self.sa     = SpectrumAnalyzerSim(source=self.spectrum, segments=self.segments, name='SA',
+                                          **(sa_kwargs or {}))
+        self.servers= []
+        self.sg_raw = []    # Raw socket servers of the generator (see sync_sg)
+
+    def sync_sg(self):
+        # A raw socket write returns before the generator has read it: execute the generator messages already
+        # received before the analyzer measures, so a sweep sees the SG commands sent before it (as with VXI-11,
+        # where a write returns once executed)
+        for server in self.sg_raw:
+            server.drain()
+
+    def spectrum(self):
+        self.sync_sg()
+        with self.sg.lock:
+            tones = self.sg.output_tones()
+        return [(f, p - self.loss) for f, p in self.dut.output(tones)]
+
+    def segments(self, t0: float, t1: float):
+        # Time varying input of the analyzer (a frequency sweep of the generator)
+        self.sync_sg()
+        with self.sg.lock:
+            segments = self.sg.output_segments(t0, t1)
+        return [(on, off, [(f, p - self.loss) for f, p in self.dut.output(tones)]) for on, off, tones in segments]
+
+    def serve(self, ip_sa: str, ip_sg: str, raw_port: int = 5025, vxi11: bool = True, portmapper_port: int = 111):
+        for ip, instrument in ((ip_sa, self.sa), (ip_sg, self.sg)):
+            raw = RawSocketServer(instrument, ip, raw_port, log=instrument.log).start()
+            self.servers.append(raw)
+            if instrument is self.sg:
+                self.sg_raw.append(raw)
+            if vxi11:
+                core = Vxi11Server(instrument, ip, 0, log=instrument.log).start()
+                self.servers.append(core)
+                try:
+                    self.servers.append(PortMapper(ip, {DEVICE_CORE_PROG: core.address[1]},
+                                                   portmapper_port, log=instrument.log).start())
+                except PermissionError:
+                    instrument.log.error(f"{instrument.name}: No permission for the portmapper port "
+                                         f"{portmapper_port}, use TCPIP0::{ip},{core.address[1]}::inst0::INSTR "
+                                         f"or the raw socket")
+        return self
+
+    def stop(self):
+        for server in self.servers:
+            server.stop()
+        self.servers = []
+        self.sg_raw  = []
+
+
+def make_dut(config: dict):
+    dut = config.get('dut', 'pa')
+    if dut == 'pa':
+        return RappPA.from_database(config.get('sn', 'SN1234'))
+    if dut == 'filter':
+        return BandpassFilter(f0=config.get('f0', 900.0), bw=config.get('bw', 20.0),
+                              order=config.get('order', 3), insertion_loss=config.get('il', 1.5))
+    return Thru()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="SCPI instrument simulator (SA + SG + device under test)")
+    parser.add_argument('--config', help="YAML file with the options below")
+    parser.add_argument('--sa', default='127.0.0.2', help="Spectrum analyzer address")
+    parser.add_argument('--sg', default='127.0.0.3', help="Signal generator address")
+    parser.add_argument('--dut', default='pa', choices=('pa', 'filter', 'thru'))
+    parser.add_argument('--sn', default='SN1234', choices=sorted(PA_DATABASE), help="PA serial number")
+    parser.add_argument('--loss', type=float, default=32.5, help="Setup loss (dB) after the DUT")
+    parser.add_argument('--time-scale', type=float, default=1.0, help="Sweep time scale (0 - no wait)")
+    parser.add_argument('--latency', type=float, default=0.0, help="Seconds per message")
+    parser.add_argument('--seed', type=int, default=None, help="Noise seed")
+    parser.add_argument('--no-vxi11', action='store_true', help="Raw socket only")
+    parser.add_argument('--debug', action='store_true')
+    args    = parser.parse_args()
+    config  = vars(args)
+    if args.config:
+        with open(args.config, 'r') as file:
+            config.update(yaml.safe_load(file))
+
+    logging.basicConfig(level=logging.DEBUG if config['debug'] else logging.INFO,
+                        format='%(asctime)s %(levelname)s %(message)s')
+    common  = {'latency': config['latency']}
+    bench   = Bench(dut=make_dut(config), loss=config['loss'],
+                    sa_kwargs=dict(common, time_scale=config['time_scale'], seed=config['seed']),
+                    sg_kwargs=common)
+    bench.serve(config['sa'], config['sg'], vxi11=not config['no_vxi11'])
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        bench.stop()
+
+
+if __name__ == '__main__':
+    main()
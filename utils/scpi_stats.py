@@ -0,0 +1,156 @@
+import json
+import math
+import threading
+import time
+
+import numpy as np
+
+from python_rf_course.utils.scpi_cache import normalize_header
+
+# Round trip statistics of the SCPI commands, by normalized header (opt-in: SCPIWrapper(stats=SCPIStats())).
+# A semicolon joined message (transaction) is a single round trip, its key joins the headers:
+# "FREQ:CENT;INIT;*OPC?;CALC:MARK:MAX;CALC:MARK:Y?".
+
+
+class LatencyHistogram:
+    """
+    Log-linear histogram (HDR histogram layout) of latencies in microseconds:
+    2^sub_bits linear buckets, then 2^(sub_bits-1) buckets per power of two.
+    The relative error of a bucket is below 2^-(sub_bits-1) (3% for sub_bits=6), the cost of record() is constant.
+    """
+    def __init__(self, sub_bits = 6, max_us = 1 << 36):
+        self.sub_bits   = sub_bits
+        self.sub_count  = 1 << sub_bits
+        self.half       = self.sub_count >> 1
+        n_octaves       = max(1, max_us.bit_length() - sub_bits + 1)
+        self.counts     = [0] * (self.sub_count + n_octaves * self.half)
+        self.count      = 0
+        self.total      = 0.0       # Seconds
+        self.min        = math.inf  # Seconds
+        self.max        = 0.0       # Seconds
+
+    def index(self, us: int) -> int:
+        if us < self.sub_count:
+            return us
+        shift = us.bit_length() - self.sub_bits
+        return min(self.sub_count + (shift - 1) * self.half + (us >> shift) - self.half, len(self.counts) - 1)
+
+    def lower(self, index: int) -> int:
+        # Lowest value (us) of a bucket
+        if index < self.sub_count:
+            return index
+        shift, sub = divmod(index - self.sub_count, self.half)
+        return (sub + self.half) << (shift + 1)
+
+    def record(self, seconds: float):
+        self.counts[self.index(int(seconds * 1e6))] += 1
+        self.count  += 1
+        self.total  += seconds
+        if seconds < self.min:
+            self.min = seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def percentile(self, q: float) -> float:
+        """
+        :param q: Percentile (0-100)
+        :return: Latency (seconds), middle of the bucket
+        """
+        if self.count == 0:
+            return 0.0
+        target  = max(1, math.ceil(q / 100 * self.count))
+        index   = int(np.searchsorted(np.cumsum(self.counts), target))
+        value   = (self.lower(index) + self.lower(index + 1)) / 2 * 1e-6
+        return min(max(value, self.min), self.max)
+
+    def merge(self, other):
+        self.counts = [a + b for a, b in zip(self.counts, other.counts)]
+        self.count += other.count
+        self.total += other.total
+        self.min    = min(self.min, other.min)
+        self.max    = max(self.max, other.max)
+
+    def to_dict(self) -> dict:
+        return {'count': self.count, 'total': self.total,
+                'mean': self.total / self.count if self.count else 0.0,
+                'min': self.min if self.count else 0.0, 'max': self.max,
+                'p50': self.percentile(50), 'p90': self.percentile(90),
+                'p99': self.percentile(99), 'p999': self.percentile(99.9),
+                # Non empty buckets (lower bound us -> count) to merge exported runs
+                'buckets': {self.lower(i): c for i, c in enumerate(self.counts) if c}}
+
+
+class HeaderStats:
+    def __init__(self):
+        self.latency    = LatencyHistogram()
+        self.bytes_out  = 0
+        self.bytes_in   = 0
+
+
+def stats_key(cmd: str) -> str:
+    # Normalized headers of a (semicolon joined) message, queries keep the question mark
+    keys = []
+    for unit in cmd.split(';'):
+        header = unit.strip().split(None, 1)[0] if unit.strip() else ''
+        keys.append(normalize_header(header) + ('?' if header.endswith('?') else ''))
+    return ';'.join(keys)
+
+def answer_bytes(ans) -> int:
+    # Writes return None (or the number of bytes sent)
+    if isinstance(ans, np.ndarray):
+        return ans.nbytes
+    if isinstance(ans, (str, bytes)):
+        return len(ans) + 1
+    return 0
+
+
+class SCPIStats:
+    """
+    Round trip time (histogram), count and bytes of each SCPI header.
+    One object can be shared by several wrappers (thread safe).
+    """
+    def __init__(self):
+        self.headers    = {}    # key -> HeaderStats
+        self.lock       = threading.Lock()
+        self.started    = time.time()
+
+    def record(self, cmd: str, seconds: float, ans = None):
+        key = stats_key(cmd)
+        with self.lock:
+            stats = self.headers.get(key)
+            if stats is None:
+                stats = self.headers[key] = HeaderStats()
+            stats.latency.record(seconds)
+            stats.bytes_out += len(cmd) + 1
+            stats.bytes_in  += answer_bytes(ans)
+
+    def reset(self):
+        with self.lock:
+            self.headers    = {}
+            self.started    = time.time()
+
+    def summary(self) -> list:
+        """
+        :return: One dict per header (key, count, total, mean, min, max, p50, p90, p99, p999, bytes),
+                 sorted by the total time
+        """
+        with self.lock:
+            rows = []
+            for key, stats in self.headers.items():
+                row = stats.latency.to_dict()
+                row.pop('buckets')
+                row.update(key=key, bytes_out=stats.bytes_out, bytes_in=stats.bytes_in)
+                rows.append(row)
+        return sorted(rows, key=lambda r: -r['total'])
+
+    def to_json(self, path: str = None) -> str:
+        with self.lock:
+            data = {'started': self.started, 'elapsed': time.time() - self.started,
+                    'headers': {key: dict(stats.latency.to_dict(), bytes_out=stats.bytes_out,
+                                          bytes_in=stats.bytes_in)
+                                for key, stats in self.headers.items()}}
+        text = json.dumps(data, indent=1)
+        if path is not None:
+            with open(path, 'w') as f:
+                f.write(text)
+        return text
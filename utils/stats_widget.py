@@ -0,0 +1,64 @@
+from PyQt6.QtWidgets import (QDockWidget, QWidget, QVBoxLayout, QHBoxLayout, QTableWidget, QTableWidgetItem,
+                             QPushButton, QFileDialog, QHeaderView, QAbstractItemView)
+from PyQt6.QtCore    import QTimer
+
+
+COLUMNS = ('Header', 'Count', 'Mean (ms)', 'p50 (ms)', 'p90 (ms)', 'p99 (ms)', 'Max (ms)', 'Total (s)',
+           'Out (kB)', 'In (kB)')
+
+
+class StatsDock(QDockWidget):
+    """
+    Live table of the SCPI round trip statistics (SCPIStats), refreshed by a timer
+    """
+    def __init__(self, stats, parent=None, period_ms=1000):
+        super().__init__("SCPI Statistics", parent)
+        self.stats  = stats
+
+        widget      = QWidget()
+        layout      = QVBoxLayout(widget)
+        self.table  = QTableWidget(0, len(COLUMNS))
+        self.table.setHorizontalHeaderLabels(COLUMNS)
+        self.table.setEditTriggers(QAbstractItemView.EditTrigger.NoEditTriggers)
+        self.table.horizontalHeader().setSectionResizeMode(0, QHeaderView.ResizeMode.Stretch)
+        layout.addWidget(self.table)
+
+        buttons     = QHBoxLayout()
+        reset       = QPushButton("Reset")
+        reset.clicked.connect(self.cb_reset)
+        export      = QPushButton("Export JSON")
+        export.clicked.connect(self.cb_export)
+        buttons.addWidget(reset)
+        buttons.addWidget(export)
+        layout.addLayout(buttons)
+        self.setWidget(widget)
+
+        self.timer  = QTimer(self)
+        self.timer.timeout.connect(self.refresh)
+        self.timer.start(period_ms)
+
+    def refresh(self):
+        if not self.isVisible():
+            return
+        rows = self.stats.summary()
+        self.table.setRowCount(len(rows))
+        for i, r in enumerate(rows):
+            values = (r['key'], str(r['count']),
+                      f"{r['mean'] * 1e3:.2f}", f"{r['p50'] * 1e3:.2f}", f"{r['p90'] * 1e3:.2f}",
+                      f"{r['p99'] * 1e3:.2f}", f"{r['max'] * 1e3:.2f}", f"{r['total']:.2f}",
+                      f"{r['bytes_out'] / 1e3:.1f}", f"{r['bytes_in'] / 1e3:.1f}")
+            for j, value in enumerate(values):
+                item = self.table.item(i, j)
+                if item is None:
+                    item = QTableWidgetItem()
+                    self.table.setItem(i, j, item)
+                item.setText(value)
+
+    def cb_reset(self):
+        self.stats.reset()
+        self.refresh()
+
+    def cb_export(self):
+        path, _ = QFileDialog.getSaveFileName(self, "Export SCPI statistics", "scpi_stats.json", "JSON (*.json)")
+        if path:
+            self.stats.to_json(path)
@@ -0,0 +1,103 @@
+import logging
+import numpy as np
+import pyvisa
+
+
+class TraceReader:
+    """
+    Read spectrum analyzer traces as binary REAL,32 (IEEE 488.2 definite length block)
+    and decode them straight into float32 buffers.
+    Instruments (older firmware) that reject the binary format are switched back to ASCII.
+
+    The returned array is a view of a caller supplied buffer (out) or of a pooled buffer
+    (one per trace length). A pooled buffer is reused by the next read, copy it if it is kept.
+    """
+    def __init__(self, instr, log = None, binary = True):
+        self.instr      = instr
+        self.log        = log if log is not None else logging.getLogger(__name__)
+        self.binary     = binary # False after falling back to ASCII
+        self.big_endian = False
+        self.configured = False
+        self.pool       = {}     # Preallocated float32 buffers by number of points
+
+    def invalidate(self):
+        # The data format has to be set again (after *RST, *RCL or a preset)
+        self.configured = False
+
+    def _drain_errors(self):
+        errors = []
+        for _ in range(32):
+            e = self.instr.query('SYST:ERR?').strip().split(',', 1)
+            if int(e[0]) == 0:
+                break
+            errors.append(e[1].strip().strip('"') if len(e) > 1 else e[0])
+        return errors
+
+    def configure(self):
+        if self.binary:
+            # Clear old errors so that only the format errors are seen
+            self._drain_errors()
+            self.instr.write(':FORMat:TRACe:DATA REAL,32')
+            errors = self._drain_errors()
+            if errors:
+                self.log.warning(f"Binary trace format not supported ({errors[0]}), using ASCII")
+                self.binary = False
+            else:
+                # Little endian (swapped) byte order. If not supported keep the SCPI default (big endian)
+                self.instr.write(':FORMat:BORDer SWAPped')
+                self.big_endian = len(self._drain_errors()) > 0
+
+        if not self.binary:
+            self.instr.write(':FORMat:TRACe:DATA ASCii')
+
+        self.configured = True
+
+    def buffer(self, n_points: int) -> np.ndarray:
+        buf = self.pool.get(n_points)
+        if buf is None:
+            buf = np.empty(n_points, dtype=np.float32)
+            self.pool[n_points] = buf
+        return buf
+
+    def read(self, trace: int = 1, out: np.ndarray = None) -> np.ndarray:
+        """
+        Read a trace from the instrument.
+        :param trace: Trace number (1-6)
+        :param out: Optional float32 buffer, at least as long as the trace
+        :return: float32 view with the trace data (dBm)
+        """
+        if not self.configured:
+            self.configure()
+
+        cmd = f":TRACe:DATA? TRACE{trace}"
+        if self.binary:
+            try:
+                data = self._read_binary(cmd)
+            except ValueError:
+                # Not a binary block: the format was reset by the instrument, set it again and retry
+                self.configure()
+                try:
+                    data = self._read_binary(cmd) if self.binary else None
+                except ValueError:
+                    self.log.warning("Binary trace read failed, using ASCII")
+                    self.binary = False
+                    self.configure()
+                    data = None
+            if data is not None:
+                return self._copy(data, out)
+
+        data = self.instr.query_ascii_values(cmd, container=np.array)
+        return self._copy(data, out)
+
+    def _read_binary(self, cmd: str) -> np.ndarray:
+        # query_binary_values with a numpy container wraps the block without parsing (np.frombuffer)
+        return self.instr.query_binary_values(cmd, datatype='f', is_big_endian=self.big_endian,
+                                              container=np.array)
+
+    def _copy(self, data: np.ndarray, out: np.ndarray) -> np.ndarray:
+        n = len(data)
+        if out is None:
+            out = self.buffer(n)
+        # The only copy: from the received block into the float32 buffer (byte order converted)
+        np.copyto(out[:n], data, casting='unsafe')
+        return out[:n]